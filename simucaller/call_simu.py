@@ -3,10 +3,17 @@ Simulation region calling algorithms
 
 algorithms:
     diff_ttest
+    diff_ttest_phases
+    ttest
+    scan_break_points
+
+Algorithms are registered in `simucaller.registry` with block kernels,
+evaluated by engines in `simucaller.engine`.
 """
 
 import sys
 import multiprocessing as mp
+from collections import OrderedDict
 from itertools import product, islice, repeat
 
 if sys.version_info <= (3, 0):
@@ -16,14 +23,133 @@ import numpy as np
 from scipy import stats
 
 from helpers import get_logger, grouper
+from simucaller.progress import ProgressTracker
+from simucaller.registry import register
+from simucaller.engine import iter_blocks, run_algorithm
+from simucaller.kernels import resolve_backend, ttest_columns
+from simucaller.kernels import _lagged_column_moments
 
 log = get_logger(__name__)
 
 n_cpu = mp.cpu_count()
 
 
+def _cumsum0(arr):
+    """
+    cumulative sum along the first axis with a leading zero, in float64,
+    so the sum of arr[a:b] is `out[b] - out[a]`.
+    """
+    out = np.zeros((arr.shape[0] + 1,) + arr.shape[1:], dtype=np.float64)
+    np.cumsum(arr, axis=0, out=out[1:])
+    return out
+
+
+def _ttest_from_moments(n1, s1, ss1, n2, s2, ss2):
+    """
+    Student's two sample t-test (same as `scipy.stats.ttest_ind`) from
+    the count, sum and sum of squares of each sample, return (t, df) pair.
+
+    :n1, s1, ss1: count, sum and sum of squares of sample 1
+    :n2, s2, ss2: count, sum and sum of squares of sample 2
+    """
+    n1 = np.asarray(n1, dtype=np.float64)
+    n2 = np.asarray(n2, dtype=np.float64)
+    m1, m2 = s1 / n1, s2 / n2
+    # sum of squared deviations, clip the rounding error
+    dev1 = np.maximum(ss1 - s1 * m1, 0)
+    dev2 = np.maximum(ss2 - s2 * m2, 0)
+    return _ttest_from_deviations(n1, m1, dev1, n2, m2, dev2)
+
+
+def _ttest_from_deviations(n1, m1, dev1, n2, m2, dev2):
+    """
+    Student's two sample t-test from the count, mean and
+    sum of squared deviations of each sample, return (t, df) pair.
+    """
+    df = n1 + n2 - 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        var = (dev1 + dev2) / df
+        t = (m1 - m2) / np.sqrt(var * (1.0 / n1 + 1.0 / n2))
+    return t, df
+
+
+def _column_moments(arr2d):
+    """
+    mean and sum of squared deviations of each column.
+
+    Element-wise temporaries stay in arr2d's dtype (safe after centering),
+    reductions accumulate in float64.
+    """
+    mean = arr2d.mean(axis=0, dtype=np.float64)
+    dev = arr2d - mean.astype(arr2d.dtype)
+    np.square(dev, out=dev)
+    return mean, dev.sum(axis=0, dtype=np.float64)
+
+
+def _ttest_columns(a, b):
+    """
+    Student's two sample t-test of every column of a (n1, m) against b (n2, m),
+    return (t, df) pair.
+    """
+    m1, dev1 = _column_moments(a)
+    m2, dev2 = _column_moments(b)
+    return _ttest_from_deviations(a.shape[0], m1, dev1, b.shape[0], m2, dev2)
+
+
+def _diff_ranges(nt, starts, ends, n_before=None, n_after=None,
+                 phase=1, diff_length=1):
+    """
+    Ranges of differences (diff[i] = series[i+diff_length] - series[i])
+    used by diff_ttest, before the event and in the phase after the event.
+    return (before_lo, before_hi, after_lo, after_hi), all int arrays.
+
+    :nt: (int) length of time series
+    :starts: (array) image index numbers when event start.
+    :ends: (array) image index numbers when event end.
+    :n_before: (int) same to `_diff_ttest`
+    :n_after: (int) same to `_diff_ttest`
+    :phase: (int) same to `_diff_ttest`
+    :diff_length: (int) same to `_diff_ttest`
+    """
+    assert phase >= 1 and diff_length >= 1, "phase and diff_length start from 1"
+    assert phase == 1 or n_after, "phases after the first need n_after"
+    starts = np.atleast_1d(starts)
+    ends = np.atleast_1d(ends)
+    before_lo = starts - n_before if n_before else np.zeros_like(starts)
+    before_hi = starts - diff_length
+    if n_after:
+        after_lo = ends + 1 + (phase - 1) * n_after
+        after_hi = np.minimum(after_lo + n_after, nt) - diff_length
+    else:
+        after_lo = ends + 1
+        after_hi = np.full_like(ends, nt - diff_length)
+    assert (before_lo >= 0).all(), "break points out of range"
+    assert (before_hi > before_lo).all() and (after_hi > after_lo).all(),\
+        "break points leave no image before or after event"
+    return before_lo, before_hi, after_lo, after_hi
+
+
+def _directional(t, pvalue, direction='+'):
+    """
+    apply direction to two-sided pvalues, same rule as `_ttest`:
+    pvalue set to 1 when t's sign not match the direction.
+    """
+    if direction == '+':
+        pvalue = np.where(t > 0, pvalue, 1)
+    elif direction == '-':
+        pvalue = np.where(t < 0, pvalue, 1)
+    return pvalue
+
+
+def _directional_pvalue(t, df, direction='+'):
+    """
+    convert t statistic to pvalue, see `_directional`.
+    """
+    return _directional(t, 2 * stats.t.sf(np.abs(t), df), direction)
+
+
 def _diff_ttest(position, time_series, break_points, direction='+',
-                n_before=None, n_after=None, phase=0, diff_length=1):
+                n_before=None, n_after=None, phase=1, diff_length=1):
     """
     perform diff_ttest algorithm on time_series, return (position, pvalue) pair
 
@@ -34,8 +160,9 @@ def _diff_ttest(position, time_series, break_points, direction='+',
         '~' for not consider direction
     :n_before: (int) how many images to consider before the event occur.
     :n_after: (int) how many images to consider in the phase after event occur.
-    :phase: (int) phase number.
-    :diff_length: (int)
+    :phase: (int) phase number, phase k is the k-th n_after images after the event,
+        phases after the first need n_after.
+    :diff_length: (int) lag of differences, time_series[i+diff_length] - time_series[i]
     """
     break_start, break_end = break_points
     if n_before:
@@ -43,11 +170,14 @@ def _diff_ttest(position, time_series, break_points, direction='+',
     else:
         before = time_series[:break_start]
     if n_after:
-        after = time_series[break_end+1 : break_end+n_after+1]
+        after_start = break_end + 1 + (phase - 1) * n_after
+        after = time_series[after_start : after_start+n_after]
     else:
+        assert phase == 1, "phases after the first need n_after"
         after = time_series[break_end+1:]
-    diff_before = np.diff(before)
-    diff_after = np.diff(after)
+    k = diff_length
+    diff_before = before[k:] - before[:-k]
+    diff_after = after[k:] - after[:-k]
     T = stats.ttest_ind(diff_after, diff_before)
     if direction == '+':
         pvalue = T[1] if T[0] > 0 else 1
@@ -84,103 +214,524 @@ def _ttest(position, time_series, intervals, direction='+'):
     return position, pvalue
 
 
+MOMENT_INDEX = 'moment_index'
+
+
+def build_moment_index(series, block_size=8):
+    """
+    Build per-voxel moment index, store it in the hdf5 group `moment_index`:
+
+    * cumsum: cumulative sums of values, (t+1, y, x, z)
+    * cumsum_sq: cumulative sums of squares, (t+1, y, x, z)
+    * cumsum_diff: cumulative sums of first differences, (t, y, x, z)
+    * cumsum_diff_sq: cumulative sums of squared first differences, (t, y, x, z)
+
+    With the index, `ttest` and `diff_ttest` with any intervals or break points
+    only read a few time points, instead of the whole time axis.
+
+    :series: `simucaller.series.Series` object.
+    :block_size: (int) how many y slices processed at once.
+    """
+    h5dict = series.h5dict
+    if MOMENT_INDEX in h5dict:
+        del h5dict[MOMENT_INDEX]
+    group = h5dict.create_group(MOMENT_INDEX)
+    nt, ny, nx, nz = series.shape
+    for name, length in (('cumsum', nt + 1), ('cumsum_sq', nt + 1),
+                         ('cumsum_diff', nt), ('cumsum_diff_sq', nt)):
+        group.create_dataset(name, shape=(length, ny, nx, nz), dtype=np.float64,
+                             maxshape=(None, ny, nx, nz))
+
+    log.info("building moment index ...")
+    for ys, block in iter_blocks(series, block_size):
+        block = block.astype(np.float64)
+        diff = np.diff(block, axis=0)
+        group['cumsum'][:, ys] = _cumsum0(block)
+        group['cumsum_sq'][:, ys] = _cumsum0(block ** 2)
+        group['cumsum_diff'][:, ys] = _cumsum0(diff)
+        group['cumsum_diff_sq'][:, ys] = _cumsum0(diff ** 2)
+    group.attrs['n_images'] = nt
+    h5dict.flush()
+    log.info("moment index stored in group {}".format(MOMENT_INDEX))
+
+
+def extend_moment_index(series, t0, block_size=8):
+    """
+    Extend the moment index after images appended to the series,
+    only rows of new images (from t0) are computed.
+    return True if extended, False if the series has no index
+    or the index is not up to date before appending.
+
+    :series: `simucaller.series.Series` object.
+    :t0: (int) n_images before appending.
+    :block_size: (int) how many y slices processed at once.
+    """
+    h5dict = series.h5dict
+    if MOMENT_INDEX not in h5dict:
+        return False
+    group = h5dict[MOMENT_INDEX]
+    if group.attrs.get('n_images') != t0 or group['cumsum'].maxshape[0] is not None:
+        log.info("moment index is out of date, please rebuild it")
+        return False
+    nt, ny = int(series.shape[0]), int(series.shape[1])
+    for name, length in (('cumsum', nt + 1), ('cumsum_sq', nt + 1),
+                         ('cumsum_diff', nt), ('cumsum_diff_sq', nt)):
+        group[name].resize(length, axis=0)
+
+    dset = h5dict['arr4d']
+    for y0 in range(0, ny, block_size):
+        ys = slice(y0, min(y0 + block_size, ny))
+        # the last old image and new images
+        block = dset[t0-1:, ys].astype(np.float64)
+        new, diff = block[1:], np.diff(block, axis=0)
+        for name, values, row in (('cumsum', new, t0),
+                                  ('cumsum_sq', new ** 2, t0),
+                                  ('cumsum_diff', diff, t0 - 1),
+                                  ('cumsum_diff_sq', diff ** 2, t0 - 1)):
+            last = group[name][row, ys]
+            group[name][row+1:, ys] = last + np.cumsum(values, axis=0)
+    group.attrs['n_images'] = nt
+    h5dict.flush()
+    log.info("moment index extended to {} images".format(nt))
+    return True
+
+
+def has_moment_index(series):
+    """
+    check the series has an up to date moment index.
+    """
+    return MOMENT_INDEX in series.h5dict and \
+        series.h5dict[MOMENT_INDEX].attrs.get('n_images') == series.shape[0]
+
+
+def _read_index(series, name, rows):
+    """
+    read rows of moment index dataset `name`,
+    return a dict map row number to (y, x, z) array.
+    """
+    rows = sorted(set(int(r) for r in rows))
+    arr = series.h5dict[MOMENT_INDEX][name][rows]
+    return dict(zip(rows, arr))
+
+
+def _ttest_from_index(series, intervals, direction='+'):
+    """
+    Evaluate `_ttest` for all voxels from the moment index.
+
+    :series: `simucaller.series.Series` object with moment index.
+    :intervals: (list) a list of intervals. like: [(0, 10), (30, 50), (100, 110)]
+    :direction: ('+'/'-'/'~')
+    """
+    nt = series.shape[0]
+    # merge overlapping intervals same as the mask in `_ttest`
+    mask = np.zeros(nt + 2, dtype=np.int8)
+    for s, e in intervals:
+        mask[s+1:min(e, nt)+1] = 1
+    edges = np.flatnonzero(np.diff(mask))
+    runs = list(zip(edges[::2], edges[1::2]))
+
+    n_simu = sum(e - s for s, e in runs)
+    total = {}
+    simu = {}
+    for name in ('cumsum', 'cumsum_sq'):
+        rows = _read_index(series, name, [0, nt] + list(edges))
+        total[name] = rows[nt] - rows[0]
+        simu[name] = sum(rows[e] - rows[s] for s, e in runs)
+    t, df = _ttest_from_moments(
+        n_simu, simu['cumsum'], simu['cumsum_sq'],
+        nt - n_simu, total['cumsum'] - simu['cumsum'],
+        total['cumsum_sq'] - simu['cumsum_sq'])
+    return _directional_pvalue(t, df, direction)
+
+
+def _phase_pvalues(stats_list, directions):
+    """
+    stack pvalues of each (phase, direction) pair,
+    the two-sided pvalue computed once per phase.
+
+    :stats_list: (list) (t, df) pair of each phase.
+    :directions: (list) of '+'/'-'/'~'
+    return array in shape (n_phases, n_directions) + t.shape
+    """
+    stacked = []
+    for t, df in stats_list:
+        pvalue = 2 * stats.t.sf(np.abs(t), df)
+        stacked.append([_directional(t, pvalue, d) for d in directions])
+    return np.asarray(stacked)
+
+
+def _diff_ttest_phases_from_index(series, break_points, phases=(1,),
+                                  directions=('+',), n_before=None, n_after=None):
+    """
+    Evaluate `_diff_ttest` (first differences) of several phases and directions
+    for all voxels from the moment index,
+    return array in shape (n_phases, n_directions, y, x, z).
+
+    :series: `simucaller.series.Series` object with moment index.
+    :break_points: (tuple) index number of image when event start and end.
+    :phases: (list) phase numbers, see `_diff_ttest`
+    :directions: (list) of '+'/'-'/'~'
+    :n_before: (int) same to `_diff_ttest`
+    :n_after: (int) same to `_diff_ttest`
+    """
+    nt = series.shape[0]
+    ranges = [[int(r[0]) for r in _diff_ranges(nt, *break_points, n_before=n_before,
+                                              n_after=n_after, phase=phase)]
+              for phase in phases]
+    rows = set(r for rs in ranges for r in rs)
+    cs = _read_index(series, 'cumsum_diff', rows)
+    cs_sq = _read_index(series, 'cumsum_diff_sq', rows)
+    stats_list = []
+    for before_lo, before_hi, after_lo, after_hi in ranges:
+        stats_list.append(_ttest_from_moments(
+            after_hi - after_lo,
+            cs[after_hi] - cs[after_lo], cs_sq[after_hi] - cs_sq[after_lo],
+            before_hi - before_lo,
+            cs[before_hi] - cs[before_lo], cs_sq[before_hi] - cs_sq[before_lo]))
+    return _phase_pvalues(stats_list, directions)
+
+
+def _diff_ttest_from_index(series, break_points, direction='+',
+                           n_before=None, n_after=None, phase=1):
+    """
+    Evaluate `_diff_ttest` (first differences) for all voxels from the moment index.
+
+    :series: `simucaller.series.Series` object with moment index.
+    :break_points: (tuple) index number of image when event start and end.
+    :direction: ('+'/'-'/'~')
+    :n_before: (int) same to `_diff_ttest`
+    :n_after: (int) same to `_diff_ttest`
+    :phase: (int) same to `_diff_ttest`
+    """
+    return _diff_ttest_phases_from_index(series, break_points, [phase],
+                                         [direction], n_before, n_after)[0, 0]
+
+
+def _ttest_index(series, params):
+    """ index fast path of 'ttest', None if series has no moment index. """
+    if has_moment_index(series):
+        return _ttest_from_index(series, params['intervals'], params['direction'])
+
+
+def _diff_ttest_index(series, params):
+    """
+    index fast path of 'diff_ttest', None if series has no moment index,
+    the index only store first differences (diff_length 1).
+    """
+    if has_moment_index(series) and params['diff_length'] == 1:
+        return _diff_ttest_from_index(series, params['break_points'],
+            params['direction'], params['n_before'], params['n_after'],
+            params['phase'])
+
+
+def _diff_ttest_phases_index(series, params):
+    """ index fast path of 'diff_ttest_phases', see `_diff_ttest_index`. """
+    if has_moment_index(series) and params['diff_length'] == 1:
+        return _diff_ttest_phases_from_index(series, params['break_points'],
+            params['phases'], params['directions'],
+            params['n_before'], params['n_after'])
+
+
+@register('diff_ttest_phases',
+          params=OrderedDict([('phases', (1,)), ('directions', ('+',)),
+                              ('n_before', None), ('n_after', None),
+                              ('diff_length', 1), ('backend', 'auto')]),
+          series_params={'break_points': 'break_points'},
+          output_shape=lambda params: (len(params['phases']),
+                                       len(params['directions'])),
+          index_func=_diff_ttest_phases_index, memory_factor=2)
+def _diff_ttest_phases_block(arr2d, break_points, phases=(1,), directions=('+',),
+                             n_before=None, n_after=None, diff_length=1,
+                             backend='auto'):
+    """
+    Block kernel of diff_ttest_phases, evaluate `_diff_ttest` of every phase
+    and direction on every column of arr2d (t, n_voxels) in one pass,
+    return pvalues in shape (n_phases, n_directions, n_voxels).
+
+    Moments of the differences before the event are computed once,
+    shared by all phases, the two-sided pvalue once per phase.
+
+    :backend: ('auto'/'numpy'/'numba') see `simucaller.kernels`
+    """
+    nt, k = arr2d.shape[0], diff_length
+    use_numba = resolve_backend(backend) == 'numba'
+
+    def moments(lo, hi):
+        """ count, mean and deviations of differences in rows [lo, hi) """
+        if use_numba:
+            return (hi - lo,) + _lagged_column_moments(arr2d, np.arange(lo, hi), k)
+        block = arr2d[lo:hi + k]
+        return (hi - lo,) + _column_moments(block[k:] - block[:-k])
+
+    before = None
+    stats_list = []
+    for phase in phases:
+        before_lo, before_hi, after_lo, after_hi = [int(r[0]) for r in
+            _diff_ranges(nt, *break_points, n_before=n_before, n_after=n_after,
+                         phase=phase, diff_length=k)]
+        if before is None:
+            before = moments(before_lo, before_hi)
+        stats_list.append(_ttest_from_deviations(
+            *(moments(after_lo, after_hi) + before)))
+    return _phase_pvalues(stats_list, directions)
+
+
+@register('diff_ttest',
+          params=OrderedDict([('direction', '+'), ('n_before', None), ('n_after', None),
+                              ('phase', 1), ('diff_length', 1), ('backend', 'auto')]),
+          series_params={'break_points': 'break_points'},
+          index_func=_diff_ttest_index, memory_factor=2)
+def _diff_ttest_block(arr2d, break_points, direction='+', n_before=None,
+                      n_after=None, phase=1, diff_length=1, backend='auto'):
+    """
+    Block kernel of diff_ttest, evaluate `_diff_ttest` on every column of
+    arr2d (t, n_voxels), return pvalues in shape (n_voxels,).
+
+    :backend: ('auto'/'numpy'/'numba') see `simucaller.kernels`
+    """
+    return _diff_ttest_phases_block(arr2d, break_points, [phase], [direction],
+                                    n_before, n_after, diff_length, backend)[0, 0]
+
+
+@register('ttest',
+          params=OrderedDict([('direction', '+'), ('backend', 'auto')]),
+          series_params={'intervals': 'simu_intervals'},
+          index_func=_ttest_index, memory_factor=2)
+def _ttest_block(arr2d, intervals, direction='+', backend='auto'):
+    """
+    Block kernel of ttest, evaluate `_ttest` on every column of
+    arr2d (t, n_voxels), return pvalues in shape (n_voxels,).
+
+    :backend: ('auto'/'numpy'/'numba') see `simucaller.kernels`
+    """
+    mask = np.zeros(arr2d.shape[0], dtype=bool)
+    for s, e in intervals:
+        mask[s:e] = True
+
+    if resolve_backend(backend) == 'numba':
+        t, df = ttest_columns(arr2d, np.flatnonzero(mask), np.flatnonzero(~mask), 0)
+        return _directional_pvalue(t, df, direction)
+
+    t, df = _ttest_columns(arr2d[mask], arr2d[~mask])
+    return _directional_pvalue(t, df, direction)
+
+
+@register('scan_break_points',
+          params=OrderedDict([('candidates', None), ('width', None),
+                              ('n_before', None), ('n_after', None)]),
+          output_shape=lambda params: (len(params['candidates']),),
+          memory_factor=10)
+def _scan_block(arr2d, candidates, width, n_before=None, n_after=None):
+    """
+    Block kernel of scan_break_points, the diff_ttest t statistic of
+    every candidate break start, return array in shape (n_candidates, n_voxels).
+
+    Cumulative sums and sums of squares of the first differences are
+    computed once per block, every candidate then cost O(1) per voxel.
+    """
+    assert candidates is not None and width is not None,\
+        "scan_break_points need candidates and width"
+    starts = np.asarray(candidates, dtype=np.int64)
+    before_lo, before_hi, after_lo, after_hi = _diff_ranges(
+        arr2d.shape[0], starts, starts + width, n_before, n_after)
+    diff = np.diff(arr2d.astype(np.float64), axis=0)
+    cs = _cumsum0(diff)
+    cs_sq = _cumsum0(diff ** 2)
+    t, _ = _ttest_from_moments(
+        (after_hi - after_lo)[:, None],
+        cs[after_hi] - cs[after_lo], cs_sq[after_hi] - cs_sq[after_lo],
+        (before_hi - before_lo)[:, None],
+        cs[before_hi] - cs[before_lo], cs_sq[before_hi] - cs_sq[before_lo])
+    return t
+
+
+def _call_voxel(args):
+    """ call a per-voxel algorithm in a worker process. """
+    alg_func, _args, kwargs = args
+    return alg_func(*_args, **kwargs)
+
+
 def algorithm_interface(alg_func, series, processes=1, *args, **kwargs):
     """
-    Heleper function provide a middle layer for call algorithm function.
+    Heleper function provide a middle layer for call per-voxel algorithm function,
+    registered algorithms use the block kernel engines in `simucaller.engine`.
 
     :alg_func: algotirhm function like `call_simu._diff_ttest`.
     :series: `simucaller.series.Series` object.
-    :processes: use how many cpu cores perform algorithm.
+    :processes: use how many cpu cores perform algorithm,
+        voxels of each block are evaluated by a pool of worker processes if > 1.
+
+    keyword only arguments, not passed to alg_func:
+
+    :progress: (callable/None) called after each voxel block finished,
+        with a `simucaller.progress.Progress` object.
+    :cancel: (simucaller.progress.CancelToken/None) checked between blocks,
+        raise `simucaller.progress.Cancelled` when cancelled.
+    :block_size: (int) how many y slices read and processed at once.
+    :y_range: (tuple/None) (y_start, y_stop) only evaluate this slab,
+        voxels out of it are NaN, default all.
 
     """
-    # construct arguments
+    progress = kwargs.pop('progress', None)
+    cancel = kwargs.pop('cancel', None)
+    block_size = kwargs.pop('block_size', 8)
+    y_range = kwargs.pop('y_range', None)
+
     nt, ny, nx, nz = series.shape
-    points = product(range(ny), range(nx), range(nz))
-    size = ny * nx * nz
-
-    # read series
-    #
-    # IO is soo slow, so read all information at once here...
-    arr4d = series.h5dict['arr4d'][...]
-    time_series = [arr4d[:, y, x, z]
-                   for y, x, z in product(range(ny), range(nx), range(nz))]
-
-    # construct args repeat
-    rep_args = [points, time_series] + [repeat(arg, size) for arg in args]
-    rep_args = zip(*rep_args)
-    rep_kwargs = repeat(kwargs, size)
-
-    # call algorithm
-    if processes == 1:
-        results = []
-        for _args, _kwargs in zip(rep_args, rep_kwargs):
-            result = alg_func(*_args, **_kwargs)
-            results.append(result)
-    else:
-        raise NotImplementedError # one cpu core seem enough
-        #chunked_args = grouper(args, 10000)
-
-        #def worker(args_chunk):
-        #    result = []
-        #    for arg in args_chunk:
-        #        res = _diff_ttest(*arg)
-        #        result.append(res)
-        #    return result
-
-        #pool = mp.Pool(processes=processes)
-        #log.info("{} processes spawned.".format(processes))
-
-        #results = []
-        #def collect_results(res_chunk):
-        #    for res in res_chunk:
-        #        results.append(res)
-
-        #for args_chunk in chunked_args:
-        #    pool.apply_async(worker, args=args_chunk, callback=collect_results)
-
-        #pool.close()
-        #pool.join()
-        #results.sort(key=lambda t: t[0])
-
-    # sort according to position
-    results = [p for pos, p in results]
-    assert size == len(results)
-
-    # reshape to 3D
-    pvalue_arr3d = np.asarray(results)
-    pvalue_arr3d = pvalue_arr3d.reshape((ny, nx, nz))
+    y_start, y_stop = y_range or (0, ny)
+    pvalue_arr3d = np.full((ny, nx, nz), np.nan)
+    tracker = ProgressTracker((y_stop - y_start) * nx * nz, progress, cancel)
+
+    pool = None
+    if processes != 1:
+        pool = mp.Pool(processes=processes)
+        log.info("{} processes spawned.".format(processes or n_cpu))
+
+    try:
+        # read series
+        #
+        # IO is soo slow, so read a block of voxels at once here...
+        for ys, block in iter_blocks(series, block_size, tracker, y_range):
+            # construct arguments
+            points = product(range(ys.start, ys.stop), range(nx), range(nz))
+            time_series = block.reshape(nt, -1).T
+            size = len(time_series)
+
+            # construct args repeat
+            rep_args = [points, time_series] + [repeat(arg, size) for arg in args]
+            rep_args = zip(*rep_args)
+
+            # call algorithm
+            if pool is None:
+                results = [alg_func(*_args, **kwargs) for _args in rep_args]
+            else:
+                results = pool.map(_call_voxel,
+                                   [(alg_func, _args, kwargs) for _args in rep_args])
+
+            # sort according to position
+            results = [p for pos, p in results]
+            assert size == len(results)
+
+            # reshape to 3D
+            pvalue_arr3d[ys] = np.asarray(results).reshape((-1, nx, nz))
+            tracker.update(size, block.nbytes, ys, pvalue_arr3d[ys])
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
     return pvalue_arr3d
 
 
 def diff_ttest(series, direction='+', n_before=None, n_after=None,
-               phase=1, diff_length=1):
+               phase=1, diff_length=1, use_index=True, backend='auto',
+               progress=None, cancel=None):
     """
     'diff_ttest' algorithm interface
 
     :series: (simucaller.Series object)
+    :direction, n_before, n_after, phase, diff_length: see `_diff_ttest`
+    :use_index: (bool) evaluate from the moment index when series has one
+        (diff_length 1 only).
+    :backend: ('auto'/'numpy'/'numba') see `simucaller.kernels`
+    :progress: (callable/None) progress callback, see `simucaller.engine`
+    :cancel: (simucaller.progress.CancelToken/None)
     """
     assert hasattr(series, 'break_points'),\
         "Please run series.set_break_point firstly"
 
-    pvalue_arr3d = algorithm_interface(_diff_ttest,
-        series, processes=1,
-        break_points=series.break_points,
-        direction='+', n_before=None, n_after=None, phase=0, diff_length=1)
+    pvalue_arr3d = run_algorithm('diff_ttest', series,
+        use_index=use_index, progress=progress, cancel=cancel,
+        direction=direction, n_before=n_before, n_after=n_after,
+        phase=phase, diff_length=diff_length, backend=backend)
 
     return pvalue_arr3d
 
 
-def ttest(series, direction='+'):
+def diff_ttest_phases(series, phases=(1,), directions=('+', '-'),
+                      n_before=None, n_after=None, diff_length=1,
+                      use_index=True, backend='auto', progress=None, cancel=None):
+    """
+    diff_ttest of several post-event phases and directions in one pass
+    over the data, return pvalues in shape (n_phases, n_directions, y, x, z),
+    result[i, j] same to `diff_ttest(series, directions[j], phase=phases[i], ...)`.
+
+    :series: (simucaller.Series object)
+    :phases: (list) phase numbers, see `_diff_ttest`
+    :directions: (list) of '+'/'-'/'~'
+    other arguments same to `diff_ttest`
+    """
+    assert hasattr(series, 'break_points'),\
+        "Please run series.set_break_point firstly"
+
+    return run_algorithm('diff_ttest_phases', series,
+        use_index=use_index, progress=progress, cancel=cancel,
+        phases=list(phases), directions=list(directions),
+        n_before=n_before, n_after=n_after, diff_length=diff_length,
+        backend=backend)
+
+
+def scan_break_points(series, candidates, width=None, direction='+',
+                      n_before=None, n_after=None, block_size=None,
+                      progress=None, cancel=None):
+    """
+    Scan candidate break points with the diff_ttest statistic.
+
+    :series: (simucaller.Series object)
+    :candidates: (iterable) candidate image index numbers when event start.
+    :width: (int) event length (break_end - break_start),
+        default use the length of series.break_points.
+    :direction: ('+'/'-'/'~') used for choose the best break point.
+    :n_before: (int) same to `_diff_ttest`
+    :n_after: (int) same to `_diff_ttest`
+    :block_size: (int/None) how many y slices processed at once,
+        default chosen by the memory budget, see `simucaller.engine`
+    :progress: (callable/None) progress callback, see `simucaller.engine`
+    :cancel: (simucaller.progress.CancelToken/None)
+
+    return (stat_arr4d, best_arr3d) pair:
+        stat_arr4d: (n_candidates, y, x, z) diff_ttest t statistic.
+        best_arr3d: (y, x, z) the best break start of each voxel.
+    """
+    if width is None:
+        assert hasattr(series, 'break_points'),\
+            "Please run series.set_break_point firstly or give the width"
+        width = series.break_points[1] - series.break_points[0]
+    starts = np.asarray(list(candidates), dtype=np.int64)
+    # check ranges before reading
+    _diff_ranges(series.shape[0], starts, starts + width, n_before, n_after)
+
+    stat_arr4d = run_algorithm('scan_break_points', series,
+        block_size=block_size, progress=progress, cancel=cancel,
+        candidates=starts, width=width, n_before=n_before, n_after=n_after)
+
+    if direction == '+':
+        score = stat_arr4d
+    elif direction == '-':
+        score = -stat_arr4d
+    else:
+        score = np.abs(stat_arr4d)
+    score = np.where(np.isnan(score), -np.inf, score)
+    best_arr3d = starts[score.argmax(axis=0)]
+    return stat_arr4d, best_arr3d
+
+
+def ttest(series, direction='+', use_index=True, backend='auto',
+          progress=None, cancel=None):
     """
     ttest algorithm interface
 
     :series: (simucaller.Series object)
+    :use_index: (bool) evaluate from the moment index when series has one.
+    :backend: ('auto'/'numpy'/'numba') see `simucaller.kernels`
+    :progress: (callable/None) progress callback, see `simucaller.engine`
+    :cancel: (simucaller.progress.CancelToken/None)
     """
     assert hasattr(series, 'simu_intervals'),\
         "Please run series.set_sumu_intervals firstly"
 
-    pvalue_arr3d = algorithm_interface(_ttest,
-        series, processes=1,
-        intervals=series.simu_intervals, direction='+')
+    pvalue_arr3d = run_algorithm('ttest', series,
+        use_index=use_index, progress=progress, cancel=cancel,
+        direction=direction, backend=backend)
 
     return pvalue_arr3d
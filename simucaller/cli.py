@@ -1,5 +1,259 @@
+import sys
+import json
+import signal
+from contextlib import contextmanager
+
+from simucaller.series import CACHE
+from simucaller.service import open_series
+from simucaller.progress import CancelToken, Cancelled, print_progress
+from simucaller.helpers import get_logger
+
+log = get_logger(__name__)
+
+
+@contextmanager
+def cancel_on_sigint():
+    """
+    yield a CancelToken, cancelled by Ctrl-C instead of KeyboardInterrupt,
+    the old SIGINT handler restored on exit.
+    """
+    cancel = CancelToken()
+    def on_sigint(signum, frame):
+        sys.stderr.write("\ncancelling, wait for current block ...\n")
+        cancel.cancel()
+    old_handler = signal.signal(signal.SIGINT, on_sigint)
+    try:
+        yield cancel
+    finally:
+        signal.signal(signal.SIGINT, old_handler)
+
+
 class CLI(object):
     """
     command line interface
     """
-    pass
\ No newline at end of file
+    def call_simu(self, hdf5_path, algorithm, name, break_points=None,
+                  intervals=None, direction='+', save=True, force=False,
+                  dataset='arr4d', cachedir=CACHE):
+        """
+        Run simulation region calling on a Series hdf5 file, print progress.
+        Ctrl-C stop the analysis cleanly after the current voxel block.
+
+        :hdf5_path: path to Series hdf5 file.
+        :algorithm: (str) algorithm name, like 'diff_ttest', 'ttest'
+        :name: (str) result name
+        :break_points: (tuple) like (100, 110), needed by diff_ttest
+        :intervals: (list) like [(0, 10), (30, 50)], needed by ttest
+        :direction: ('+'/'-'/'~')
+        :save: (bool) save result to the hdf5 file.
+        :force: (bool) recompute even the same result is saved.
+        :dataset: (str) input dataset, 'arr4d' or a derived one like
+            'derived/smooth_fwhm2' (see `smooth`).
+        :cachedir: path to cache directory.
+        """
+        return self.batch([hdf5_path], algorithm, name,
+                          break_points=break_points, intervals=intervals,
+                          direction=direction, save=save, force=force,
+                          dataset=dataset, cachedir=cachedir)
+
+    def batch(self, hdf5_paths, algorithm, name, break_points=None,
+              intervals=None, direction='+', save=True, force=False,
+              dataset='arr4d', cachedir=CACHE):
+        """
+        Run the same simulation region calling on several Series hdf5 files.
+        Ctrl-C stop the whole batch cleanly after the current voxel block.
+        Files served by `serve` are analysed by the service.
+        return the list of finished files.
+
+        :hdf5_paths: (list) paths to Series hdf5 files.
+        other arguments same to `call_simu`
+        """
+        finished = []
+        with cancel_on_sigint() as cancel:
+            for i, path in enumerate(hdf5_paths):
+                series = open_series(path, cachedir=cachedir)
+                if break_points is not None:
+                    series.set_break_points(tuple(break_points))
+                if intervals is not None:
+                    series.set_simu_intervals([tuple(i) for i in intervals])
+                prefix = "[%d/%d] %s: "%(i + 1, len(hdf5_paths), path)
+                try:
+                    series.call_simu(algorithm, name, force=force,
+                                     direction=direction, dataset=dataset,
+                                     progress=print_progress(prefix=prefix),
+                                     cancel=cancel)
+                except Cancelled:
+                    sys.stderr.write("cancelled, %d/%d files finished\n"%(
+                        len(finished), len(hdf5_paths)))
+                    break
+                if save:
+                    series.save_simu_result(algorithm, name)
+                    series.save_attr()
+                finished.append(path)
+        return finished
+
+    def prepare(self, hdf5_path, dataset='arr4d', cachedir=CACHE):
+        """
+        Hash the data once and store its fingerprint in the Series hdf5 file,
+        run before handing out `shard` jobs, see `simucaller.shard`.
+
+        :hdf5_path: path to Series hdf5 file.
+        :dataset: (str) input dataset of the shards.
+        :cachedir: path to cache directory.
+        """
+        from simucaller.shard import prepare_shards
+        series = open_series(hdf5_path, cachedir=cachedir)
+        return prepare_shards(series, dataset)
+
+    def shard(self, hdf5_path, algorithm, name, shard, n_shards, out_dir,
+              break_points=None, intervals=None, direction='+',
+              data_fingerprint=None, cachedir=CACHE):
+        """
+        Run one shard (y slab) of a simulation region calling,
+        write its shard file to out_dir, see `simucaller.shard`.
+        Run `prepare` once first, then jobs of all shards are independent,
+        run them anywhere the files are reachable, then `merge`.
+
+        :hdf5_path: path to Series hdf5 file, opened read-only.
+        :shard: (int) shard number, in [0, n_shards)
+        :n_shards: (int) number of shards.
+        :out_dir: path to directory of shard files.
+        :data_fingerprint: (str/None) printed by `prepare`,
+            default the one `prepare` stored in the file.
+        other arguments same to `call_simu`
+        """
+        from simucaller.shard import run_shard
+        series = open_series(hdf5_path, cachedir=cachedir, mode='r')
+        if break_points is not None:
+            series.set_break_points(tuple(break_points))
+        if intervals is not None:
+            series.set_simu_intervals([tuple(i) for i in intervals])
+        path = run_shard(series, algorithm, name, shard, n_shards, out_dir,
+                         data_fingerprint=data_fingerprint, direction=direction,
+                         progress=print_progress(prefix="shard %d: "%shard))
+        sys.stderr.write("shard file written to %s\n"%path)
+        return path
+
+    def merge(self, hdf5_path, algorithm, name, out_dir, cachedir=CACHE):
+        """
+        Validate and merge shard files written by `shard`,
+        save the result to the Series hdf5 file.
+
+        :hdf5_path: path to Series hdf5 file.
+        :algorithm: (str) algorithm name
+        :name: (str) result name
+        :out_dir: path to directory of shard files.
+        :cachedir: path to cache directory.
+        """
+        from simucaller.shard import merge_shards
+        series = open_series(hdf5_path, cachedir=cachedir)
+        merge_shards(series, algorithm, name, out_dir)
+        return "%s/%s"%(algorithm, name)
+
+    def smooth(self, hdf5_path, fwhm, name=None, processes=None, cachedir=CACHE):
+        """
+        Gaussian spatial smoothing of a Series hdf5 file, written to a
+        derived dataset, analyse it by `call_simu --dataset`.
+
+        :hdf5_path: path to Series hdf5 file.
+        :fwhm: (float/tuple) FWHM of all axes or (y, x, z) axes, unit: voxel
+        :name: (str) derived dataset name, default 'smooth_fwhm<fwhm>'
+        :processes: (int) number of worker processes, default serial.
+        :cachedir: path to cache directory.
+        """
+        series = open_series(hdf5_path, cachedir=cachedir)
+        with cancel_on_sigint() as cancel:
+            path = series.smooth(fwhm, name=name, processes=processes,
+                                 progress=print_progress(prefix="smooth: "),
+                                 cancel=cancel)
+        sys.stderr.write("smoothed series written to %s\n"%path)
+        return path
+
+    def results(self, hdf5_path, cachedir=CACHE):
+        """
+        List saved results of a Series hdf5 file with their parameters.
+
+        :hdf5_path: path to Series hdf5 file.
+        :cachedir: path to cache directory.
+        """
+        series = open_series(hdf5_path, cachedir=cachedir)
+        for res, params in series.list_simu_result(params=True):
+            print("%s\t%s"%(res, json.dumps(params, sort_keys=True)
+                             if params is not None else "-"))
+
+    def serve(self, hdf5_path, address=None, cachedir=CACHE):
+        """
+        Serve a Series hdf5 file from shared memory, until Ctrl-C.
+        Viewers and `call_simu`/`batch` jobs on this workstation open the
+        served file through the service, sharing its data and analysis cache.
+
+        :hdf5_path: path to Series hdf5 file.
+        :address: (str) unix socket path or pipe name,
+            default derived from hdf5_path.
+        :cachedir: path to cache directory.
+        """
+        from simucaller.service import SeriesService
+        service = SeriesService(hdf5_path, address, cachedir=cachedir)
+        sys.stderr.write("serving %s at %s, Ctrl-C to stop\n"%(
+            hdf5_path, service.address))
+        try:
+            service.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            service.close()
+
+    def append(self, hdf5_path, image_dir, cachedir=CACHE):
+        """
+        Append new hdr images in image_dir to a Series hdf5 file,
+        images already ingested are skipped.
+
+        :hdf5_path: path to Series hdf5 file.
+        :image_dir: path to directory which store hdr image files.
+        :cachedir: path to cache directory.
+        """
+        series = open_series(hdf5_path, cachedir=cachedir, served=False)
+        n = series.append_images(image_dir)
+        sys.stderr.write("%d images appended, %d images in total\n"%(
+            n, series.n_images))
+        return n
+
+    def watch(self, hdf5_path, image_dir, algorithm='ttest', name='online',
+              intervals=None, break_points=None, direction='+',
+              poll_interval=1.0, timeout=None, overwrite=True, cachedir=CACHE):
+        """
+        Watch image_dir during a live experiment, append new hdr images to the
+        Series and print the updated result after each volume.
+        Ctrl-C (or no new image in timeout seconds) stop watching,
+        the last pvalue map saved as result <algorithm>/<name>.
+
+        :hdf5_path: path to Series hdf5 file.
+        :image_dir: path to directory which store hdr image files.
+        :algorithm: ('ttest'/'diff_ttest')
+        :name: (str) result name
+        :intervals: (list) like [(0, 10), (30, 50)], for ttest,
+            may extend beyond the current end of series.
+        :break_points: (tuple) like (100, 110), for diff_ttest
+        :direction: ('+'/'-'/'~')
+        :poll_interval: (float) unit: 1 second
+        :timeout: (float/None) unit: 1 second
+        :overwrite: (bool) replace the result saved with the same name,
+            e.g. by a previous session.
+        :cachedir: path to cache directory.
+        """
+        from simucaller.online import OnlineAnalysis
+        series = open_series(hdf5_path, cachedir=cachedir, served=False)
+        online = OnlineAnalysis(series, algorithm, direction,
+            intervals=[tuple(i) for i in intervals] if intervals else None,
+            break_points=tuple(break_points) if break_points else None)
+        def report(pvalue_arr3d, t):
+            sys.stderr.write("T %d: %d voxels p < 0.05, min p %.3g\n"%(
+                t, (pvalue_arr3d < 0.05).sum(), pvalue_arr3d.min()))
+        online.subscribe(report)
+        with cancel_on_sigint() as cancel:
+            online.watch(image_dir, poll_interval, cancel, timeout)
+        if not hasattr(series, 'simu_results'):
+            series.simu_results = {}
+        series.simu_results.setdefault(algorithm, {})[name] = online.pvalue()
+        series.save_simu_result(algorithm, name, overwrite=overwrite)
+        return series.n_images
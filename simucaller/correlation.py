@@ -0,0 +1,97 @@
+"""
+Seed-based correlation map.
+
+Pearson correlation between the mean time series of seed voxels
+(selected points or an ROI) and every voxel. The seed is standardized once
+(zero mean, unit norm), so each block costs one matrix-vector product
+plus the column norms.
+"""
+
+from collections import OrderedDict
+
+import numpy as np
+
+from simucaller.helpers import get_logger
+from simucaller.registry import register
+from simucaller.series import read_region
+from simucaller.engine import run_algorithm
+from simucaller.call_simu import _column_moments, _directional_pvalue
+
+log = get_logger(__name__)
+
+
+def seed_series(series, mask):
+    """
+    mean time series of voxels in mask, over the whole time axis
+    (same as the engines, `Series.set_range` not applied).
+    """
+    mask = np.asarray(mask, dtype=bool)
+    assert mask.any(), "empty seed mask"
+    arr = read_region(series.h5dict['arr4d'], mask)
+    return arr.mean(axis=1, dtype=np.float64)
+
+
+def standardize(seed):
+    """ seed time series with zero mean and unit norm, in float64. """
+    seed = np.asarray(seed, dtype=np.float64)
+    seed = seed - seed.mean()
+    norm = np.sqrt(seed.dot(seed))
+    assert norm > 0, "seed time series is constant"
+    return seed / norm
+
+
+@register('seed_correlation',
+          params=OrderedDict([('seed', None)]),
+          memory_factor=3)
+def _seed_correlation_block(arr2d, seed):
+    """
+    Block kernel of seed_correlation, Pearson correlation between
+    the seed and every column of arr2d (t, n_voxels), in shape (n_voxels,).
+
+    :seed: (numpy array) seed time series, standardized by `standardize`.
+    """
+    assert seed is not None, "seed_correlation need the seed time series"
+    # seed sums to zero, so seed . (y - mean) == seed . y
+    cov = seed.dot(arr2d)
+    _, dev = _column_moments(arr2d)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return cov / np.sqrt(dev)
+
+
+def correlation_pvalue(r, n, direction='+'):
+    """
+    pvalue of Pearson correlation r of n samples, by t = r sqrt((n-2)/(1-r^2)).
+
+    :direction: ('+'/'-'/'~') '+' for positive correlation.
+    """
+    df = n - 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = r * np.sqrt(df / np.maximum(1 - r ** 2, 0))
+    return _directional_pvalue(t, df, direction)
+
+
+def seed_correlation(series, mask, name=None, direction='+', overwrite=False,
+                     **kwargs):
+    """
+    Seed-based correlation map, return (r_arr3d, pvalue_arr3d) pair.
+
+    :series: (simucaller.Series object)
+    :mask: (numpy array) (y, x, z) bool mask of seed voxels.
+    :name: (str/None) if given, store the pvalue map as result
+        seed_correlation/<name> and the correlation as seed_correlation/<name>_r
+    :direction: ('+'/'-'/'~') direction of pvalue.
+    :overwrite: (bool) replace saved results of the same name.
+    :kwargs: engine options, see `simucaller.engine.run_algorithm`
+    """
+    r_arr3d = run_algorithm('seed_correlation', series,
+                            seed=standardize(seed_series(series, mask)), **kwargs)
+    pvalue_arr3d = correlation_pvalue(r_arr3d, int(series.shape[0]), direction)
+    if name is not None:
+        if not hasattr(series, 'simu_results'):
+            series.simu_results = {}
+        results = series.simu_results.setdefault('seed_correlation', {})
+        results[name] = pvalue_arr3d
+        results[name + '_r'] = r_arr3d
+        series.save_simu_result('seed_correlation', name, overwrite)
+        series.save_simu_result('seed_correlation', name + '_r', overwrite)
+    return r_arr3d, pvalue_arr3d
@@ -0,0 +1,351 @@
+"""
+Execution engines of registered algorithms (see `simucaller.registry`).
+
+* serial: voxel blocks evaluated one by one in this process.
+* process: voxel blocks evaluated by a pool of worker processes.
+* streaming: `stream_algorithm` yield results block by block,
+    without allocate the whole result volume. `run_algorithm` writes
+    the blocks to a dataset in the series's hdf5 file instead of memory
+    when the result volume alone exceed the memory budget.
+* masked: with `mask`, only voxels inside the mask are evaluated,
+    others filled with NaN.
+
+Series's 4D array always read block by block along the y axis,
+when block_size not given, DEFAULT_BLOCK_SIZE y slices per block (fewer for
+the process engine, at least 2 blocks per process), shrunk to fit the memory
+budget, so progress, cancel and partial results are reported block by block.
+
+Precision: `dtype` set the dtype of input blocks and the result,
+kernels keep float64 accumulation for variance-sensitive reductions.
+"""
+
+import sys
+import multiprocessing as mp
+from itertools import islice
+
+if sys.version_info <= (3, 0):
+    from itertools import izip as zip
+
+import numpy as np
+
+from simucaller.helpers import get_logger
+from simucaller.progress import ProgressTracker
+from simucaller.registry import Algorithm, get_algorithm
+
+log = get_logger(__name__)
+
+ENGINES = ('serial', 'process')
+
+# default memory budget of one run, unit: byte
+MEMORY_BUDGET = 1024 ** 3
+
+# default y slices per block, the memory budget only shrink it
+DEFAULT_BLOCK_SIZE = 8
+
+# hdf5 group of results written block by block, see `run_algorithm`
+SCRATCH = 'scratch'
+
+
+def iter_blocks(series, block_size=8, tracker=None, y_range=None, dataset='arr4d'):
+    """
+    Read series's 4D array block by block along the y axis,
+    yield (y_slice, block) pairs, block in shape (t, block_size, x, z).
+
+    :series: `simucaller.series.Series` object.
+    :block_size: (int) how many y slices read at once.
+    :tracker: (simucaller.progress.ProgressTracker/None)
+        cancel token checked before read each block.
+    :y_range: (tuple/None) (y_start, y_stop) only read this slab, default all.
+    :dataset: (str) path of the 4D dataset in series.h5dict,
+        'arr4d' or a derived one (e.g. by `simucaller.smoothing`).
+    """
+    y_start, y_stop = y_range or (0, int(series.shape[1]))
+    dset = series.h5dict[dataset]
+    shape = tuple(int(n) for n in series.shape)
+    assert tuple(dset.shape) == shape, \
+        "dataset {} in shape {} not match the series {}, please recreate it".format(
+            dataset, tuple(dset.shape), shape)
+    for y0 in range(y_start, y_stop, block_size):
+        if tracker is not None:
+            tracker.check()
+        ys = slice(y0, min(y0 + block_size, y_stop))
+        yield ys, dset[:, ys, :, :]
+
+
+def _report_whole(result, progress=None):
+    """
+    report the whole volume as one finished block,
+    for results evaluated at once (e.g. from moment index).
+    """
+    tracker = ProgressTracker(result.size, progress)
+    tracker.update(result.size, 0, slice(None), result)
+
+
+def _call_kernel(args):
+    """ evaluate kernel on one block, skip empty blocks (masked out). """
+    kernel, arr2d, params, out_shape = args
+    if arr2d.shape[1] == 0:
+        return np.empty(out_shape + (0,))
+    return kernel(arr2d, **params)
+
+
+def _iter_inputs(series, block_size, mask, tracker, dtype=None, y_range=None,
+                 dataset='arr4d'):
+    """
+    yield (y_slice, n_bytes, arr2d, selected) of each block,
+    arr2d in shape (t, n_voxels), selected is the flat mask of block or None.
+    """
+    nt = series.shape[0]
+    for ys, block in iter_blocks(series, block_size, tracker, y_range, dataset):
+        arr2d = block.reshape(nt, -1)
+        if dtype is not None:
+            arr2d = arr2d.astype(dtype, copy=False)
+        selected = None
+        if mask is not None:
+            selected = mask[ys].reshape(-1)
+            arr2d = arr2d[:, selected]
+        yield ys, block.nbytes, arr2d, selected
+
+
+def _map_serial(kernel, params, out_shape, inputs):
+    for item in inputs:
+        yield item, _call_kernel((kernel, item[2], params, out_shape))
+
+
+def _map_process(kernel, params, out_shape, inputs, processes=None):
+    """
+    evaluate blocks in a process pool, at most 2 blocks per process
+    read ahead, so the memory usage is bounded.
+    """
+    processes = processes or mp.cpu_count()
+    pool = mp.Pool(processes=processes)
+    log.info("{} processes spawned.".format(processes))
+    try:
+        while True:
+            chunk = list(islice(inputs, 2 * processes))
+            if not chunk:
+                break
+            results = pool.map(_call_kernel,
+                [(kernel, item[2], params, out_shape) for item in chunk])
+            for item, result in zip(chunk, results):
+                yield item, result
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _as_algorithm(algorithm):
+    if isinstance(algorithm, Algorithm):
+        return algorithm
+    return get_algorithm(algorithm)
+
+
+def _result_dtype(dtype):
+    return np.dtype(np.float64 if dtype is None else dtype)
+
+
+def _memory_estimate(alg, params, series, dtype, engine, processes,
+                     dataset='arr4d'):
+    """ see `estimate_memory`, return (per_y, fixed, n_inflight) """
+    nt, ny, nx, nz = series.shape
+    in_itemsize = np.dtype(series.h5dict[dataset].dtype).itemsize
+    itemsize = in_itemsize if dtype is None else np.dtype(dtype).itemsize
+    n_out = int(np.prod(alg.output_shape(params)))
+    # bytes per y slice of one block in flight:
+    #   read block, cast block, kernel temporaries, block result
+    per_y = nx * nz * (nt * (in_itemsize + itemsize * (1 + alg.memory_factor)) +
+                       n_out * 8)
+    # whole result volume
+    fixed = n_out * ny * nx * nz * _result_dtype(dtype).itemsize
+    n_inflight = 2 * (processes or mp.cpu_count()) if engine == 'process' else 1
+    return per_y, fixed, n_inflight
+
+
+def estimate_memory(algorithm, series, block_size=None, dtype=None,
+                    engine='serial', processes=None,
+                    memory_budget=None, dataset='arr4d', **kwargs):
+    """
+    Estimate peak memory of a run, return dict with keys (unit: byte):
+
+    * block_size: y slices per block, if not given DEFAULT_BLOCK_SIZE
+        (at most ny / blocks in flight), shrunk to fit the budget.
+    * block: peak memory of blocks in flight.
+    * result: memory of the result volume.
+    * peak: block + result.
+
+    arguments same to `run_algorithm`.
+    """
+    alg = _as_algorithm(algorithm)
+    params = alg.bind(series, **kwargs)
+    per_y, fixed, n_inflight = _memory_estimate(
+        alg, params, series, dtype, engine, processes, dataset)
+    if block_size is None:
+        budget = MEMORY_BUDGET if memory_budget is None else memory_budget
+        ny = int(series.shape[1])
+        fit = max(1, (budget - fixed) // (per_y * n_inflight))
+        # keep every worker busy: at least one block per block in flight
+        spread = max(1, -(-ny // n_inflight))
+        block_size = int(min(DEFAULT_BLOCK_SIZE, spread, fit))
+    block = int(per_y * block_size * n_inflight)
+    return {'block_size': block_size, 'block': block,
+            'result': int(fixed), 'peak': block + int(fixed)}
+
+
+def _plan(alg, params, series, block_size, dtype, engine, processes,
+          memory_budget, streaming=False, dataset='arr4d'):
+    """
+    log the memory estimate before a run, and choose the block size.
+    """
+    estimate = estimate_memory(alg, series, block_size, dtype, engine,
+                               processes, memory_budget, dataset, **params)
+    if streaming: # result volume not allocated
+        estimate['peak'] -= estimate['result']
+    budget = MEMORY_BUDGET if memory_budget is None else memory_budget
+    log.info("{}: block size {}, estimated peak memory {:.1f} MB".format(
+        alg.name, estimate['block_size'], estimate['peak'] / 1024.0 ** 2))
+    if estimate['peak'] > budget:
+        log.warning("estimated peak memory {:.1f} MB exceed the budget {:.1f} MB,"
+                    " use smaller block size or `stream_algorithm`".format(
+                        estimate['peak'] / 1024.0 ** 2, budget / 1024.0 ** 2))
+    return estimate['block_size']
+
+
+def stream_algorithm(algorithm, series, engine='serial', processes=None,
+                     mask=None, block_size=None, dtype=None, memory_budget=None,
+                     progress=None, cancel=None, y_range=None, dataset='arr4d',
+                     **kwargs):
+    """
+    Evaluate algorithm block by block, yield (y_slice, result_block) pairs,
+    result_block in shape output_shape + (n_y, x, z).
+
+    :algorithm: (str/simucaller.registry.Algorithm) registered algorithm.
+    :series: `simucaller.series.Series` object.
+    :engine: ('serial'/'process')
+    :processes: (int/None) number of worker processes of 'process' engine,
+        default use all cpu cores.
+    :mask: (numpy array/None) (y, x, z) bool mask, only evaluate voxels inside.
+    :block_size: (int/None) how many y slices read and processed at once,
+        default DEFAULT_BLOCK_SIZE shrunk to fit the memory budget.
+    :dtype: (numpy dtype/None) dtype of input blocks and results,
+        default input as stored, result in float64.
+    :memory_budget: (int/None) unit: byte, default `engine.MEMORY_BUDGET`
+    :progress: (callable/None) called after each voxel block finished,
+        with a `simucaller.progress.Progress` object.
+    :cancel: (simucaller.progress.CancelToken/None) checked between blocks,
+        raise `simucaller.progress.Cancelled` when cancelled.
+    :y_range: (tuple/None) (y_start, y_stop) only evaluate this slab,
+        default all, see `simucaller.shard`.
+    :dataset: (str) input 4D dataset, 'arr4d' or a derived one
+        (e.g. smoothed by `simucaller.smoothing`).
+    :kwargs: parameters of the algorithm.
+    """
+    alg = _as_algorithm(algorithm)
+    params = alg.bind(series, **kwargs)
+    out_shape = alg.output_shape(params)
+    result_dtype = _result_dtype(dtype)
+    if block_size is None:
+        block_size = _plan(alg, params, series, block_size, dtype, engine,
+                           processes, memory_budget, True, dataset)
+    _, ny, nx, nz = series.shape
+    y_start, y_stop = y_range or (0, int(ny))
+    if mask is not None:
+        mask = np.asarray(mask, dtype=bool)
+        assert mask.shape == (ny, nx, nz), "mask shape not match the series"
+        n_total = int(mask[y_start:y_stop].sum())
+    else:
+        n_total = (y_stop - y_start) * nx * nz
+    tracker = ProgressTracker(n_total, progress, cancel)
+
+    inputs = _iter_inputs(series, block_size, mask, tracker, dtype, y_range,
+                          dataset)
+    if engine == 'serial':
+        results = _map_serial(alg.kernel, params, out_shape, inputs)
+    elif engine == 'process':
+        results = _map_process(alg.kernel, params, out_shape, inputs, processes)
+    else:
+        raise ValueError("engine should be one of {}".format(ENGINES))
+
+    for (ys, n_bytes, arr2d, selected), result in results:
+        result = np.asarray(result, dtype=result_dtype).reshape(out_shape + (-1,))
+        n_y = ys.stop - ys.start
+        if selected is not None:
+            block = np.full(out_shape + (selected.size,), np.nan, dtype=result_dtype)
+            block[..., selected] = result
+            result = block
+        result = result.reshape(out_shape + (n_y, nx, nz))
+        tracker.update(arr2d.shape[1], n_bytes, ys, result)
+        yield ys, result
+
+
+def _scratch_dataset(series, name, shape, dtype):
+    """
+    create a NaN filled dataset under SCRATCH in series's hdf5 file,
+    None if the file is not writable here (read only, or served).
+    """
+    h5dict = series.h5dict
+    if getattr(h5dict, 'mode', None) != 'r+':
+        return None
+    n = 0
+    while "%s/%s_%d"%(SCRATCH, name, n) in h5dict:
+        n += 1
+    path = "%s/%s_%d"%(SCRATCH, name, n)
+    # one chunk per y slice, blocks written without read back
+    chunks = shape[:-3] + (1,) + shape[-2:]
+    return h5dict.create_dataset(path, shape=shape, dtype=dtype, chunks=chunks,
+                                 fillvalue=np.nan)
+
+
+def run_algorithm(algorithm, series, engine='serial', processes=None,
+                  mask=None, block_size=None, dtype=None, memory_budget=None,
+                  use_index=True, progress=None, cancel=None, dataset='arr4d',
+                  **kwargs):
+    """
+    Evaluate algorithm on series, return result in shape output_shape + (y, x, z).
+
+    When the result volume alone exceed the memory budget, it is written to
+    a dataset under SCRATCH in series's hdf5 file block by block, and the
+    h5py dataset is returned, `Series.save_simu_result` moves it in place.
+
+    :use_index: (bool) use the algorithm's index fast path if it has one,
+        (e.g. evaluate from the moment index of arr4d),
+        ignored when masked or input from a derived dataset.
+    other arguments same to `stream_algorithm`.
+    """
+    alg = _as_algorithm(algorithm)
+    params = alg.bind(series, **kwargs)
+
+    result_dtype = _result_dtype(dtype)
+
+    if use_index and mask is None and dataset == 'arr4d' and \
+            alg.index_func is not None:
+        result = alg.index_func(series, params)
+        if result is not None:
+            result = result.astype(result_dtype, copy=False)
+            _report_whole(result, progress)
+            return result
+
+    _, ny, nx, nz = series.shape
+    shape = alg.output_shape(params) + (int(ny), int(nx), int(nz))
+    budget = MEMORY_BUDGET if memory_budget is None else memory_budget
+    result = None
+    if int(np.prod(shape)) * result_dtype.itemsize > budget:
+        result = _scratch_dataset(series, alg.name, shape, result_dtype)
+        if result is not None:
+            log.info("{}: result volume exceed the memory budget, "
+                     "write it to {} block by block".format(alg.name, result.name))
+    block_size = _plan(alg, params, series, block_size, dtype, engine,
+                       processes, memory_budget, result is not None, dataset)
+    if result is None:
+        result = np.full(shape, np.nan, dtype=result_dtype)
+    try:
+        for ys, block in stream_algorithm(alg, series, engine, processes, mask,
+                                          block_size, dtype, memory_budget,
+                                          progress, cancel, dataset=dataset,
+                                          **params):
+            result[..., ys, :, :] = block
+    except BaseException:
+        # never leave a partial result in the file
+        if not isinstance(result, np.ndarray):
+            del series.h5dict[result.name]
+        raise
+    return result
@@ -0,0 +1,137 @@
+"""
+Content-addressed fingerprints of simulation region call results.
+
+A result's fingerprint is the sha1 of:
+
+* algorithm name
+* parameters bound by the registry (defaults and series attributes included)
+* engine options change the result (`RESULT_OPTIONS`)
+* the data fingerprint of the input dataset
+
+The data fingerprint is a hash chain over the frames of a 4D dataset,
+stored in the dataset's attributes, so it is computed once,
+and only new frames are hashed after images appended.
+
+Parameters are stored in canonical JSON (see `canonical`) beside the
+fingerprint, in the attributes of each saved result.
+"""
+
+import json
+import hashlib
+
+import numpy as np
+
+from simucaller.helpers import get_logger
+from simucaller.registry import get_algorithm
+
+log = get_logger(__name__)
+
+DATA_ATTR = 'fingerprint'
+DATA_N_ATTR = 'fingerprint_n_images'
+
+# engine options change the result, others (engine, block_size ...) do not
+RESULT_OPTIONS = ('mask', 'dtype')
+
+# arrays larger than this stored as their hash instead of values
+MAX_INLINE = 64
+
+
+def _sha1(data):
+    return hashlib.sha1(data).hexdigest()
+
+
+def canonical(value):
+    """
+    JSON serializable canonical form of a parameter value,
+    equal values (list or numpy array, tuple or list) get the same form.
+    numeric arrays larger than MAX_INLINE replaced by
+    {'sha1': ..., 'shape': ..., 'dtype': ...}.
+    """
+    if isinstance(value, (list, tuple, range)):
+        arr = np.asarray(value) if len(value) > 0 else None
+        if arr is not None and arr.dtype.kind in 'biuf':
+            value = arr
+        else:
+            return [canonical(v) for v in value]
+    if isinstance(value, np.ndarray):
+        if value.size > MAX_INLINE:
+            arr = np.ascontiguousarray(value)
+            return {'sha1': _sha1(arr.tobytes()), 'shape': list(arr.shape),
+                    'dtype': arr.dtype.str}
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, dict):
+        return {str(k): canonical(v) for k, v in value.items()}
+    if isinstance(value, np.dtype):
+        return value.str
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    return repr(value)
+
+
+def data_fingerprint(dset, block_size=16):
+    """
+    hash chain over frames of the 4D dataset dset (t, y, x, z),
+    stored in dset's attributes, extended when frames appended.
+
+    :dset: (h5py dataset)
+    :block_size: (int) how many frames read at once.
+    """
+    nt = int(dset.shape[0])
+    fingerprint = dset.attrs.get(DATA_ATTR)
+    n_done = int(dset.attrs.get(DATA_N_ATTR, 0))
+    if fingerprint is None or n_done > nt:
+        head = repr((tuple(int(n) for n in dset.shape[1:]), np.dtype(dset.dtype).str))
+        fingerprint, n_done = _sha1(head.encode('utf-8')), 0
+    if n_done == nt:
+        return fingerprint
+    log.info("hashing frames {}-{} of {}".format(n_done, nt, dset.name))
+    for t0 in range(n_done, nt, block_size):
+        for frame in dset[t0:t0 + block_size]:
+            frame = np.ascontiguousarray(frame)
+            fingerprint = _sha1(fingerprint.encode('utf-8') + frame.tobytes())
+    try:
+        dset.attrs[DATA_ATTR] = fingerprint
+        dset.attrs[DATA_N_ATTR] = nt
+    except (IOError, OSError):
+        log.warning("file opened read-only, data fingerprint not stored")
+    return fingerprint
+
+
+def stored_data_fingerprint(dset):
+    """
+    data fingerprint stored in dset's attributes if it covers all frames,
+    else None, no frame read.
+
+    :dset: (h5py dataset)
+    """
+    attrs = getattr(dset, 'attrs', {})
+    if int(attrs.get(DATA_N_ATTR, -1)) != int(dset.shape[0]):
+        return None
+    return attrs.get(DATA_ATTR)
+
+
+def result_fingerprint(series, algorithm, data_fingerprint=None, **kwargs):
+    """
+    fingerprint of `series.call_simu(algorithm, name, **kwargs)`,
+    return (params_json, fingerprint) pair.
+
+    :series: (simucaller.Series object)
+    :algorithm: (str) registered algorithm name.
+    :data_fingerprint: (str/None) fingerprint of the input dataset if known,
+        default `series.data_fingerprint`.
+    :kwargs: algorithm parameters and engine options.
+    """
+    alg = get_algorithm(algorithm)
+    params = {k: v for k, v in kwargs.items() if k in alg.params or k in alg.series_params}
+    options = {k: kwargs[k] for k in RESULT_OPTIONS if kwargs.get(k) is not None}
+    if 'dtype' in options:
+        options['dtype'] = np.dtype(options['dtype'])
+    if 'mask' in options:
+        options['mask'] = np.asarray(options['mask'], dtype=bool)
+    bound = alg.bind(series, **params)
+    params_json = json.dumps(canonical(dict(bound, **options)), sort_keys=True)
+    data = data_fingerprint or series.data_fingerprint(kwargs.get('dataset') or 'arr4d')
+    content = json.dumps([algorithm, params_json, data])
+    return params_json, _sha1(content.encode('utf-8'))
@@ -0,0 +1,179 @@
+"""
+General linear model (GLM) across all voxels.
+
+Design matrix columns:
+    task: boxcar of simulation intervals, optionally convolved with the canonical HRF.
+    nuisance: user given regressors, like motion parameters.
+    drift: polynomial drift, order 0 is the intercept.
+
+Ordinary least squares solved for every voxel of a block at once:
+the pseudo-inverse of the design matrix computed once,
+betas are one matrix product per block.
+
+Results stored in `simulation_region_call/glm` by `glm(series, name=...)`:
+    <name>_beta_<regressor>, <name>_t<k>, <name>_p<k> (k-th contrast)
+"""
+
+from collections import OrderedDict
+
+import numpy as np
+from scipy import stats
+
+from simucaller.helpers import get_logger
+from simucaller.registry import register
+from simucaller.engine import run_algorithm
+from simucaller.call_simu import _directional_pvalue
+
+log = get_logger(__name__)
+
+
+def canonical_hrf(time_interval, length=32.0):
+    """
+    SPM canonical double-gamma haemodynamic response function,
+    sampled every time_interval seconds, normalized to unit sum.
+
+    :time_interval: time interval between two images, unit: 1 second
+    :length: (float) HRF length, unit: 1 second
+    """
+    t = np.arange(0, length, time_interval)
+    hrf = stats.gamma.pdf(t, 6) - stats.gamma.pdf(t, 16) / 6.0
+    return hrf / hrf.sum()
+
+
+def design_matrix(n_images, intervals, time_interval=None, hrf=False,
+                  nuisance=None, drift=1):
+    """
+    Build the design matrix, return (design, names) pair,
+    design in shape (n_images, n_regressors).
+
+    :n_images: (int) length of time series
+    :intervals: (list) simulation intervals, like: [(0, 10), (30, 50)]
+    :time_interval: time interval between two images, unit: 1 second,
+        needed by the HRF.
+    :hrf: (bool) convolve the boxcar with the canonical HRF.
+    :nuisance: (numpy array/None) nuisance regressors in shape (n_images, k).
+    :drift: (int) order of polynomial drift, 0 for intercept only.
+    """
+    boxcar = np.zeros(n_images)
+    for s, e in intervals:
+        boxcar[s:e] = 1
+    if hrf:
+        assert time_interval, "HRF convolution need the time_interval"
+        boxcar = np.convolve(boxcar, canonical_hrf(time_interval))[:n_images]
+    columns, names = [boxcar], ['task']
+
+    if nuisance is not None:
+        nuisance = np.asarray(nuisance, dtype=np.float64).reshape(n_images, -1)
+        for i in range(nuisance.shape[1]):
+            columns.append(nuisance[:, i])
+            names.append('nuisance%d'%i)
+
+    x = np.linspace(-1, 1, n_images)
+    for order in range(drift + 1):
+        columns.append(x ** order)
+        names.append('drift%d'%order)
+    return np.column_stack(columns), names
+
+
+def _contrast_matrix(contrasts, n_regressors):
+    """
+    contrasts to (n_contrasts, n_regressors) array,
+    shorter contrast vectors padded with zeros, default test the first regressor.
+    """
+    if contrasts is None:
+        contrasts = [[1]]
+    contrasts = [list(c) + [0] * (n_regressors - len(c)) for c in contrasts]
+    return np.asarray(contrasts, dtype=np.float64)
+
+
+def _glm_output_shape(params):
+    n_regressors = np.shape(params['design'])[1]
+    n_contrasts = len(_contrast_matrix(params['contrasts'], n_regressors))
+    return (n_regressors + 2 * n_contrasts,)
+
+
+@register('glm',
+          params=OrderedDict([('design', None), ('pinv', None), ('rank', None),
+                              ('contrasts', None), ('direction', '+')]),
+          output_shape=_glm_output_shape, memory_factor=5)
+def _glm_block(arr2d, design, pinv=None, rank=None, contrasts=None,
+               direction='+'):
+    """
+    Block kernel of glm, fit the design to every column of arr2d (t, n_voxels).
+    return stacked [betas, t statistics, pvalues]
+    in shape (n_regressors + 2 * n_contrasts, n_voxels).
+
+    :design: (numpy array) design matrix in shape (t, n_regressors)
+    :pinv: (numpy array/None) pseudo-inverse of design, computed if not given.
+    :rank: (int/None) rank of design, computed if not given.
+    :contrasts: (list) contrast vectors, default test the first regressor.
+    :direction: ('+'/'-'/'~') direction of contrast t-tests.
+    """
+    assert design is not None, "glm need the design matrix"
+    design = np.asarray(design, dtype=np.float64)
+    if pinv is None:
+        pinv = np.linalg.pinv(design)
+    if rank is None:
+        rank = np.linalg.matrix_rank(design)
+    c = _contrast_matrix(contrasts, design.shape[1])
+
+    Y = arr2d.astype(np.float64)
+    beta = pinv.dot(Y)
+    resid = Y - design.dot(beta)
+    np.square(resid, out=resid)
+    df = design.shape[0] - rank
+    sigma2 = resid.sum(axis=0) / df
+    # var(c.beta) = c (X'X)^-1 c' sigma2, (X'X)^-1 = pinv pinv'
+    c_var = np.einsum('ij,jk,ik->i', c, pinv.dot(pinv.T), c)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = c.dot(beta) / np.sqrt(c_var[:, None] * sigma2)
+    pvalue = _directional_pvalue(t, df, direction)
+    return np.concatenate([beta, t, pvalue])
+
+
+def glm(series, name=None, intervals=None, hrf=False, nuisance=None, drift=1,
+        contrasts=None, direction='+', overwrite=False, **kwargs):
+    """
+    GLM algorithm interface, return dict with keys:
+    'beta' (n_regressors, y, x, z), 't' and 'p' (n_contrasts, y, x, z), 'regressors'.
+
+    :series: (simucaller.Series object)
+    :name: (str/None) if given, store volumes in series.simu_results['glm']
+        and the hdf5 file, see module doc.
+    :intervals: (list) default series.simu_intervals
+    :hrf, nuisance, drift: see `design_matrix`
+    :contrasts: (list) contrast vectors, default test the task regressor.
+    :direction: ('+'/'-'/'~')
+    :overwrite: (bool) replace saved results of the same name.
+    :kwargs: engine options, see `simucaller.engine.run_algorithm`
+    """
+    if intervals is None:
+        assert hasattr(series, 'simu_intervals'),\
+            "Please run series.set_sumu_intervals firstly"
+        intervals = series.simu_intervals
+    design, names = design_matrix(int(series.shape[0]), intervals,
+                                  getattr(series, 'time_interval', None),
+                                  hrf, nuisance, drift)
+    # fixed for all voxel blocks, computed once
+    pinv = np.linalg.pinv(design)
+    rank = int(np.linalg.matrix_rank(design))
+    n_contrasts = len(_contrast_matrix(contrasts, len(names)))
+    stacked = run_algorithm('glm', series, design=design, pinv=pinv, rank=rank,
+                            contrasts=contrasts, direction=direction, **kwargs)
+    n = len(names)
+    result = {'beta': stacked[:n], 't': stacked[n:n + n_contrasts],
+              'p': stacked[n + n_contrasts:], 'regressors': names}
+
+    if name is not None:
+        volumes = [("%s_beta_%s"%(name, r), result['beta'][i])
+                   for i, r in enumerate(names)]
+        for k in range(n_contrasts):
+            volumes.append(("%s_t%d"%(name, k), result['t'][k]))
+            volumes.append(("%s_p%d"%(name, k), result['p'][k]))
+        if not hasattr(series, 'simu_results'):
+            series.simu_results = {}
+        results = series.simu_results.setdefault('glm', {})
+        for res_name, volume in volumes:
+            results[res_name] = volume
+            series.save_simu_result('glm', res_name, overwrite)
+    return result
@@ -0,0 +1,176 @@
+"""
+Cine playback helpers:
+
+* FrameRingBuffer: fixed size buffer of upcoming frames.
+* CineReader: background thread fill the ring buffer.
+* export_cine: render playback to image sequence or video, off screen.
+"""
+
+import threading
+from collections import OrderedDict
+from os.path import splitext
+
+from simucaller.helpers import get_logger
+
+log = get_logger(__name__)
+
+
+class FrameRingBuffer(object):
+    """
+    Thread safe fixed size buffer of upcoming frames,
+    frames keyed by the playback sequence number.
+    """
+    def __init__(self, size=16):
+        """
+        :size: (int) max number of frames in buffer.
+        """
+        self.size = size
+        self.frames = OrderedDict()
+        self.cond = threading.Condition()
+
+    def put(self, k, t, arr3d, is_running):
+        """
+        put frame k into buffer, wait when the buffer is full.
+        return False if stopped while waiting.
+        """
+        with self.cond:
+            while len(self.frames) >= self.size:
+                if not is_running():
+                    return False
+                self.cond.wait(0.1)
+            self.frames[k] = (t, arr3d)
+            return True
+
+    def take(self, k):
+        """
+        take frame k out of the buffer, frames before k are dropped.
+        return (t, arr3d) pair, or None if the frame not read yet.
+        """
+        with self.cond:
+            for key in list(self.frames):
+                if key < k:
+                    del self.frames[key]
+            frame = self.frames.pop(k, None)
+            self.cond.notify_all()
+            return frame
+
+    def clear(self):
+        with self.cond:
+            self.frames.clear()
+            self.cond.notify_all()
+
+
+class CineReader(threading.Thread):
+    """
+    Background reader for cine playback,
+    read frames after the start time point into a FrameRingBuffer,
+    wrap to the first frame at the end of series.
+    """
+    def __init__(self, series, start, buffer_size=16):
+        """
+        :series: simucaller.series.Series
+        :start: (int) time point of playback sequence number 0.
+        :buffer_size: (int) how many frames read ahead.
+        """
+        super(CineReader, self).__init__()
+        self.daemon = True
+        self.series = series
+        self.start_t = start
+        self.buffer = FrameRingBuffer(buffer_size)
+        self.next_k = 0
+        self.running = True
+        self.lock = threading.Lock()
+
+    def time_point(self, k):
+        """ time point of playback sequence number k """
+        return int((self.start_t + k) % self.series.shape[0])
+
+    def seek(self, k):
+        """
+        jump the reader to sequence number k, when it fall behind playback.
+        """
+        with self.lock:
+            if k > self.next_k:
+                log.debug("cine reader fall behind, skip to %d"%k)
+                self.next_k = k
+
+    def run(self):
+        while self.running:
+            with self.lock:
+                k = self.next_k
+                self.next_k += 1
+            t = self.time_point(k)
+            # read without memory cache, frames used only once
+            arr3d = self.series._get_arr3d(t)
+            if not self.buffer.put(k, t, arr3d, lambda: self.running):
+                break
+
+    def stop(self):
+        self.running = False
+        self.buffer.clear()
+        self.join()
+
+
+def export_cine(series, path, z, time_points=None, fps=10,
+                overlay=None, cutoff=None, dpi=100):
+    """
+    Export cine playback of z slice to an image sequence or a video,
+    rendered by an off screen figure, frames read in time order.
+
+    :series: simucaller.series.Series
+    :path: output path, the extension decide the format:
+        .png/.jpg/.tif: image sequence, named like <path>_0001.png
+        .mp4/.avi: video, need ffmpeg
+        .gif: gif animation, need pillow
+    :z: (int) z slice
+    :time_points: (iterable) time points to export, default all.
+    :fps: (int) frames per second of video.
+    :overlay: (simucaller.gui.heatmap.HeatmapOverlay/None) heatmap overlay.
+    :cutoff: (float/None) heatmap cutoff pvalue.
+    :dpi: (int)
+    """
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    if time_points is None:
+        time_points = range(series.shape[0])
+    root, ext = splitext(path)
+    ext = ext.lower()
+
+    fig = Figure((6, 6), dpi=dpi)
+    FigureCanvasAgg(fig)
+    axes = fig.add_subplot(111)
+    image = None
+
+    writer = None
+    if ext in ('.mp4', '.avi', '.gif'):
+        from matplotlib import animation
+        if ext == '.gif':
+            writer = animation.PillowWriter(fps=fps)
+        else:
+            writer = animation.FFMpegWriter(fps=fps)
+        writer.setup(fig, path, dpi=dpi)
+
+    # one (y, x) frame per time point, never the whole volume
+    arr4d = series.h5dict['arr4d']
+    n = 0
+    for t in time_points:
+        mat = arr4d[t, :, :, z]
+        if image is None:
+            image = axes.matshow(mat, cmap='gray')
+            if overlay is not None:
+                axes.imshow(overlay.slice(z, cutoff),
+                            interpolation='nearest', origin='upper')
+            title = axes.set_title("")
+        image.set_data(mat)
+        image.autoscale()
+        title.set_text("T: %d"%t)
+        if writer is not None:
+            writer.grab_frame()
+        else:
+            fig.savefig("%s_%04d%s"%(root, t, ext), dpi=dpi)
+        n += 1
+    if writer is not None:
+        writer.finish()
+    log.info("%d frames exported to %s"%(n, path))
+    return n
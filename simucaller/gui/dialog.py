@@ -8,13 +8,45 @@ matplotlib.use('Qt5Agg')
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
 from matplotlib.backends.backend_qt5 import NavigationToolbar2QT as NavigationToolbar
 from matplotlib.figure import Figure
+from matplotlib.collections import LineCollection
+from matplotlib.lines import Line2D
+
+import time
 
 from simucaller.series import Series
 from simucaller.helpers import get_logger
+from simucaller.gui.worker import AnalysisWorker
 
 log = get_logger(__name__)
 
 
+def minmax_decimate(arr2d, max_points=2000):
+    """
+    Min/max decimation of lines for drawing,
+    keep the min and max value of every bucket, so peaks are not lost.
+    return (x, y) pair, x: (m,) time index, y: (n_lines, m)
+
+    :arr2d: (n_lines, t) array
+    :max_points: (int) max number of points per line after decimation.
+    """
+    n, nt = arr2d.shape
+    x = np.arange(nt)
+    if nt <= max_points:
+        return x, arr2d
+    n_buckets = max_points // 2
+    size = -(-nt // n_buckets) # ceil
+    pad = n_buckets * size - nt
+    padded = np.pad(arr2d, ((0, 0), (0, pad)), mode='edge')
+    buckets = padded.reshape(n, n_buckets, size)
+    y = np.empty((n, n_buckets, 2))
+    y[:, :, 0] = buckets.min(axis=2)
+    y[:, :, 1] = buckets.max(axis=2)
+    x = np.repeat(np.arange(n_buckets) * size, 2)
+    x[1::2] += size - 1
+    x = np.minimum(x, nt - 1)
+    return x, y.reshape(n, -1)
+
+
 class SeriesLineView(QDialog):
     """
     Dialog for view time series lines.
@@ -35,6 +67,7 @@ class SeriesLineView(QDialog):
         # init window
         super(SeriesLineView, self).__init__(None)
         self.create_main_frame()
+        self.init_aggregates()
         self.on_draw()
 
     def create_main_frame(self):
@@ -92,6 +125,32 @@ class SeriesLineView(QDialog):
 
         self.setLayout(vbox)
 
+    MAX_LEGEND = 20
+
+    def init_aggregates(self):
+        """
+        stack series and compute aggregates once:
+
+        * self.series_arr: (n_points, t) stacked series
+        * self.mean, self.sem: mean and standard error of series
+        * self.segments: decimated lines for LineCollection
+        * self.labels, self.colors: legend labels and line colors
+        """
+        self.series_arr = np.asarray(self.points_series, dtype=np.float64)
+        n = len(self.series_arr)
+        self.mean = self.series_arr.mean(axis=0)
+        if n > 1:
+            self.sem = self.series_arr.std(axis=0, ddof=1) / np.sqrt(n)
+        else:
+            self.sem = np.zeros_like(self.mean)
+        # about one min/max pair per pixel column
+        x, y = minmax_decimate(self.series_arr,
+                               max_points=max(int(self.axes.bbox.width), 100))
+        self.segments = np.stack([np.broadcast_to(x, y.shape), y], axis=-1)
+        self.labels = [str(p) for p in self.points]
+        cycle = matplotlib.rcParams['axes.prop_cycle'].by_key()['color']
+        self.colors = [cycle[i % len(cycle)] for i in range(n)]
+
     def on_draw(self):
         import matplotlib.patches as patches
         import matplotlib.transforms as transforms
@@ -104,18 +163,23 @@ class SeriesLineView(QDialog):
         # draw line
         #
         if self.cb_mean.isChecked():
-            series = np.asarray(self.points_series)
-            s = series.mean(axis=0)            
-            self.axes.plot(s, label="mean")
+            x = np.arange(len(self.mean))
+            self.axes.fill_between(x, self.mean - self.sem, self.mean + self.sem,
+                                   alpha=0.3, linewidth=0)
+            self.axes.plot(x, self.mean, label="mean")
         else:
-            lines = []
-            for p, s in zip(self.points, self.points_series):
-                line = self.axes.plot(s, label=str(p))
-                lines.append(line)
+            colors = self.colors
+            lines = LineCollection(self.segments, colors=colors, linewidths=1)
+            self.axes.add_collection(lines)
+            self.axes.autoscale_view()
             # add label
             if self.cb_label.isChecked():
-                labels = [str(p) for p in self.points]
-                self.axes.legend(labels, loc=2)
+                if len(self.labels) <= self.MAX_LEGEND:
+                    handles = [Line2D([], [], color=c) for c in colors]
+                    self.axes.legend(handles, self.labels, loc=2)
+                else:
+                    handle = Line2D([], [], color=colors[0])
+                    self.axes.legend([handle], ["%d series"%len(self.labels)], loc=2)
 
         # draw break points high light band
         #
@@ -184,7 +248,7 @@ class HeatmapLoadingDialog(QDialog):
         res_path = self.heatmap_list.selectedItems()[0].text()
         algorithm, name = res_path.split('/')
         log.info("heatmap {} loaded".format(res_path))
-        self.parent.heatmap = self.parent.series.get_simu_result(algorithm, name)
+        self.parent.set_heatmap(self.parent.series.get_simu_result(algorithm, name))
         self.close()
 
     def load_list_items(self):
@@ -195,3 +259,157 @@ class HeatmapLoadingDialog(QDialog):
         res_list = self.parent.series.list_simu_result()
         for res_path in res_list:
             self.heatmap_list.addItem(res_path)
+
+
+class AnalysisDialog(QDialog):
+    """
+    Dialog for run simulation region calling in a background worker,
+    with voxel block progress, throughput, ETA and cancel.
+    Partial pvalue blocks are streamed into the parent's heatmap overlay.
+    """
+    ALGORITHMS = ('diff_ttest', 'ttest')
+
+    def __init__(self, parent_window):
+        """
+        :parent_window: the main SimuViewer instance
+        """
+        log.info("AnalysisDialog window launched.")
+        #
+        # init window
+        super(AnalysisDialog, self).__init__(None)
+        self.setWindowTitle("Run Analysis")
+        self.parent = parent_window
+        self.worker = None
+        series = self.parent.series
+        n_images = int(series.n_images)
+
+        self.algorithm_combo = QComboBox()
+        self.algorithm_combo.addItems(self.ALGORITHMS)
+
+        start, end = getattr(series, 'break_points', (0, 1))
+        self.break_start = QSpinBox()
+        self.break_start.setRange(0, n_images)
+        self.break_start.setValue(int(start))
+        self.break_end = QSpinBox()
+        self.break_end.setRange(0, n_images)
+        self.break_end.setValue(int(end))
+
+        intervals = getattr(series, 'simu_intervals', [])
+        self.intervals_input = QLineEdit(
+            ", ".join("%d-%d"%(s, e) for s, e in intervals))
+
+        self.direction_combo = QComboBox()
+        self.direction_combo.addItems(['+', '-', '~'])
+
+        n_results = len(series.list_simu_result()) \
+            if 'simulation_region_call' in series.h5dict else 0
+        self.name_input = QLineEdit("call_%d"%n_results)
+
+        form = QFormLayout()
+        form.addRow("algorithm", self.algorithm_combo)
+        form.addRow("break start", self.break_start)
+        form.addRow("break end", self.break_end)
+        form.addRow("intervals (s-e, ...)", self.intervals_input)
+        form.addRow("direction", self.direction_combo)
+        form.addRow("result name", self.name_input)
+
+        self.progress_bar = QProgressBar()
+        self.status_label = QLabel("")
+
+        self.run_button = QPushButton("Run")
+        self.run_button.clicked.connect(self.on_run)
+        self.cancel_button = QPushButton("Cancel")
+        self.cancel_button.setEnabled(False)
+        self.cancel_button.clicked.connect(self.on_cancel)
+        buttons = QHBoxLayout()
+        buttons.addWidget(self.run_button)
+        buttons.addWidget(self.cancel_button)
+
+        vbox = QVBoxLayout()
+        vbox.addLayout(form)
+        vbox.addWidget(self.progress_bar)
+        vbox.addWidget(self.status_label)
+        vbox.addLayout(buttons)
+        self.setLayout(vbox)
+
+    @staticmethod
+    def parse_intervals(text):
+        """
+        parse intervals text like: "0-10, 30-50" to [(0, 10), (30, 50)]
+        """
+        intervals = []
+        for item in text.split(','):
+            if item.strip():
+                s, e = item.split('-')
+                intervals.append((int(s), int(e)))
+        return intervals
+
+    def on_run(self):
+        """ set series parameters, launch the worker. """
+        series = self.parent.series
+        algorithm = self.algorithm_combo.currentText()
+        name = self.name_input.text().strip()
+        try:
+            assert name, "result name is empty"
+            assert 'simulation_region_call' not in series.h5dict or \
+                "%s/%s"%(algorithm, name) not in series.list_simu_result(), \
+                "result %s/%s exists"%(algorithm, name)
+            if algorithm == 'diff_ttest':
+                series.set_break_points((self.break_start.value(),
+                                         self.break_end.value()))
+            else:
+                series.set_simu_intervals(
+                    self.parse_intervals(self.intervals_input.text()))
+        except (AssertionError, ValueError) as e:
+            self.status_label.setText("invalid parameters: %s"%e)
+            return
+
+        self.parent.start_partial_heatmap()
+        self.worker = AnalysisWorker(series, algorithm, name,
+            direction=self.direction_combo.currentText())
+        self.worker.progress.connect(self.on_progress)
+        self.worker.partial.connect(self.parent.update_partial_heatmap)
+        self.worker.done.connect(self.on_done)
+        self.worker.failed.connect(self.on_failed)
+        self.start_time = time.time()
+        self.run_button.setEnabled(False)
+        self.cancel_button.setEnabled(True)
+        self.progress_bar.setValue(0)
+        self.status_label.setText("running ...")
+        self.worker.start()
+
+    def on_progress(self, progress):
+        """ show progress, throughput and ETA. """
+        self.progress_bar.setValue(int(100 * progress.fraction))
+        self.status_label.setText(str(progress))
+
+    def on_done(self, algorithm, name):
+        """ save result and show it as heatmap. """
+        series = self.parent.series
+        series.save_simu_result(algorithm, name)
+        series.save_attr()
+        self.parent.set_heatmap(series.get_simu_result(algorithm, name))
+        self.parent.show_heatmap()
+        self.status_label.setText("%s/%s finished in %.1fs"%(
+            algorithm, name, time.time() - self.start_time))
+        self.finish()
+
+    def on_failed(self, msg):
+        """ drop the partial heatmap, show the heatmap before the run. """
+        self.status_label.setText("analysis stopped: %s"%msg)
+        self.finish(restore=True)
+
+    def on_cancel(self):
+        if self.worker is not None:
+            self.worker.cancel()
+
+    def finish(self, restore=False):
+        self.parent.stop_partial_heatmap(restore)
+        self.run_button.setEnabled(True)
+        self.cancel_button.setEnabled(False)
+
+    def closeEvent(self, event):
+        if self.worker is not None and self.worker.isRunning():
+            self.worker.cancel()
+            self.worker.wait()
+        QDialog.closeEvent(self, event)
@@ -1,20 +1,108 @@
+from collections import OrderedDict
+
 import numpy as np
-from scipy import stats
+from matplotlib.colors import Normalize
+try:
+    from matplotlib import colormaps
+    get_cmap = colormaps.get_cmap
+except ImportError:
+    from matplotlib.cm import get_cmap
 
 from simucaller.helpers import get_logger
 
 log = get_logger(__name__)
 
-def zscore_heatmap2d(heatmap2d):
+def zscore_heatmap3d(heatmap3d):
     """
-    get 2d heatmap zscore
+    get 3d heatmap zscore, with the volume level mean and std of -log10(pvalue)
     """
-    mat = heatmap2d
-    mat = -np.log10(mat)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mat = -np.log10(heatmap3d)
     mat[mat == -np.inf] = 0
-    zscore = stats.zscore(mat)
+    finite = np.isfinite(mat)
+    if finite.any():
+        # pvalue 0 -> the max finite value
+        mat[mat == np.inf] = mat[finite].max()
+        mean, std = mat[finite].mean(), mat[finite].std()
+    else:
+        mean, std = 0, 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        zscore = (mat - mean) / std
     return zscore
 
+
+class HeatmapOverlay(object):
+    """
+    Precomputed overlay of a whole pvalue volume.
+
+    The -log10/zscore transform and the colormapped RGBA volume computed
+    once for the volume, a cutoff only changes the alpha channel,
+    cutoff masked RGBA volumes cached per cutoff, so slice changes
+    and cutoff edits only index into precomputed arrays.
+    """
+    def __init__(self, heatmap3d, cmap='YlOrRd', alpha=0.6, max_cached=4):
+        """
+        :heatmap3d: (y, x, z) pvalue volume
+        :cmap: colormap name
+        :alpha: (float)
+        :max_cached: (int) how many cutoff RGBA volumes keep in cache.
+        """
+        assert 0 <= alpha <= 1
+        self.pvalue = heatmap3d
+        self.zscore = zscore_heatmap3d(heatmap3d)
+        self.cmap = get_cmap(cmap)
+        self.alpha = alpha
+        self.max_cached = max_cached
+        self._base = None
+        self._rgba = OrderedDict()
+
+    def base(self):
+        """
+        return the (y, x, z, 4) uint8 RGBA volume without cutoff,
+        computed at the first call.
+        """
+        if self._base is None:
+            finite = np.isfinite(self.zscore)
+            if finite.any():
+                zs = self.zscore[finite]
+                norm = Normalize(zs.min(), zs.max())
+            else:
+                norm = Normalize(0, 1)
+            self._base = self.cmap(norm(self.zscore), alpha=self.alpha, bytes=True)
+            self._base[~finite, 3] = 0
+        return self._base
+
+    @staticmethod
+    def _apply_cutoff(rgba, pvalue, cutoff):
+        """ copy of rgba, the value lagger than cutoff pvalue is transparent. """
+        rgba = rgba.copy()
+        if cutoff:
+            rgba[~(pvalue <= cutoff), 3] = 0
+        return rgba
+
+    def rgba(self, cutoff=None):
+        """
+        return the (y, x, z, 4) uint8 RGBA volume,
+        the value lagger than cutoff pvalue is transparent.
+        """
+        if cutoff in self._rgba:
+            self._rgba[cutoff] = self._rgba.pop(cutoff)
+            return self._rgba[cutoff]
+        rgba = self._apply_cutoff(self.base(), self.pvalue, cutoff)
+        self._rgba[cutoff] = rgba
+        while len(self._rgba) > self.max_cached:
+            self._rgba.popitem(last=False)
+        return rgba
+
+    def slice(self, z, cutoff=None):
+        """
+        return the (y, x, 4) RGBA overlay of z slice.
+        """
+        if cutoff in self._rgba:
+            return self._rgba[cutoff][:, :, z]
+        return self._apply_cutoff(self.base()[:, :, z], self.pvalue[:, :, z], cutoff)
+
+
 def pvalue2zscore(pvalue, heatmap2d_pvalue):
     """
     convert pvalue to zscore in the population of heatmap2d
@@ -26,18 +114,3 @@ def pvalue2zscore(pvalue, heatmap2d_pvalue):
     mean = mat.mean()
     zscore = (log2_p - mean) / std
     return zscore
-
-def draw_heatmap(axes, heatmap2d_pvalue, cutoff=None, alpha=0.6):
-    """
-    draw heatmap on target axes.
-
-    :axes: target axes.
-    :heatmap2d: target heatmap
-    :cutoff: (float/None) the value lagger than cutoff pvalue will not show.
-    :alpha: (float)
-    """
-    assert 0 <= alpha <= 1
-    mat = zscore_heatmap2d(heatmap2d_pvalue)
-    if cutoff:
-        mat = np.where(heatmap2d_pvalue <= cutoff, mat, np.nan)
-    axes.matshow(mat, cmap='YlOrRd', alpha=alpha)
@@ -4,26 +4,31 @@ from PyQt5.QtCore import *
 from PyQt5.QtGui import *
 from PyQt5.QtWidgets import *
 
+import numpy as np
 import matplotlib
 matplotlib.use('Qt5Agg')
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
 from matplotlib.backends.backend_qt5 import NavigationToolbar2QT as NavigationToolbar
 from matplotlib.figure import Figure
 
-from simucaller.series import Series
+from simucaller.service import open_series
 from simucaller.helpers import get_logger
 
 from .widget.control_panel import ControlPanel
 from .widget.heatmap_panel import HeatmapPanel
 from .widget.points_panel import PointsPanel
 from .widget.menu import Menu
+from .widget.ortho_panel import OrthoPanel
+from .widget.roi_panel import ROIPanel
+from .worker import FrameLoader
 
 import logging
 logging.basicConfig(level=logging.DEBUG)
 log = get_logger(__name__)
 
 
-class SimuViewer(QMainWindow, ControlPanel, HeatmapPanel, PointsPanel, Menu):
+class SimuViewer(QMainWindow, ControlPanel, HeatmapPanel, PointsPanel,
+                 OrthoPanel, ROIPanel, Menu):
     """ Main application window. """
     def __init__(self, hdf5_path=None, parent=None):
         # init position
@@ -37,6 +42,22 @@ class SimuViewer(QMainWindow, ControlPanel, HeatmapPanel, PointsPanel, Menu):
         # init points
         self.selected_points = set([])
 
+        # init displayed frame
+        self.frame = None
+        self.frame3d = None
+        self.frame3d_t = None
+
+        # init hover readout
+        self.motion_xy = (None, None)
+        self.series2d = None
+        self.series2d_z = None
+        self.spark_background = None
+
+        # init image artists
+        self.image = None
+        self.heatmap_image = None
+        self.backgrounds = {}
+
         # init window
         QMainWindow.__init__(self, parent)
         self.setWindowTitle('SimuViewer')
@@ -59,9 +80,24 @@ class SimuViewer(QMainWindow, ControlPanel, HeatmapPanel, PointsPanel, Menu):
             self.window_load_file()
 
     def load_file(self, hdf5_path):
-        """ Load Series from hdf5 file """
+        """
+        Load Series from hdf5 file,
+        through the local service if the file is served (see `simucaller.service`).
+        """
         try:
-            self.series = Series(hdf5_path)
+            self.series = open_series(hdf5_path)
+            self.image = None
+            self.frame = None
+            self.frame3d_t = None
+            self.series2d_z = None
+            if hasattr(self, 'cine_timer'):
+                self.stop_cine()
+            if hasattr(self, 'frame_loader'):
+                self.frame_loader.stop()
+            self.frame_loader = FrameLoader(self.series)
+            self.frame_loader.loaded.connect(self.on_frame_loaded)
+            self.roi_mask = None
+            self.load_roi_items()
             return True
         except Exception as e:
             log.error(e)
@@ -73,15 +109,27 @@ class SimuViewer(QMainWindow, ControlPanel, HeatmapPanel, PointsPanel, Menu):
         path, _ = QFileDialog.getSaveFileName(self,
             'Open file', 'image.png', file_choices)
         if path:
+            # animated artists are skipped by print_figure
+            artists = [a for _, artists in self.animated_artists() for a in artists]
+            for artist in artists:
+                artist.set_animated(False)
             self.canvas.print_figure(path, dpi=self.dpi)
+            for artist in artists:
+                artist.set_animated(True)
             log.info("Save image file to %s"%path)
 
     def on_click(self, event):
         """
         handle matplotlib.backend_bases.MouseEvent ('button_press_event')
 
-        collection clicked positions.
+        collection clicked positions,
+        move crosshair when ortho planes shown.
         """
+        if self.ortho_cb.isChecked() and hasattr(self, 'series'):
+            if self.on_ortho_click(event):
+                return
+        if event.inaxes is not self.axes or self.roi_selector is not None:
+            return
         t, z = self.position['t'], self.position['z']
         x, y = event.xdata, event.ydata
         if x and y:
@@ -96,16 +144,26 @@ class SimuViewer(QMainWindow, ControlPanel, HeatmapPanel, PointsPanel, Menu):
         """
         handle matplotlib.backend_bases.MouseEvent ('motion_notify_event')
 
-        refersh status_text
+        keep the latest position, status_text refreshed by motion_timer,
+        throttled to the display refresh rate.
         """
-        x, y = event.xdata, event.ydata
-        if x and y and hasattr(self, 'series'):
-            mat = self.series.get_arr2d(self.position['t'],
-                                        self.position['z'],
-                                        axis='xy')
+        if event.inaxes is not self.axes:
+            return
+        self.motion_xy = event.xdata, event.ydata
+        if not self.motion_timer.isActive():
+            self.motion_timer.start()
+
+    def on_readout(self):
+        """
+        refresh status_text (and sparkline) from in memory frame,
+        without any I/O.
+        """
+        x, y = self.motion_xy
+        if x and y and hasattr(self, 'series') and self.frame is not None:
+            row, col = int(round(y)), int(round(x))
             try:
-                value = mat[int(round(y)), int(round(x))]
-            except:
+                value = self.frame[row, col]
+            except IndexError:
                 value = 0.0
 
             text = "position: (%d, %.2f, %.2f, %d) value: %.2f"%(
@@ -113,38 +171,183 @@ class SimuViewer(QMainWindow, ControlPanel, HeatmapPanel, PointsPanel, Menu):
                 self.position['z'], value)
 
             if hasattr(self, 'heatmap2d') and self.heatmap_cb.isChecked():
-                pvalue = self.heatmap2d[int(round(y)), int(round(x))]
-                text += " pvalue: %f"%pvalue
+                try:
+                    pvalue = self.heatmap2d[row, col]
+                    text += " pvalue: %f"%pvalue
+                except IndexError:
+                    pass
             self.status_text.setText(text)
 
+            if self.sparkline_cb.isChecked():
+                self.draw_sparkline(row, col)
+
+    def on_sparkline(self):
+        """
+        handler for sparkline checkbox state change.
+        """
+        self.spark_axes.set_visible(self.sparkline_cb.isChecked())
+        self.canvas.draw()
+
+    def draw_sparkline(self, row, col):
+        """
+        draw the time series of voxel (row, col) in current z slice,
+        slice's time series read at once then kept in memory.
+        """
+        z = self.position['z']
+        if self.series2d_z != z:
+            self.series2d = self.series.get_series2d(z, axis='xy')
+            self.series2d_z = z
+        try:
+            s = self.series2d[:, row, col].astype(np.float64)
+        except IndexError:
+            return
+        span = s.max() - s.min()
+        s = (s - s.min()) / span if span else np.zeros_like(s)
+        self.spark_axes.set_xlim(0, max(len(s) - 1, 1))
+        self.spark_line.set_data(np.arange(len(s)), s)
+        if self.spark_background is not None:
+            self.canvas.restore_region(self.spark_background)
+            self.spark_axes.draw_artist(self.spark_line)
+            self.canvas.blit(self.spark_axes.bbox)
+
+    def init_artists(self, frame3d):
+        """
+        Create the persistent artists:
+
+        * self.image: anatomy frame
+        * self.heatmap_image: heatmap overlay
+        * self.roi_image: ROI overlay
+        * crosshair and ortho planes' artists
+
+        all are animated, updated by `set_data` and drawn by blitting.
+        """
+        mat = frame3d[:, :, self.position['z']]
+        self.axes.clear()
+        self.axes.grid(self.grid_cb.isChecked())
+        self.image = self.axes.matshow(mat, cmap='gray', animated=True)
+        self.heatmap_image = self.axes.imshow(
+            np.zeros(mat.shape + (4,), dtype=np.uint8),
+            interpolation='nearest', origin='upper',
+            animated=True, visible=False)
+        self.roi_image = self.axes.imshow(
+            np.zeros(mat.shape + (4,), dtype=np.uint8),
+            interpolation='nearest', origin='upper',
+            animated=True, visible=False)
+        self.init_crosshair('xy', self.axes)
+        if self.ortho_cb.isChecked():
+            self.init_ortho_artists(frame3d)
+        self.backgrounds = {}
+        self.canvas.draw()
+
+    def animated_artists(self):
+        """
+        return [(axes, artists)] pairs drawn by blitting.
+        """
+        if self.image is None:
+            return []
+        artists = [self.image, self.heatmap_image, self.roi_image]
+        if self.ortho_cb.isChecked():
+            artists += list(self.crosshairs['xy'])
+        return [(self.axes, artists)] + self.ortho_artists()
+
+    def on_canvas_draw(self, event):
+        """
+        handle matplotlib.backend_bases.DrawEvent ('draw_event')
+
+        cache the static background for blitting,
+        then draw animated artists over it.
+        """
+        if self.spark_axes.get_visible():
+            self.spark_background = self.canvas.copy_from_bbox(self.spark_axes.bbox)
+            self.spark_axes.draw_artist(self.spark_line)
+        else:
+            self.spark_background = None
+        self.backgrounds = {}
+        for axes, artists in self.animated_artists():
+            self.backgrounds[axes] = self.canvas.copy_from_bbox(axes.bbox)
+            for artist in artists:
+                axes.draw_artist(artist)
+
+    def blit(self):
+        """
+        Redraw animated artists over the cached background.
+        """
+        pairs = self.animated_artists()
+        if any(axes not in self.backgrounds for axes, _ in pairs):
+            self.canvas.draw()
+            return
+        for axes, artists in pairs:
+            self.canvas.restore_region(self.backgrounds[axes])
+            for artist in artists:
+                axes.draw_artist(artist)
+            self.canvas.blit(axes.bbox)
+
+    def request_frame(self):
+        """
+        Request current time point's frame from the worker thread,
+        draw directly when it is already in memory.
+        """
+        if self.frame3d_t == self.position['t']:
+            self.on_draw()
+        else:
+            self.frame_loader.request(self.position['t'])
+
+    def on_frame_loaded(self, request_id, t, arr3d):
+        """
+        handler for FrameLoader loaded signal, draw the latest frame only.
+        """
+        if self.frame_loader.is_stale(request_id):
+            return
+        self.frame3d = arr3d
+        self.frame3d_t = t
+        self.on_draw()
+
+    def current_frame3d(self):
+        """
+        return the 3d frame at current time point,
+        load it synchronously when not loaded by the worker.
+        """
+        t = self.position['t']
+        if self.frame3d is None or self.frame3d_t != t:
+            self.frame3d = self.series.get_arr3d(t)
+            self.frame3d_t = t
+        return self.frame3d
+
     def on_draw(self):
         """
         Refresh the figure.
         """
         if hasattr(self, 'series'):
             # self.series exist,
-            # clear the axes and redraw the plot anew
+            # update image artists' data and blit
             #
-            self.axes.clear()
-            self.axes.grid(self.grid_cb.isChecked())
-
-            mat = self.series.get_arr2d(self.position['t'],
-                                        self.position['z'],
-                                        axis='xy')
-            self.axes.matshow(mat, cmap='gray')
-
-            if hasattr(self, 'heatmap') and self.heatmap_cb.isChecked():
-                from .heatmap import draw_heatmap
-                draw_heatmap(self.axes, self.heatmap2d, cutoff=self.heatmap_cutoff)
-
-            try:
-                self.canvas.draw()
-            except AttributeError as e:
-                self.axes.clear()
-                self.axes.grid(self.grid_cb.isChecked())
-                self.axes.matshow(mat, cmap='gray')
-                self.canvas.draw()
-                log.error(str(e))
+            frame3d = self.current_frame3d()
+            z = self.position['z']
+            self.frame = mat = frame3d[:, :, z]
+            if self.image is None or self.image.get_array().shape != mat.shape:
+                self.init_artists(frame3d)
+            self.image.set_data(mat)
+            self.image.autoscale()
+
+            show_heatmap = hasattr(self, 'heatmap') and self.heatmap_cb.isChecked()
+            if show_heatmap:
+                overlay = self.heatmap_overlay.slice(z, cutoff=self.heatmap_cutoff)
+                self.heatmap_image.set_data(overlay)
+            self.heatmap_image.set_visible(show_heatmap)
+
+            show_roi = self.roi_mask is not None
+            if show_roi:
+                roi = np.zeros(mat.shape + (4,), dtype=np.uint8)
+                roi[self.roi_mask[:, :, z]] = (27, 197, 209, 120)
+                self.roi_image.set_data(roi)
+            self.roi_image.set_visible(show_roi)
+
+            if self.ortho_cb.isChecked():
+                rgba = self.heatmap_overlay.rgba(self.heatmap_cutoff) \
+                    if show_heatmap else None
+                self.update_ortho(frame3d, rgba)
+
+            self.blit()
         else:
             # self.series not exist
             # show text
@@ -177,7 +380,9 @@ class SimuViewer(QMainWindow, ControlPanel, HeatmapPanel, PointsPanel, Menu):
         canvas(FigureCanvas)
         NavigationToolBar
         control(QHBoxLayout)
+        heatmap(QHBoxLayout)
         points(QHBoxLayout)
+        roi(QHBoxLayout)
         """
         self.main_frame = QWidget()
 
@@ -196,10 +401,32 @@ class SimuViewer(QMainWindow, ControlPanel, HeatmapPanel, PointsPanel, Menu):
         #
         self.axes = self.fig.add_subplot(111)
 
+        # Coronal and sagittal planes, shown with ortho checkbox
+        #
+        self.create_ortho_axes()
+
+        # Small axes for hovered voxel's time series sparkline
+        #
+        self.spark_axes = self.fig.add_axes([0.72, 0.02, 0.26, 0.1])
+        self.spark_axes.set_ylim(-0.05, 1.05)
+        self.spark_axes.set_axis_off()
+        self.spark_axes.set_visible(False)
+        self.spark_line, = self.spark_axes.plot([], [], lw=0.8, animated=True)
+
         # Bind the events for mouse clicking and motion
         #
         self.canvas.mpl_connect('button_press_event', self.on_click)
         self.canvas.mpl_connect('motion_notify_event', self.on_motion)
+        self.canvas.mpl_connect('draw_event', self.on_canvas_draw)
+
+        # Status readout refresh at most once per display frame
+        #
+        screen = QApplication.primaryScreen()
+        refresh_rate = screen.refreshRate() if screen else 60
+        self.motion_timer = QTimer()
+        self.motion_timer.setSingleShot(True)
+        self.motion_timer.setInterval(int(1000 / max(refresh_rate, 1)))
+        self.motion_timer.timeout.connect(self.on_readout)
 
         # Create the navigation toolbar, tied to the canvas
         #
@@ -216,16 +443,29 @@ class SimuViewer(QMainWindow, ControlPanel, HeatmapPanel, PointsPanel, Menu):
         #
         points_hbox = self.create_points_hbox()
 
+        # Create ROI hbox
+        #
+        roi_hbox = self.create_roi_hbox()
+
         vbox = QVBoxLayout()
         vbox.addWidget(self.mpl_toolbar)
         vbox.addWidget(self.canvas)
         vbox.addLayout(control_hbox)
         vbox.addLayout(heatmap_hbox)
         vbox.addLayout(points_hbox)
+        vbox.addLayout(roi_hbox)
 
         self.main_frame.setLayout(vbox)
         self.setCentralWidget(self.main_frame)
 
+    def closeEvent(self, event):
+        self.stop_cine()
+        if hasattr(self, 'analysis_dialog'):
+            self.analysis_dialog.close()
+        if hasattr(self, 'frame_loader'):
+            self.frame_loader.stop()
+        QMainWindow.closeEvent(self, event)
+
     def create_status_bar(self):
         self.status_text = QLabel("position: value:")
         self.statusBar().addWidget(self.status_text, 1)
@@ -1,9 +1,12 @@
 from functools import partial
+import time
 
-from PyQt5.QtCore import Qt
-from PyQt5.QtWidgets import QCheckBox, QLabel, QSlider, QVBoxLayout, QHBoxLayout
+from PyQt5.QtCore import Qt, QTimer
+from PyQt5.QtWidgets import QCheckBox, QLabel, QSlider, QVBoxLayout, QHBoxLayout,\
+    QPushButton, QSpinBox, QFileDialog, QMessageBox
 
 from simucaller.helpers import get_logger
+from simucaller.gui.cine import CineReader, export_cine
 
 log = get_logger(__name__)
 
@@ -15,7 +18,13 @@ class ControlPanel(object):
 
     * checkboxes(QVBoxLayout)
         - grid_checkbox
+        - sparkline_checkbox
+        - ortho_checkbox
     * sliders(QVBoxLayout)
+    * cine(QVBoxLayout)
+        - play_button
+        - fps_spinbox
+        - export_button
     """
     def on_slide(self):
         """
@@ -39,12 +48,30 @@ class ControlPanel(object):
             try:
                 pvalue = float(self.heatmap_cutoff_input.text())
                 self.heatmap_cutoff = pvalue
-                self.on_draw()
+                self.schedule_draw()
             except ValueError as e:
                 log.error(e)
+        else:
+            self.schedule_draw()
+
+    def schedule_draw(self):
+        """
+        Debounce the redraw: restart the timer on every slider change,
+        the frame is requested from the worker thread when it times out.
+        """
+        if hasattr(self, 'frame_loader'):
+            self.draw_timer.start()
         else:
             self.on_draw()
 
+    def on_grid(self):
+        """
+        handler for grid checkbox state change,
+        grid is part of the static background, so redraw whole canvas.
+        """
+        self.axes.grid(self.grid_cb.isChecked())
+        self.canvas.draw()
+
     def create_slider(self, axis, max_value, init_value=0):
         """
         Generate slider widget with the label.
@@ -81,7 +108,113 @@ class ControlPanel(object):
             sliders.addWidget(w)
         return sliders
 
+    def on_play(self):
+        """
+        handler for play button click, start/pause cine playback.
+        """
+        if self.cine_timer.isActive():
+            self.stop_cine()
+        elif hasattr(self, 'series'):
+            self.start_cine()
+
+    def start_cine(self):
+        """
+        start cine playback from current time point,
+        frames read ahead by CineReader in background.
+        """
+        self.cine_reader = CineReader(self.series, self.position['t'] + 1,
+                                      buffer_size=max(2 * self.fps_spinbox.value(), 8))
+        self.cine_reader.start()
+        self.cine_clock = time.time()
+        self.cine_k = -1
+        self.cine_dropped = 0
+        self.cine_timer.setInterval(int(1000 / self.fps_spinbox.value()))
+        self.cine_timer.start()
+        self.play_button.setText("Pause")
+
+    def stop_cine(self):
+        """ stop cine playback. """
+        self.cine_timer.stop()
+        if hasattr(self, 'cine_reader'):
+            self.cine_reader.stop()
+            del self.cine_reader
+            log.info("cine stopped, %d frames dropped"%self.cine_dropped)
+        self.play_button.setText("Play")
+
+    def on_cine_tick(self):
+        """
+        handler for cine timer, show the frame due at current wall clock time,
+        drop frames instead of stalling when reading fall behind.
+        """
+        k = int((time.time() - self.cine_clock) * self.fps_spinbox.value())
+        if k <= self.cine_k:
+            return
+        frame = self.cine_reader.buffer.take(k)
+        if frame is None:
+            self.cine_dropped += 1
+            self.cine_reader.seek(k + 1)
+            return
+        self.cine_k = k
+        t, arr3d = frame
+        self.frame3d = arr3d
+        self.frame3d_t = t
+        self.slider_t.setValue(t)
+
+    def on_export_cine(self):
+        """
+        handler for export button click, export cine of current z slice.
+        """
+        if not hasattr(self, 'series'):
+            return
+        file_choices = "PNG sequence (*.png);;MP4 (*.mp4);;GIF (*.gif);;ALL (*)"
+        path, _ = QFileDialog.getSaveFileName(self,
+            'Export cine', 'cine.mp4', file_choices)
+        if not path:
+            return
+        show_heatmap = hasattr(self, 'heatmap') and self.heatmap_cb.isChecked()
+        try:
+            export_cine(self.series, path, self.position['z'],
+                        fps=self.fps_spinbox.value(),
+                        overlay=self.heatmap_overlay if show_heatmap else None,
+                        cutoff=getattr(self, 'heatmap_cutoff', None))
+        except Exception as e:
+            log.error(e)
+            QMessageBox.information(self, "Export failed",
+                                    "Fail to export cine:\n" + str(e))
+
+    def create_cine(self):
+        """
+        cine(QVBoxLayout)
+
+        * play_button
+        * fps_spinbox
+        * export_button
+        """
+        self.cine_timer = QTimer()
+        self.cine_timer.timeout.connect(self.on_cine_tick)
+
+        self.play_button = QPushButton("Play")
+        self.play_button.clicked.connect(self.on_play)
+        self.fps_spinbox = QSpinBox()
+        self.fps_spinbox.setRange(1, 60)
+        self.fps_spinbox.setValue(10)
+        self.fps_spinbox.setSuffix(" fps")
+        self.export_button = QPushButton("Export")
+        self.export_button.clicked.connect(self.on_export_cine)
+
+        cine = QVBoxLayout()
+        for w in [self.play_button, self.fps_spinbox, self.export_button]:
+            cine.addWidget(w)
+        return cine
+
     def create_control_hbox(self):
+        # debounce timer for sliders
+        #
+        self.draw_timer = QTimer()
+        self.draw_timer.setSingleShot(True)
+        self.draw_timer.setInterval(15)
+        self.draw_timer.timeout.connect(self.request_frame)
+
         # checkboxes
         checkboxes = QVBoxLayout()
 
@@ -89,10 +222,26 @@ class ControlPanel(object):
         #
         self.grid_cb = QCheckBox("Show &Grid")
         self.grid_cb.setChecked(False)
-        self.grid_cb.stateChanged.connect(self.on_draw)
+        self.grid_cb.stateChanged.connect(self.on_grid)
 
         checkboxes.addWidget(self.grid_cb)
 
+        # Sparkline check box
+        #
+        self.sparkline_cb = QCheckBox("Show S&parkline")
+        self.sparkline_cb.setChecked(False)
+        self.sparkline_cb.stateChanged.connect(self.on_sparkline)
+
+        checkboxes.addWidget(self.sparkline_cb)
+
+        # Ortho planes check box
+        #
+        self.ortho_cb = QCheckBox("Show &Ortho planes")
+        self.ortho_cb.setChecked(False)
+        self.ortho_cb.stateChanged.connect(self.on_ortho)
+
+        checkboxes.addWidget(self.ortho_cb)
+
         # sliders
         #
         sliders = self.create_sliders()
@@ -104,5 +253,6 @@ class ControlPanel(object):
 
         hbox.addLayout(checkboxes)
         hbox.addLayout(sliders)
+        hbox.addLayout(self.create_cine())
         return hbox
     
\ No newline at end of file
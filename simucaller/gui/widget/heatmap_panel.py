@@ -1,7 +1,9 @@
+import numpy as np
+from PyQt5.QtCore import QTimer
 from PyQt5.QtWidgets import QHBoxLayout, QMessageBox, QLabel, QPushButton, QCheckBox, QLineEdit
 
 from simucaller.helpers import get_logger
-from simucaller.gui.heatmap import pvalue2zscore
+from simucaller.gui.heatmap import pvalue2zscore, HeatmapOverlay
 
 log = get_logger(__name__)
 
@@ -16,6 +18,76 @@ class HeatmapPanel(object):
     * heatmap_cutoff_input(QLineEdit)
     * heatmap_cutoff_button
     """
+    def set_heatmap(self, heatmap):
+        """
+        set the (y, x, z) pvalue heatmap, precompute the overlay volume.
+        """
+        self.heatmap = heatmap
+        self.heatmap_overlay = HeatmapOverlay(heatmap)
+
+    def start_partial_heatmap(self):
+        """
+        start showing partial result of a running analysis,
+        not finished voxels has pvalue 1,
+        the current heatmap is kept to be restored if the analysis stops.
+        """
+        self.previous_heatmap = (getattr(self, 'heatmap', None),
+                                 getattr(self, 'heatmap_overlay', None),
+                                 self.heatmap_cb.isChecked())
+        self.partial_heatmap = np.ones(tuple(self.series.shape[1:]))
+        self.partial_dirty = False
+        if not hasattr(self, 'partial_timer'):
+            self.partial_timer = QTimer()
+            self.partial_timer.setInterval(250)
+            self.partial_timer.timeout.connect(self.refresh_partial_heatmap)
+        self.partial_timer.start()
+
+    def update_partial_heatmap(self, y_start, y_stop, block):
+        """ handler for partial pvalue block of running analysis. """
+        self.partial_heatmap[y_start:y_stop] = block
+        self.partial_dirty = True
+
+    def refresh_partial_heatmap(self):
+        """ rebuild heatmap overlay from partial result, throttled by timer. """
+        if not self.partial_dirty:
+            return
+        self.partial_dirty = False
+        self.set_heatmap(self.partial_heatmap.copy())
+        if self.heatmap_cb.isChecked():
+            self.show_heatmap()
+        else:
+            self.heatmap_cb.setChecked(True)
+
+    def stop_partial_heatmap(self, restore=False):
+        """
+        stop showing partial result.
+
+        :restore: (bool) the analysis failed or cancelled,
+            drop the partial heatmap and show the heatmap before it.
+        """
+        if hasattr(self, 'partial_timer'):
+            self.partial_timer.stop()
+        self.partial_dirty = False
+        previous = getattr(self, 'previous_heatmap', None)
+        self.previous_heatmap = None
+        if not restore or previous is None:
+            return
+        heatmap, overlay, checked = previous
+        if heatmap is None:
+            for attr in ('heatmap', 'heatmap2d', 'heatmap_overlay'):
+                if hasattr(self, attr):
+                    delattr(self, attr)
+            checked = False
+        else:
+            self.heatmap = heatmap
+            self.heatmap_overlay = overlay
+            self.load_heatmap2d()
+        # unchecking redraws without heatmap, checking redraws with it
+        self.heatmap_cb.blockSignals(True)
+        self.heatmap_cb.setChecked(checked)
+        self.heatmap_cb.blockSignals(False)
+        self.on_draw()
+
     def load_heatmap2d(self):
         """ load 2d heatmap, and 2d zscore """
         assert hasattr(self, 'heatmap')
@@ -1,7 +1,7 @@
 from PyQt5.QtWidgets import QMessageBox, QAction, QFileDialog
 from PyQt5.QtGui import QIcon
 
-from simucaller.gui.dialog import HeatmapLoadingDialog
+from simucaller.gui.dialog import HeatmapLoadingDialog, AnalysisDialog
 from simucaller.helpers import get_logger
 
 log = get_logger(__name__)
@@ -18,6 +18,8 @@ class Menu(object):
         - Quit
     * View
         - Load Heatmap
+    * Analysis
+        - Run Analysis
     * Help
         - About
     """
@@ -44,6 +46,13 @@ class Menu(object):
         dialog.exec_()
         self.load_heatmap2d()
 
+    def window_run_analysis(self):
+        """ launch window for run analysis in background. """
+        if not hasattr(self, 'series'):
+            return
+        self.analysis_dialog = AnalysisDialog(self)
+        self.analysis_dialog.show()
+
     def create_action(self, text, slot=None, shortcut=None,
                       icon=None, tip=None, checkable=False,
                       signal="triggered()"):
@@ -106,6 +115,14 @@ class Menu(object):
             tip="Load Heatmap")
         self.add_actions(self.view_menu, (load_heatmap_action,))
 
+        #
+        # analysis menu
+        self.analysis_menu = self.menuBar().addMenu("&Analysis")
+        run_analysis_action = self.create_action("&Run Analysis",
+            slot=self.window_run_analysis,
+            tip="Run simulation region calling in background")
+        self.add_actions(self.analysis_menu, (run_analysis_action,))
+
         #
         # help menu
         self.help_menu = self.menuBar().addMenu("&Help")
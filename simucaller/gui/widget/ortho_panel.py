@@ -0,0 +1,145 @@
+import numpy as np
+
+from simucaller.helpers import get_logger
+
+log = get_logger(__name__)
+
+class OrthoPanel(object):
+    """
+    Abstract class for create orthogonal three-plane view.
+
+    * axial plane('xy'): self.axes
+    * coronal plane('xz'): self.ortho_axes['xz']
+    * sagittal plane('yz'): self.ortho_axes['yz']
+
+    All planes are cut from one cached 3d frame (y, x, z) of current time point,
+    and linked by crosshair on the (x, y, z) position.
+    """
+    # plane -> (horizontal axis, vertical axis) of displayed image
+    ORTHO_PLANES = {
+        'xz': ('x', 'z'),
+        'yz': ('y', 'z'),
+    }
+
+    def create_ortho_axes(self):
+        """
+        create axes of coronal and sagittal planes, hidden by default.
+        """
+        self.axial_position = self.axes.get_position()
+        self.ortho_axes = {
+            'xz': self.fig.add_axes([0.58, 0.55, 0.38, 0.35]),
+            'yz': self.fig.add_axes([0.58, 0.12, 0.38, 0.35]),
+        }
+        for axes in self.ortho_axes.values():
+            axes.set_visible(False)
+        self.ortho_images = {}
+        self.ortho_heatmap_images = {}
+        self.crosshairs = {}
+
+    def cut_plane(self, plane, arr3d):
+        """
+        cut 2d plane from (y, x, z, ...) array at current position,
+        in display orientation: z as rows, another axis as columns.
+        """
+        if plane == 'xz':
+            arr2d = arr3d[self.position['y'], :, :]
+        else: # 'yz'
+            arr2d = arr3d[:, self.position['x'], :]
+        return np.swapaxes(arr2d, 0, 1)
+
+    def init_crosshair(self, plane, axes):
+        """ create animated crosshair lines on axes. """
+        kwargs = dict(color='#1bc5d1', lw=0.8, animated=True,
+                      visible=self.ortho_cb.isChecked())
+        self.crosshairs[plane] = (axes.axvline(0, **kwargs),
+                                  axes.axhline(0, **kwargs))
+
+    def init_ortho_artists(self, frame3d):
+        """
+        Create image, heatmap overlay and crosshair artists of ortho planes.
+        """
+        for plane, axes in self.ortho_axes.items():
+            axes.clear()
+            h, v = self.ORTHO_PLANES[plane]
+            axes.set_xlabel(h)
+            axes.set_ylabel(v)
+            mat = self.cut_plane(plane, frame3d)
+            self.ortho_images[plane] = axes.imshow(
+                mat, cmap='gray', origin='lower', aspect='auto',
+                interpolation='nearest', animated=True)
+            self.ortho_heatmap_images[plane] = axes.imshow(
+                np.zeros(mat.shape + (4,), dtype=np.uint8),
+                origin='lower', aspect='auto', interpolation='nearest',
+                animated=True, visible=False)
+            self.init_crosshair(plane, axes)
+
+    def ortho_artists(self):
+        """ return [(axes, artists)] pairs of ortho planes. """
+        if not self.ortho_cb.isChecked() or not self.ortho_images:
+            return []
+        return [(axes, [self.ortho_images[plane],
+                        self.ortho_heatmap_images[plane]] +
+                       list(self.crosshairs[plane]))
+                for plane, axes in self.ortho_axes.items()]
+
+    def update_crosshairs(self):
+        """ move all crosshairs to current position """
+        for plane, (vline, hline) in self.crosshairs.items():
+            h, v = ('x', 'y') if plane == 'xy' else self.ORTHO_PLANES[plane]
+            vline.set_xdata([self.position[h]] * 2)
+            hline.set_ydata([self.position[v]] * 2)
+
+    def update_ortho(self, frame3d, heatmap_rgba=None):
+        """
+        update ortho planes' data from the 3d frame and heatmap RGBA volume.
+        """
+        for plane in self.ortho_axes:
+            image = self.ortho_images[plane]
+            image.set_data(self.cut_plane(plane, frame3d))
+            image.autoscale()
+            heatmap_image = self.ortho_heatmap_images[plane]
+            if heatmap_rgba is not None:
+                heatmap_image.set_data(self.cut_plane(plane, heatmap_rgba))
+            heatmap_image.set_visible(heatmap_rgba is not None)
+        self.update_crosshairs()
+
+    def on_ortho(self):
+        """
+        handler for ortho checkbox state change, relayout the figure.
+        """
+        checked = self.ortho_cb.isChecked()
+        if checked:
+            self.axes.set_position([0.05, 0.12, 0.48, 0.78])
+        else:
+            self.axes.set_position(self.axial_position)
+        for axes in self.ortho_axes.values():
+            axes.set_visible(checked)
+        for lines in self.crosshairs.values():
+            for line in lines:
+                line.set_visible(checked)
+        self.image = None # recreate artists
+        self.on_draw()
+
+    def on_ortho_click(self, event):
+        """
+        move the crosshair to the clicked position,
+        return True if event is in one of ortho planes.
+        """
+        if event.xdata is None or event.ydata is None:
+            return False
+        _, ny, nx, nz = self.series.shape
+        limits = {'x': nx, 'y': ny, 'z': nz}
+        if event.inaxes is self.axes:
+            h, v = 'x', 'y'
+        else:
+            planes = [p for p, a in self.ortho_axes.items() if a is event.inaxes]
+            if not planes:
+                return False
+            h, v = self.ORTHO_PLANES[planes[0]]
+        for axis, value in ((h, event.xdata), (v, event.ydata)):
+            self.position[axis] = min(max(int(round(value)), 0), limits[axis] - 1)
+        if self.slider_z.value() != self.position['z']:
+            self.slider_z.setValue(self.position['z'])
+        else:
+            self.on_draw()
+        return event.inaxes is not self.axes
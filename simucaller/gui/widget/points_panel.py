@@ -1,7 +1,9 @@
+import numpy as np
 from PyQt5.QtWidgets import QListWidget, QPushButton, QVBoxLayout, QHBoxLayout
 
 from simucaller.helpers import get_logger
 from simucaller.gui.dialog import SeriesLineView
+from simucaller.correlation import seed_correlation
 
 log = get_logger(__name__)
 
@@ -15,6 +17,7 @@ class PointsPanel(object):
     * buttons
         - clear_button
         - draw_series_button
+        - seed_corr_button
 
     """
     def clear_points(self):
@@ -32,10 +35,42 @@ class PointsPanel(object):
         launch SeriesLineView Dialog.
         """
         points = list(self.selected_points)
+        if not points:
+            return
         points_series = [self.series.get_series(x, y, z) for x, y, z in points]
         line_dialog = SeriesLineView(points, points_series, self)
         line_dialog.exec_()
 
+    def points_mask(self):
+        """ (y, x, z) bool mask of selected points. """
+        mask = np.zeros(tuple(self.series.shape[1:]), dtype=bool)
+        for x, y, z in self.selected_points:
+            mask[y, x, z] = True
+        return mask
+
+    def on_seed_correlation(self):
+        """
+        handler for seed_corr_button click event.
+
+        correlation map of the mean series of selected points
+        (or current ROI if no point selected), shown as heatmap overlay.
+        """
+        if not hasattr(self, 'series'):
+            return
+        if self.selected_points:
+            mask = self.points_mask()
+        elif getattr(self, 'roi_mask', None) is not None and self.roi_mask.any():
+            mask = self.roi_mask
+        else:
+            return
+        _, pvalue = seed_correlation(self.series, mask, name='seed',
+                                     overwrite=True)
+        self.set_heatmap(pvalue)
+        if self.heatmap_cb.isChecked():
+            self.show_heatmap()
+        else:
+            self.heatmap_cb.setChecked(True)
+
     def create_points_hbox(self):
         #
         # points_list
@@ -49,10 +84,15 @@ class PointsPanel(object):
         self.points_draw_series_button = QPushButton("Draw series")
         self.points_draw_series_button.clicked.connect(self.draw_series_line)
         #
+        # seed_corr_button
+        self.seed_corr_button = QPushButton("Seed correlation")
+        self.seed_corr_button.clicked.connect(self.on_seed_correlation)
+        #
         # buttons
         buttons = QVBoxLayout()
         buttons.addWidget(self.points_clear_button)
         buttons.addWidget(self.points_draw_series_button)
+        buttons.addWidget(self.seed_corr_button)
         #
         # hbox
         hbox = QHBoxLayout()
@@ -0,0 +1,162 @@
+import numpy as np
+from matplotlib.path import Path
+from matplotlib.widgets import RectangleSelector, LassoSelector
+from PyQt5.QtWidgets import QHBoxLayout, QPushButton, QComboBox, QLabel,\
+    QInputDialog, QMessageBox
+
+from simucaller.helpers import get_logger
+from simucaller.gui.dialog import SeriesLineView
+
+log = get_logger(__name__)
+
+class ROIPanel(object):
+    """
+    Abstract class for create ROI panel.
+
+    ROIPanel(QHBoxLayout)
+
+    * rectangle_button
+    * lasso_button
+    * threshold_button
+    * roi_combo(QComboBox): saved ROIs
+    * save_button
+    * series_button
+    * clear_button
+
+    ROI stored as a (y, x, z) bool mask: self.roi_mask
+    """
+    def set_roi(self, mask):
+        """ set current ROI mask, and refresh the figure. """
+        self.roi_mask = mask
+        n = int(mask.sum()) if mask is not None else 0
+        self.roi_label.setText("ROI: %d voxels"%n)
+        self.on_draw()
+
+    def stop_roi_selector(self):
+        """ disconnect the active rectangle/lasso selector. """
+        if getattr(self, 'roi_selector', None) is not None:
+            self.roi_selector.set_active(False)
+            self.roi_selector.disconnect_events()
+            self.roi_selector = None
+
+    def slice_mask(self, mask2d):
+        """ convert 2d mask of current z slice to 3d mask """
+        mask = np.zeros(tuple(self.series.shape[1:]), dtype=bool)
+        mask[:, :, self.position['z']] = mask2d
+        return mask
+
+    def on_rectangle(self):
+        """ handler for rectangle button, start rectangle selector. """
+        if not hasattr(self, 'series'):
+            return
+        self.stop_roi_selector()
+        def on_select(press, release):
+            _, ny, nx, _ = self.series.shape
+            x0, x1, y0, y1 = self.roi_selector.extents
+            mask2d = np.zeros((ny, nx), dtype=bool)
+            mask2d[int(round(y0)):int(round(y1)) + 1,
+                   int(round(x0)):int(round(x1)) + 1] = True
+            self.stop_roi_selector()
+            self.set_roi(self.slice_mask(mask2d))
+        self.roi_selector = RectangleSelector(self.axes, on_select,
+                                              useblit=False, interactive=False)
+
+    def on_lasso(self):
+        """ handler for lasso button, start lasso selector. """
+        if not hasattr(self, 'series'):
+            return
+        self.stop_roi_selector()
+        def on_select(verts):
+            _, ny, nx, _ = self.series.shape
+            yy, xx = np.mgrid[:ny, :nx]
+            centers = np.column_stack([xx.ravel(), yy.ravel()])
+            mask2d = Path(verts).contains_points(centers).reshape(ny, nx)
+            self.stop_roi_selector()
+            self.set_roi(self.slice_mask(mask2d))
+        self.roi_selector = LassoSelector(self.axes, on_select, useblit=False)
+
+    def on_threshold(self):
+        """
+        handler for threshold button,
+        select all voxels pass the heatmap cutoff as ROI.
+        """
+        if not hasattr(self, 'heatmap'):
+            msg = "Please load heatmap firstly \"Menu >> View >> Load Heatmap\""
+            QMessageBox.information(self, "Message", msg)
+            return
+        try:
+            cutoff = float(self.heatmap_cutoff_input.text())
+        except ValueError as e:
+            log.error(e)
+            return
+        self.set_roi(self.heatmap <= cutoff)
+
+    def on_roi_save(self):
+        """ handler for save button, save current ROI to hdf5 file. """
+        if getattr(self, 'roi_mask', None) is None:
+            return
+        name, ok = QInputDialog.getText(self, "Save ROI", "ROI name:")
+        if ok and name:
+            self.series.save_roi(name, self.roi_mask)
+            self.load_roi_items()
+
+    def on_roi_load(self, index):
+        """ handler for roi combo box, load saved ROI. """
+        if index <= 0:
+            return
+        name = self.roi_combo.itemText(index)
+        self.set_roi(self.series.get_roi(name))
+
+    def load_roi_items(self):
+        """ load saved ROI names into combo box """
+        self.roi_combo.blockSignals(True)
+        self.roi_combo.clear()
+        self.roi_combo.addItem("-- saved ROI --")
+        if hasattr(self, 'series'):
+            for name in self.series.list_roi():
+                self.roi_combo.addItem(name)
+        self.roi_combo.blockSignals(False)
+
+    def draw_roi_series(self):
+        """
+        handler for ROI series button,
+        launch SeriesLineView with ROI mean and median time series.
+        """
+        if getattr(self, 'roi_mask', None) is None or not self.roi_mask.any():
+            return
+        arr = self.series.get_region_series(self.roi_mask)
+        n = arr.shape[1]
+        labels = ["ROI mean (%d voxels)"%n, "ROI median (%d voxels)"%n]
+        series = [arr.mean(axis=1), np.median(arr, axis=1)]
+        line_dialog = SeriesLineView(labels, series, self)
+        line_dialog.exec_()
+
+    def clear_roi(self):
+        self.stop_roi_selector()
+        self.set_roi(None)
+
+    def create_roi_hbox(self):
+        self.roi_mask = None
+        self.roi_selector = None
+        self.roi_label = QLabel("ROI: 0 voxels")
+
+        buttons = [
+            ("Rectangle", self.on_rectangle),
+            ("Lasso", self.on_lasso),
+            ("Threshold", self.on_threshold),
+            ("Save ROI", self.on_roi_save),
+            ("ROI series", self.draw_roi_series),
+            ("Clear ROI", self.clear_roi),
+        ]
+        self.roi_combo = QComboBox()
+        self.roi_combo.currentIndexChanged.connect(self.on_roi_load)
+        self.load_roi_items()
+
+        hbox = QHBoxLayout()
+        hbox.addWidget(self.roi_label)
+        for text, slot in buttons:
+            button = QPushButton(text)
+            button.clicked.connect(slot)
+            hbox.addWidget(button)
+        hbox.addWidget(self.roi_combo)
+        return hbox
@@ -0,0 +1,118 @@
+from PyQt5.QtCore import QObject, QThread, pyqtSignal, pyqtSlot
+
+from simucaller.helpers import get_logger
+from simucaller.progress import CancelToken, Cancelled
+
+log = get_logger(__name__)
+
+
+class FrameLoader(QObject):
+    """
+    Load 3d frames of series in a worker thread,
+    all planes of a time point are cut from the same frame.
+
+    Every request get an increasing id, only the latest request is loaded,
+    stale requests for intermediate positions are dropped.
+
+    signals:
+
+    * loaded(request_id, t, arr3d)
+    """
+    requested = pyqtSignal(int, int)
+    loaded = pyqtSignal(int, int, object)
+
+    def __init__(self, series):
+        """
+        :series: simucaller.series.Series
+        """
+        super(FrameLoader, self).__init__()
+        self.series = series
+        self.latest = 0
+        self.thread = QThread()
+        self.moveToThread(self.thread)
+        self.requested.connect(self.load)
+        self.thread.start()
+
+    def request(self, t):
+        """
+        request frame at time point t, return the request id.
+        """
+        self.latest += 1
+        self.requested.emit(self.latest, t)
+        return self.latest
+
+    def is_stale(self, request_id):
+        return request_id != self.latest
+
+    @pyqtSlot(int, int)
+    def load(self, request_id, t):
+        """ load frame in worker thread. """
+        if self.is_stale(request_id):
+            return
+        arr3d = self.series.get_arr3d(t)
+        if self.is_stale(request_id):
+            log.debug("drop stale frame %d"%t)
+            return
+        self.loaded.emit(request_id, t, arr3d)
+
+    def stop(self):
+        """ stop the worker thread. """
+        self.thread.quit()
+        self.thread.wait()
+
+
+class AnalysisWorker(QThread):
+    """
+    Run `Series.call_simu` in a worker thread,
+    report voxel block progress and partial pvalue blocks.
+
+    signals:
+
+    * progress(simucaller.progress.Progress)
+    * partial(y_start, y_stop, pvalue_block)
+    * done(algorithm, name)
+    * failed(message)
+    """
+    progress = pyqtSignal(object)
+    partial = pyqtSignal(int, int, object)
+    done = pyqtSignal(str, str)
+    failed = pyqtSignal(str)
+
+    def __init__(self, series, algorithm, name, **kwargs):
+        """
+        :series: simucaller.series.Series
+        :algorithm: (str) algorithm name
+        :name: (str) result name
+        :kwargs: arguments pass to the algorithm
+        """
+        super(AnalysisWorker, self).__init__()
+        self.series = series
+        self.algorithm = algorithm
+        self.name = name
+        self.kwargs = kwargs
+        self.cancel_token = CancelToken()
+
+    def cancel(self):
+        self.cancel_token.cancel()
+
+    def on_progress(self, progress):
+        """ progress callback, called in worker thread after each block. """
+        ny = int(self.series.shape[1])
+        y_start, y_stop, _ = progress.y_slice.indices(ny)
+        self.partial.emit(y_start, y_stop, progress.block.copy())
+        self.progress.emit(progress)
+
+    def run(self):
+        try:
+            self.series.call_simu(self.algorithm, self.name,
+                                  progress=self.on_progress,
+                                  cancel=self.cancel_token, **self.kwargs)
+        except Cancelled:
+            log.info("analysis %s/%s cancelled"%(self.algorithm, self.name))
+            self.failed.emit("cancelled")
+            return
+        except Exception as e:
+            log.error(e)
+            self.failed.emit(str(e))
+            return
+        self.done.emit(self.algorithm, self.name)
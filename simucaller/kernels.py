@@ -0,0 +1,109 @@
+"""
+Optional Numba compiled voxel loops of the statistical kernels,
+with the pure NumPy fallback when Numba is not installed.
+
+backends:
+    'numpy': vectorized NumPy / SciPy
+    'numba': compiled voxel loops, need numba installed
+    'auto': 'numba' if numba installed, else 'numpy'
+
+The loops are plain python functions when Numba is not installed,
+so they still can be checked against the reference implementations.
+"""
+
+import math
+
+import numpy as np
+
+from simucaller.helpers import get_logger
+
+log = get_logger(__name__)
+
+try:
+    from numba import njit
+    HAS_NUMBA = True
+except ImportError:
+    HAS_NUMBA = False
+
+    def njit(*args, **kwargs):
+        """ stand-in of numba.njit, return the function unchanged. """
+        def decorator(func):
+            return func
+        return decorator
+
+
+BACKENDS = ('auto', 'numpy', 'numba')
+
+
+def resolve_backend(backend='auto'):
+    """
+    resolve backend name to 'numpy' or 'numba'.
+    """
+    if backend not in BACKENDS:
+        raise ValueError("backend should be one of {}".format(BACKENDS))
+    if backend == 'auto':
+        return 'numba' if HAS_NUMBA else 'numpy'
+    if backend == 'numba' and not HAS_NUMBA:
+        raise ImportError("backend 'numba' need numba installed")
+    return backend
+
+
+@njit(cache=True)
+def _lagged_column_moments(arr2d, rows, lag):
+    """
+    mean and sum of squared deviations of each column's samples,
+    two-pass in float64.
+
+    :arr2d: (t, n_voxels) array.
+    :rows: (int array) rows of samples.
+    :lag: (int) 0: samples are arr2d[rows],
+        k > 0: samples are differences arr2d[rows + k] - arr2d[rows].
+    """
+    n_voxels = arr2d.shape[1]
+    mean = np.zeros(n_voxels)
+    dev = np.zeros(n_voxels)
+    for r in rows:
+        for j in range(n_voxels):
+            v = float(arr2d[r, j])
+            if lag > 0:
+                v = float(arr2d[r + lag, j]) - v
+            mean[j] += v
+    for j in range(n_voxels):
+        mean[j] /= len(rows)
+    for r in rows:
+        for j in range(n_voxels):
+            v = float(arr2d[r, j])
+            if lag > 0:
+                v = float(arr2d[r + lag, j]) - v
+            d = v - mean[j]
+            dev[j] += d * d
+    return mean, dev
+
+
+@njit(cache=True)
+def ttest_columns(arr2d, rows1, rows2, lag=0):
+    """
+    Student's two sample t statistic (same as `scipy.stats.ttest_ind`)
+    of sample 1 against sample 2, for every column of arr2d.
+    return (t, df) pair, t in shape (n_voxels,).
+
+    :arr2d: (t, n_voxels) array.
+    :rows1: (int array) rows of sample 1.
+    :rows2: (int array) rows of sample 2.
+    :lag: (int) see `_lagged_column_moments`.
+    """
+    n1, n2 = len(rows1), len(rows2)
+    m1, d1 = _lagged_column_moments(arr2d, rows1, lag)
+    m2, d2 = _lagged_column_moments(arr2d, rows2, lag)
+    df = n1 + n2 - 2
+    t = np.empty(arr2d.shape[1])
+    for j in range(arr2d.shape[1]):
+        diff = m1[j] - m2[j]
+        denom = math.sqrt((d1[j] + d2[j]) / df * (1.0 / n1 + 1.0 / n2))
+        if denom > 0:
+            t[j] = diff / denom
+        elif diff == 0:
+            t[j] = np.nan
+        else:
+            t[j] = math.copysign(np.inf, diff)
+    return t, df
@@ -0,0 +1,222 @@
+"""
+Online (real-time) analysis, update statistics as volumes arrive.
+
+Per-voxel running moments (Welford) of the two sample groups
+(simulation/background for 'ttest', after/before differences for 'diff_ttest')
+are updated with each new volume, the pvalue map republished after that,
+each update cost time proportional to one volume, not the whole series.
+
+Usage:
+
+    online = OnlineAnalysis(series, 'ttest', intervals=[(10, 20), (40, 50)])
+    online.subscribe(lambda pvalue_arr3d, t: ...)
+    online.watch(image_dir)  # or online.consume(queue)
+"""
+
+import time
+
+import numpy as np
+
+from simucaller.helpers import get_logger
+from simucaller.call_simu import _ttest_from_deviations, _directional_pvalue
+from simucaller.engine import iter_blocks
+
+log = get_logger(__name__)
+
+try:
+    from queue import Empty
+except ImportError:
+    from Queue import Empty
+
+
+class RunningMoments(object):
+    """
+    Per-voxel running count, mean and sum of squared deviations (Welford).
+    """
+    def __init__(self, shape):
+        self.n = 0
+        self.mean = np.zeros(shape, dtype=np.float64)
+        self.m2 = np.zeros(shape, dtype=np.float64)
+
+    def update(self, values):
+        """ add one sample of every voxel """
+        self.n += 1
+        delta = values - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (values - self.mean)
+
+    def set_batch(self, ys, arr):
+        """
+        set moments of y slab ys from samples arr in shape (n, y, x, z),
+        used for initialization.
+        """
+        self.n = arr.shape[0]
+        if self.n == 0:
+            return
+        mean = arr.mean(axis=0)
+        self.mean[ys] = mean
+        self.m2[ys] = ((arr - mean) ** 2).sum(axis=0)
+
+
+class OnlineAnalysis(object):
+    """
+    Online version of 'ttest' and 'diff_ttest'.
+
+    Each row of time series belong to sample 1, sample 2 or neither:
+
+    * ttest: value x[t], sample 1 inside intervals, sample 2 outside.
+    * diff_ttest: difference x[t] - x[t-1], sample 1 after event, sample 2 before,
+        same ranges as `call_simu._diff_ttest`.
+    """
+    def __init__(self, series, algorithm='ttest', direction='+', intervals=None,
+                 break_points=None, n_before=None, n_after=None, block_size=8):
+        """
+        :series: `simucaller.series.Series` object, volumes appended into it.
+        :algorithm: ('ttest'/'diff_ttest')
+        :direction: ('+'/'-'/'~')
+        :intervals: (list) for 'ttest', default series.simu_intervals,
+            intervals may extend beyond the current end of series.
+        :break_points: (tuple) for 'diff_ttest', default series.break_points.
+        :n_before: (int) same to `call_simu._diff_ttest`
+        :n_after: (int) same to `call_simu._diff_ttest`
+        :block_size: (int) how many y slices read at once when initialize.
+        """
+        assert algorithm in ('ttest', 'diff_ttest')
+        self.series = series
+        self.algorithm = algorithm
+        self.direction = direction
+        if algorithm == 'ttest':
+            self.intervals = intervals or series.simu_intervals
+        else:
+            self.break_points = break_points or series.break_points
+        self.n_before = n_before
+        self.n_after = n_after
+        self.subscribers = []
+        self.init_moments(block_size)
+
+    def group(self, t):
+        """
+        sample group of the new value when volume t arrive, 1, 2 or None.
+        """
+        if self.algorithm == 'ttest':
+            if any(s <= t < e for s, e in self.intervals):
+                return 1
+            return 2
+        # diff_ttest: row i = t - 1 is the difference x[t] - x[t-1]
+        i = t - 1
+        if i < 0:
+            return None
+        break_start, break_end = self.break_points
+        before_lo = break_start - self.n_before if self.n_before else 0
+        if before_lo <= i and t <= break_start - 1:
+            return 2
+        if i >= break_end + 1 and \
+                (not self.n_after or t <= break_end + self.n_after):
+            return 1
+        return None
+
+    def init_moments(self, block_size=8):
+        """
+        initialize moments from volumes already in the series.
+        """
+        nt, ny, nx, nz = self.series.shape
+        self.moments = {1: RunningMoments((ny, nx, nz)),
+                        2: RunningMoments((ny, nx, nz))}
+        groups = np.array([self.group(t) for t in range(nt)])
+        for ys, block in iter_blocks(self.series, block_size):
+            block = block.astype(np.float64)
+            if self.algorithm == 'diff_ttest':
+                values = np.concatenate([block[:1] * np.nan,
+                                         np.diff(block, axis=0)])
+            else:
+                values = block
+            for g, moments in self.moments.items():
+                moments.set_batch(ys, values[groups == g])
+        self.last = self.series.h5dict['arr4d'][nt - 1].astype(np.float64) \
+            if nt > 0 else None
+        self.n_images = int(nt)
+
+    def pvalue(self):
+        """ current pvalue map in shape (y, x, z) """
+        m1, m2 = self.moments[1], self.moments[2]
+        t, df = _ttest_from_deviations(m1.n, m1.mean, m1.m2, m2.n, m2.mean, m2.m2)
+        return _directional_pvalue(t, df, self.direction)
+
+    def subscribe(self, callback):
+        """
+        callback(pvalue_arr3d, t) called after each volume added.
+        """
+        self.subscribers.append(callback)
+
+    def add_volume(self, arr3d, append=True):
+        """
+        add a new volume, update moments and republish the pvalue map.
+
+        :arr3d: (numpy array) volume in shape (y, x, z).
+        :append: (bool) append the volume to the series.
+        """
+        t = self.n_images
+        if append:
+            self.series.append_volumes([arr3d])
+        arr3d = np.asarray(arr3d, dtype=np.float64)
+        g = self.group(t)
+        if g is not None:
+            value = arr3d - self.last if self.algorithm == 'diff_ttest' else arr3d
+            self.moments[g].update(value)
+        self.last = arr3d
+        self.n_images = t + 1
+        pvalue_arr3d = self.pvalue()
+        for callback in self.subscribers:
+            callback(pvalue_arr3d, t)
+        return pvalue_arr3d
+
+    def update_from_series(self):
+        """
+        add volumes appended to the series by others.
+        """
+        dset = self.series.h5dict['arr4d']
+        for t in range(self.n_images, dset.shape[0]):
+            self.add_volume(dset[t], append=False)
+
+    def watch(self, image_dir, poll_interval=1.0, cancel=None, timeout=None):
+        """
+        Watch image_dir, append new hdr images to the series and update.
+        Stop when cancelled or no new image in timeout seconds.
+
+        :image_dir: path to directory which store hdr image files.
+        :poll_interval: (float) unit: 1 second
+        :cancel: (simucaller.progress.CancelToken/None)
+        :timeout: (float/None) unit: 1 second, None for wait forever.
+        """
+        last_new = time.time()
+        while cancel is None or not cancel.cancelled:
+            if self.series.append_images(image_dir) > 0:
+                self.update_from_series()
+                last_new = time.time()
+            elif timeout is not None and time.time() - last_new > timeout:
+                log.info("no new image in {}s, stop watching".format(timeout))
+                break
+            time.sleep(poll_interval)
+
+    def consume(self, queue, cancel=None, timeout=None):
+        """
+        Consume volumes from a queue (e.g. `queue.Queue`), add them to the series.
+        Stop when get None from queue, cancelled, or no volume in timeout seconds.
+
+        :queue: queue of (y, x, z) arrays.
+        :cancel: (simucaller.progress.CancelToken/None)
+        :timeout: (float/None) unit: 1 second, None for wait forever.
+        """
+        waited = 0.0
+        while cancel is None or not cancel.cancelled:
+            try:
+                arr3d = queue.get(timeout=0.1)
+            except Empty:
+                waited += 0.1
+                if timeout is not None and waited > timeout:
+                    break
+                continue
+            waited = 0.0
+            if arr3d is None:
+                break
+            self.add_volume(arr3d)
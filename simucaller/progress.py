@@ -0,0 +1,135 @@
+"""
+Progress report and cancellation protocol of analyses.
+
+* Progress: progress state passed to progress callbacks.
+* CancelToken: checked between voxel blocks, stop the analysis cleanly.
+* ProgressTracker: helper used by analysis engines.
+"""
+
+import sys
+import time
+import threading
+
+from simucaller.helpers import get_logger
+
+log = get_logger(__name__)
+
+
+class Cancelled(Exception):
+    """ raised when an analysis stopped by its CancelToken. """
+    pass
+
+
+class CancelToken(object):
+    """
+    Thread safe cancel flag, checked by analysis engines between voxel blocks.
+    """
+    def __init__(self):
+        self._event = threading.Event()
+
+    def cancel(self):
+        self._event.set()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def check(self):
+        """ raise `Cancelled` if cancelled. """
+        if self.cancelled:
+            raise Cancelled("analysis cancelled")
+
+
+class Progress(object):
+    """
+    Progress state of an analysis, passed to progress callback
+    after each voxel block.
+
+    :n_done: (int) voxels processed.
+    :n_total: (int) total voxels.
+    :elapsed: (float) elapsed time, unit: 1 second
+    :bytes_read: (int) bytes of data read.
+    :y_slice: (slice) y range of the finished block.
+    :block: (numpy array) result of the finished block.
+    """
+    def __init__(self, n_done, n_total, elapsed, bytes_read,
+                 y_slice=None, block=None):
+        self.n_done = n_done
+        self.n_total = n_total
+        self.elapsed = elapsed
+        self.bytes_read = bytes_read
+        self.y_slice = y_slice
+        self.block = block
+
+    @property
+    def fraction(self):
+        return float(self.n_done) / self.n_total if self.n_total else 1.0
+
+    @property
+    def throughput(self):
+        """ voxels per second """
+        return self.n_done / self.elapsed if self.elapsed > 0 else 0.0
+
+    @property
+    def read_rate(self):
+        """ bytes per second """
+        return self.bytes_read / self.elapsed if self.elapsed > 0 else 0.0
+
+    @property
+    def eta(self):
+        """ estimated remaining time, unit: 1 second """
+        rate = self.throughput
+        return (self.n_total - self.n_done) / rate if rate > 0 else float('nan')
+
+    def __str__(self):
+        return "%d/%d voxels (%.1f%%), %.0f voxels/s, %.1f MB/s, ETA %.1fs"%(
+            self.n_done, self.n_total, 100 * self.fraction,
+            self.throughput, self.read_rate / 1e6, self.eta)
+
+
+class ProgressTracker(object):
+    """
+    Helper for analysis engines: check the cancel token and
+    report Progress to the callback after each voxel block.
+    """
+    def __init__(self, n_total, progress=None, cancel=None):
+        """
+        :n_total: (int) total voxels.
+        :progress: (callable/None) progress callback, receive a `Progress` object.
+        :cancel: (CancelToken/None)
+        """
+        self.n_total = n_total
+        self.progress = progress
+        self.cancel = cancel
+        self.n_done = 0
+        self.bytes_read = 0
+        self.start = time.time()
+
+    def check(self):
+        """ check the cancel token, called before each block. """
+        if self.cancel is not None:
+            self.cancel.check()
+
+    def update(self, n_voxels, n_bytes, y_slice=None, block=None):
+        """ called after each block finished. """
+        self.n_done += n_voxels
+        self.bytes_read += n_bytes
+        if self.progress is not None:
+            self.progress(Progress(self.n_done, self.n_total,
+                                   time.time() - self.start, self.bytes_read,
+                                   y_slice=y_slice, block=block))
+
+
+def print_progress(stream=sys.stderr, prefix=""):
+    """
+    return a progress callback print progress line to stream.
+
+    :stream: output stream, default stderr.
+    :prefix: (str) prefix of progress line.
+    """
+    def callback(progress):
+        stream.write("\r" + prefix + str(progress))
+        if progress.n_done >= progress.n_total:
+            stream.write("\n")
+        stream.flush()
+    return callback
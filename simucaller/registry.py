@@ -0,0 +1,131 @@
+"""
+Registry of simulation region calling algorithms.
+
+Every algorithm declare a block kernel:
+
+    kernel(arr2d, **params) -> array in shape output_shape(params) + (n_voxels,)
+
+`arr2d` is the time series of a block of voxels, in shape (t, n_voxels).
+Execution engines in `simucaller.engine` (serial, multi-process, streaming, masked)
+work for every registered algorithm.
+
+Register a third-party algorithm:
+
+    from simucaller.registry import register
+
+    @register('mean_diff', params={'split': 100})
+    def mean_diff(arr2d, split):
+        return arr2d[split:].mean(axis=0) - arr2d[:split].mean(axis=0)
+
+    series.call_simu('mean_diff', 'call_0', split=120)
+"""
+
+import importlib
+from collections import OrderedDict
+
+from simucaller.helpers import get_logger
+
+log = get_logger(__name__)
+
+
+ALGORITHMS = OrderedDict()
+
+
+class Algorithm(object):
+    """
+    A registered algorithm.
+
+    :name: (str) algorithm name, used by `Series.call_simu`
+    :kernel: (callable) block kernel, must be a module level function,
+        so it can be sent to worker processes.
+    :params: (dict) parameter name -> default value
+    :series_params: (dict) parameter name -> Series attribute name,
+        parameters take value from the series when not given, like 'break_points'.
+    :output_shape: (callable/None) output_shape(params) -> tuple,
+        leading shape of the kernel output, default () (one value per voxel).
+    :index_func: (callable/None) index_func(series, params) -> result or None,
+        fast path evaluate the whole volume at once (e.g. from moment index).
+    :memory_factor: (float) kernel's peak working memory,
+        as multiple of the input block size, used by memory estimates.
+    """
+    def __init__(self, name, kernel, params=None, series_params=None,
+                 output_shape=None, index_func=None, memory_factor=3):
+        self.name = name
+        self.kernel = kernel
+        self.params = OrderedDict(params or {})
+        self.series_params = dict(series_params or {})
+        self._output_shape = output_shape
+        self.index_func = index_func
+        self.memory_factor = memory_factor
+        self.doc = kernel.__doc__
+
+    def bind(self, series, **kwargs):
+        """
+        Complete parameters with defaults and series attributes,
+        return params dict passed to the kernel.
+        """
+        unknown = set(kwargs) - set(self.params) - set(self.series_params)
+        if unknown:
+            raise TypeError("{} got unexpected parameters: {}".format(
+                self.name, ", ".join(sorted(unknown))))
+        params = OrderedDict(self.params)
+        params.update(kwargs)
+        for param, attr in self.series_params.items():
+            if params.get(param) is None:
+                assert hasattr(series, attr),\
+                    "{} need series.{}, please set it firstly".format(self.name, attr)
+                params[param] = getattr(series, attr)
+        return params
+
+    def output_shape(self, params):
+        if self._output_shape is None:
+            return ()
+        return tuple(self._output_shape(params))
+
+    def __repr__(self):
+        return "<Algorithm {}({})>".format(
+            self.name, ", ".join(list(self.series_params) + list(self.params)))
+
+
+def register(name, params=None, series_params=None, output_shape=None,
+             index_func=None, memory_factor=3):
+    """
+    Decorator register a block kernel as algorithm `name`,
+    arguments same to `Algorithm`.
+    """
+    def decorator(kernel):
+        if name in ALGORITHMS:
+            log.warning("algorithm {} re-registered".format(name))
+        ALGORITHMS[name] = Algorithm(name, kernel, params, series_params,
+                                     output_shape, index_func, memory_factor)
+        return kernel
+    return decorator
+
+
+BUILTIN_MODULES = ('simucaller.call_simu', 'simucaller.glm',
+                   'simucaller.correlation')
+
+
+def _load_builtin():
+    # built-in algorithms registered when import
+    for module in BUILTIN_MODULES:
+        importlib.import_module(module)
+
+
+def get_algorithm(name):
+    """
+    get registered algorithm by name.
+    """
+    _load_builtin()
+    if name not in ALGORITHMS:
+        raise KeyError("algorithm {} not registered, available: {}".format(
+            name, ", ".join(ALGORITHMS)))
+    return ALGORITHMS[name]
+
+
+def list_algorithms():
+    """
+    list names of all registered algorithms.
+    """
+    _load_builtin()
+    return list(ALGORITHMS)
@@ -1,11 +1,13 @@
+import hashlib
 import importlib
+import json
 from os import listdir, curdir
-from os.path import join, abspath, exists
+from os.path import join, abspath, exists, basename
 from itertools import product
 from functools import wraps
 import logging
 
-from h5py import File
+from h5py import File, Dataset, special_dtype
 import nibabel as nib
 import numpy as np
 import joblib
@@ -18,6 +20,45 @@ log = get_logger(__name__)
 
 CACHE = "__cache__"
 
+# read voxels one by one when they fill less than 1/MAX_BOX_RATIO of
+# their bounding box (e.g. scattered points)
+MAX_BOX_RATIO = 8
+
+
+def _arr4d_chunks(shape):
+    """
+    chunk shape of the resizable arr4d dataset:
+    a few time points of a y slab, keep both y block reads and frame reads cheap.
+    """
+    t, y, x, z = shape
+    return (max(1, min(t, 4)), max(1, min(y, 8)), x, z)
+
+
+def _create_arr4d(h5dict, shape, dtype='f4'):
+    """ create arr4d dataset with a resizable time axis. """
+    return h5dict.create_dataset('arr4d', shape=shape, dtype=dtype,
+                                 maxshape=(None,) + tuple(shape[1:]),
+                                 chunks=_arr4d_chunks(shape))
+
+
+def read_region(dset, mask, ts=slice(None)):
+    """
+    time series of voxels in mask from the 4D dataset dset (t, y, x, z),
+    the bounding box read at once, or voxel by voxel if mask is sparse in it.
+    return array in shape (t, n_voxels), voxels in order of `np.argwhere(mask)`
+
+    :mask: (numpy bool array) in shape (y, x, z)
+    :ts: (slice) time range.
+    """
+    idx = np.argwhere(mask)
+    assert len(idx) > 0, "empty mask"
+    lo, hi = idx.min(axis=0), idx.max(axis=0) + 1
+    if np.prod(hi - lo) > MAX_BOX_RATIO * len(idx):
+        return np.stack([dset[ts, y, x, z] for y, x, z in idx], axis=1)
+    box = tuple(slice(l, h) for l, h in zip(lo, hi))
+    block = dset[(ts,) + box] # (t, y, x, z)
+    return block[:, mask[box]]
+
 
 class Series(object):
     """
@@ -31,11 +72,18 @@ class Series(object):
             :image_dir: path to directory which store hdr image files.
             NOTE: Images name's character order must same to time sequence order.
             :time_interval: time interval between two images, unit: 1 second
+        or:
+            :nifti_path: path to a 4D NIfTI file (.nii/.nii.gz)
+            :time_interval: (optional) default use the TR in NIfTI header.
         """
         if not exists(hdf5_path):
-            image_dir = kwargs['image_dir']
-            time_interval = kwargs['time_interval']
-            cls.create_from_hdr(image_dir, hdf5_path, time_interval)
+            if 'nifti_path' in kwargs:
+                cls.create_from_nifti(kwargs['nifti_path'], hdf5_path,
+                                      kwargs.get('time_interval'))
+            else:
+                image_dir = kwargs['image_dir']
+                time_interval = kwargs['time_interval']
+                cls.create_from_hdr(image_dir, hdf5_path, time_interval)
         return super(Series, cls).__new__(cls)
 
     def __init__(self, hdf5_path, cachedir=CACHE, *args, **kwargs):
@@ -44,8 +92,10 @@ class Series(object):
 
         :hdf5_path: path to related hdf5 file.
         :cachedir: path to cache directory, default current dir.
+        :mode: ('r+'/'r') keyword only, default 'r+',
+            'r' for jobs only read the file (e.g. shards, see `simucaller.shard`).
         """
-        self.h5dict = File(hdf5_path, 'r+')
+        self.h5dict = File(hdf5_path, kwargs.get('mode', 'r+'))
         for k, v in self.h5dict.attrs.items():
             setattr(self, k, v)
 
@@ -65,12 +115,20 @@ class Series(object):
                 self.h5dict.attrs[attr] = getattr(self, attr)
         self.h5dict.flush()
 
+    def _series_cachedir(self):
+        """
+        cache directory of this series under self.cachedir,
+        one per hdf5 file, so clearing it keep the cache of other series.
+        """
+        path = abspath(self.h5dict.filename).encode('utf-8')
+        return join(self.cachedir, 'series_' + hashlib.sha1(path).hexdigest()[:16])
+
     def _memoize(self, func, verbose=0):
         '''
         helper method for memory cache.
         '''
         if not hasattr(self, '_mymem'):
-            self._mymem = joblib.Memory(cachedir=self.cachedir)
+            self._mymem = joblib.Memory(cachedir=self._series_cachedir())
 
         memoized_func = self._mymem.cache(func, verbose=verbose)
         memoized_func.__doc__ = func.__doc__
@@ -93,6 +151,95 @@ class Series(object):
         self.get_series = self._memoize(self._get_series)
         return self.get_series(*args, **kwargs)
 
+    def _get_series2d(self, k, axis='xy'):
+        """
+        return time series of all pixels in a 2d plane,
+        read along the time axis at once.
+        the return array in shape (t, d1, d2), like `get_arr2d` with time axis.
+
+        :k: (int) index of another dimension, e.g. axis == 'xy', k will means index of 'z' axis
+        :axis: (str) the axis of 2d plane. like: 'xy'(default), 'yz', 'xz'
+        """
+        assert axis in ('xy', 'yz', 'xz')
+        if hasattr(self, 'start') and hasattr(self, 'end'):
+            ts = slice(self.start, self.end)
+        else:
+            ts = slice(None)
+        dset = self.h5dict['arr4d'] # (t, y, x, z)
+        if axis == 'xy':
+            arr = dset[ts, :, :, k]
+        elif axis == 'yz':
+            arr = dset[ts, :, k, :]
+        else: # 'xz'
+            arr = dset[ts, k, :, :]
+        return arr
+
+    def get_series2d(self, *args, **kwargs):
+        """ cached method, cache mothod at first run """
+        self.get_series2d = self._memoize(self._get_series2d)
+        return self.get_series2d(*args, **kwargs)
+
+    def get_region_series(self, mask):
+        """
+        return time series of all voxels in mask, see `read_region`.
+        return array in shape (t, n_voxels), voxels in order of `np.argwhere(mask)`
+
+        :mask: (numpy bool array) in shape (y, x, z)
+        """
+        mask = np.asarray(mask, dtype=bool)
+        assert mask.shape == tuple(self.shape[1:]), \
+            "mask expect in shape {} but get shape {}".format(
+                tuple(self.shape[1:]), mask.shape)
+        if hasattr(self, 'start') and hasattr(self, 'end'):
+            ts = slice(self.start, self.end)
+        else:
+            ts = slice(None)
+        return read_region(self.h5dict['arr4d'], mask, ts)
+
+    def get_roi_series(self, mask, reduce='mean'):
+        """
+        return the region average time series of voxels in mask.
+
+        :mask: (numpy bool array) in shape (y, x, z)
+        :reduce: ('mean'/'median')
+        """
+        assert reduce in ('mean', 'median')
+        arr = self.get_region_series(mask)
+        return getattr(np, reduce)(arr, axis=1)
+
+    def save_roi(self, name, mask):
+        """
+        Save ROI mask to related hdf5 file, overwrite the ROI with same name.
+
+        :name: (str) ROI name
+        :mask: (numpy bool array) in shape (y, x, z)
+
+        save path:
+            self.h5dict -> roi/<name>
+        """
+        path = "roi/{}".format(name)
+        if path in self.h5dict:
+            del self.h5dict[path]
+        self.h5dict.create_dataset(path, data=np.asarray(mask, dtype=bool))
+        self.h5dict.flush()
+        log.info("ROI saved to path: {}".format(path))
+
+    def list_roi(self):
+        """
+        list all saved ROI names.
+        """
+        if 'roi' not in self.h5dict:
+            return []
+        return list(self.h5dict['roi'].keys())
+
+    def get_roi(self, name):
+        """
+        Load ROI mask from hdf5 file.
+
+        :name: (str) ROI name
+        """
+        return self.h5dict['roi'][name][...]
+
     def _get_arr3d(self, t):
         """
         return the 3d(y, x, z) array at the time point t.
@@ -170,50 +317,171 @@ class Series(object):
             assert start < end
         self.simu_intervals = intervals        
 
-    def call_simu(self, algorithm, name, *args, **kwargs):
+    def build_moment_index(self, block_size=8):
         """
-        Call simulation region, store result in the dict: self.simu_results
+        Build per-voxel moment index (cumulative sums of values, squares
+        and first differences), stored in related hdf5 file.
+        After that, `ttest` and `diff_ttest` with new intervals or break points
+        evaluated from the index without pass over the time axis.
 
-        :algorithm: the name of simulation calling method
-        :name: (str) the name of this result
+        :block_size: (int) how many y slices processed at once.
         """
-        log.info("call simulation region using {} algorithm".format(algorithm))
         calling = importlib.import_module('simucaller.call_simu')
+        calling.build_moment_index(self, block_size=block_size)
+
+    def smooth(self, fwhm, name=None, batch_size=16, processes=None, **kwargs):
+        """
+        Gaussian spatial smoothing, written to a derived dataset,
+        return its path, pass it to `call_simu` as `dataset` to analyse it.
+        see `simucaller.smoothing.smooth_series`
+
+        :fwhm: (float/tuple) FWHM of all axes or (y, x, z) axes, unit: voxel
+        :name: (str/None) derived dataset name.
+        :batch_size: (int) how many time frames smoothed at once.
+        :processes: (int/None) number of worker processes, None for serial.
+        """
+        smoothing = importlib.import_module('simucaller.smoothing')
+        return smoothing.smooth_series(self, fwhm, name=name, batch_size=batch_size,
+                                       processes=processes, **kwargs)
+
+    def data_fingerprint(self, dataset='arr4d'):
+        """
+        fingerprint of a 4D dataset, see `simucaller.fingerprint.data_fingerprint`,
+        kept in memory until images appended.
+
+        :dataset: (str) 'arr4d' or a derived dataset.
+        """
+        nt = int(self.h5dict[dataset].shape[0])
+        if not hasattr(self, '_data_fingerprints'):
+            self._data_fingerprints = {}
+        cached = self._data_fingerprints.get(dataset)
+        if cached is None or cached[0] != nt:
+            fingerprint = importlib.import_module('simucaller.fingerprint')
+            cached = (nt, fingerprint.data_fingerprint(self.h5dict[dataset]))
+            self._data_fingerprints[dataset] = cached
+        return cached[1]
+
+    def call_simu(self, algorithm, name, force=False, **kwargs):
+        """
+        Call simulation region, store result in the dict: self.simu_results,
+        return the result.
+
+        If a result with the same fingerprint (algorithm, parameters and data,
+        see `simucaller.fingerprint`) is saved, load it instead of recompute.
+
+        :algorithm: the name of registered algorithm, see `simucaller.registry`
+        :name: (str) the name of this result
+        :force: (bool) recompute even a matching result is saved.
+        :kwargs: algorithm parameters and engine options,
+            see `simucaller.engine.run_algorithm`
+        """
+        engine = importlib.import_module('simucaller.engine')
+        fingerprint = importlib.import_module('simucaller.fingerprint')
+        params, key = fingerprint.result_fingerprint(self, algorithm, **kwargs)
+        saved = None if force else self.find_simu_result(key)
+        if saved is not None:
+            log.info("{}/{}: same result saved as {}, load it".format(
+                algorithm, name, saved))
+            # stored as float32, return in the dtype a computed result has
+            result = self.h5dict['simulation_region_call'][saved][...].astype(
+                engine._result_dtype(kwargs.get('dtype')))
+            engine._report_whole(result, kwargs.get('progress'))
+        else:
+            log.info("call simulation region using {} algorithm".format(algorithm))
+            result = engine.run_algorithm(algorithm, self, **kwargs)
         if not hasattr(self, 'simu_results'):
             self.simu_results = {}
-        alg = getattr(calling, algorithm)
-        result = alg(self, *args, **kwargs)
+        if not hasattr(self, 'simu_meta'):
+            self.simu_meta = {}
         self.simu_results.setdefault(algorithm, {})
         self.simu_results[algorithm][name] = result
+        self.simu_meta["%s/%s"%(algorithm, name)] = \
+            {'fingerprint': key, 'params': params}
+        return result
 
-    def list_simu_result(self):
+    def list_simu_result(self, params=False):
         """
         list all simulation region call result.
+
+        :params: (bool) if True, return (result, params) pairs,
+            params is the dict of parameters recorded by `call_simu`, or None.
         """
+        if 'simulation_region_call' not in self.h5dict:
+            return []
+        group = self.h5dict['simulation_region_call']
         res_list = [
             "%s/%s"%(alg_name, name)
-                for alg_name, alg_group in self.h5dict['simulation_region_call'].items()
+                for alg_name, alg_group in group.items()
                     for name, _ in alg_group.items()
         ]
+        if params:
+            res_list = [(res, json.loads(group[res].attrs['params'])
+                         if 'params' in group[res].attrs else None)
+                        for res in res_list]
         return res_list
 
-    def save_simu_result(self, algorithm, name):
+    def find_simu_result(self, fingerprint):
+        """
+        find saved result with the fingerprint, return its name or None.
+
+        :fingerprint: (str) see `simucaller.fingerprint.result_fingerprint`
         """
-        Save simulation region call result to related hdf5 file.
+        if 'simulation_region_call' not in self.h5dict:
+            return None
+        group = self.h5dict['simulation_region_call']
+        for res in self.list_simu_result():
+            if group[res].attrs.get('fingerprint') == fingerprint:
+                return res
+        return None
+
+    def save_simu_result(self, algorithm, name, overwrite=False):
+        """
+        Save simulation region call result to related hdf5 file,
+        with the fingerprint and parameters in attributes if called by `call_simu`.
+        A result same to a saved one is stored as a hard link, not a copy.
 
         :algorithm: (str) name of algorithm
         :name: (name) the name of result dataset
+        :overwrite: (bool) replace a different result saved with the same name.
 
         save path:
             self.h5dict -> simulation_region_call/<algorithm>/<name>
         """
         path = "simulation_region_call/{}/{}".format(algorithm, name)
         result = self.simu_results[algorithm][name]
+        meta = getattr(self, 'simu_meta', {}).get("%s/%s"%(algorithm, name))
         log.info("saving simulation call result to path: {}".format(path))
-        self.h5dict.create_dataset(path, shape=result.shape)
-        log.debug(result.shape)
-        log.debug(type(result))
-        self.h5dict[path][...] = result
+        if path in self.h5dict:
+            if meta and self.h5dict[path].attrs.get('fingerprint') == meta['fingerprint']:
+                log.info("same result already saved as {}".format(path))
+                return
+            assert overwrite, \
+                "result {} exists, save with overwrite=True to replace it".format(path)
+            log.warning("result {} exists, overwrite it".format(path))
+            del self.h5dict[path]
+        # result written to the file block by block, see `engine.run_algorithm`
+        scratch = isinstance(result, Dataset) and result.file == self.h5dict.file
+        saved = self.find_simu_result(meta['fingerprint']) if meta else None
+        if saved is not None:
+            log.info("same to result {}, link to it".format(saved))
+            self.h5dict[path] = self.h5dict['simulation_region_call'][saved]
+            if scratch:
+                del self.h5dict[result.name]
+                self.simu_results[algorithm][name] = self.h5dict[path]
+            self.h5dict.flush()
+            return
+        if scratch:
+            self.h5dict.require_group("simulation_region_call/{}".format(algorithm))
+            self.h5dict.move(result.name, path)
+            result = self.simu_results[algorithm][name] = self.h5dict[path]
+        else:
+            self.h5dict.create_dataset(path, shape=result.shape)
+            log.debug(result.shape)
+            log.debug(type(result))
+            self.h5dict[path][...] = result
+        if meta:
+            self.h5dict[path].attrs['fingerprint'] = meta['fingerprint']
+            self.h5dict[path].attrs['params'] = meta['params']
         self.h5dict.flush()
 
     def get_simu_result(self, algorithm, name):
@@ -234,11 +502,9 @@ class Series(object):
 
         :time_interval: time interval between two images, unit: 1 second
         """
-        img_files = [i for i in listdir(image_dir) if i.endswith('.hdr')]
-        img_files.sort(key=lambda i: i.split('.')[0])
-        img_files = [join(image_dir, i) for i in img_files]
+        img_files = cls._list_hdr(image_dir)
 
-        load_img = lambda f: nib.load(f).get_data()
+        load_img = lambda f: np.asanyarray(nib.load(f).dataobj)
         log.info("loading hdr images ...")
         imgs = [load_img(i) for i in img_files]
         n_images = len(imgs)
@@ -259,9 +525,10 @@ class Series(object):
         # store data
         h5dict = File(hdf5_path, 'w')
         log.info("hdf5 file created at {}".format(hdf5_path))
-        h5dict.create_dataset('arr4d', shape=arr4d.shape)
+        _create_arr4d(h5dict, arr4d.shape)
         h5dict['arr4d'][...] = arr4d
         log.info("time series dataset shape {}".format(arr4d.shape))
+        cls._add_source_files(h5dict, [basename(f) for f in img_files])
 
         # store meta data
         h5dict.attrs['n_images'] = n_images
@@ -271,5 +538,179 @@ class Series(object):
         h5dict.close() # close hdf5 file
         log.info("Series hdf5 file creating process finished")
 
+    @classmethod
+    def create_from_nifti(cls, nifti_path, hdf5_path, time_interval=None,
+                          batch_size=16):
+        """
+        Create hdf5 file from a 4D NIfTI file, in shape (y, x, z, t).
+        Images read through nibabel's dataobj proxy batch by batch,
+        the whole 4D array never loaded into memory.
+
+        :nifti_path: path to .nii/.nii.gz file.
+        :hdf5_path: path to the hdf5 file to create.
+        :time_interval: time interval between two images, unit: 1 second,
+            default use the TR (pixdim[4]) in NIfTI header.
+        :batch_size: (int) how many images read at once.
+
+        Store the affine and voxel size of images
+        in h5dict.attrs['affine'] and h5dict.attrs['voxel_size'].
+        """
+        img = nib.load(nifti_path)
+        assert len(img.shape) == 4, \
+            "Expect 4D NIfTI image but get shape {}".format(img.shape)
+        y, x, z, n_images = img.shape
+        zooms = img.header.get_zooms()
+        if time_interval is None:
+            time_unit = img.header.get_xyzt_units()[1]
+            scale = {'msec': 1e-3, 'usec': 1e-6}.get(time_unit, 1.0)
+            time_interval = float(zooms[3]) * scale
+            if time_interval <= 0:
+                raise ValueError("NIfTI header has no TR, "
+                                 "please give the time_interval")
+            log.info("TR from NIfTI header: {}s".format(time_interval))
+
+        h5dict = File(hdf5_path, 'w')
+        log.info("hdf5 file created at {}".format(hdf5_path))
+        shape = (n_images, y, x, z)
+        dset = _create_arr4d(h5dict, shape)
+        log.info("loading NIfTI images from {} ...".format(nifti_path))
+        for t0 in range(0, n_images, batch_size):
+            t1 = min(t0 + batch_size, n_images)
+            batch = np.asarray(img.dataobj[..., t0:t1], dtype='f4')
+            dset[t0:t1] = np.moveaxis(batch, -1, 0)
+            log.debug("images {}-{} loaded".format(t0, t1))
+        log.info("time series dataset shape {}".format(shape))
+
+        # store meta data
+        h5dict.attrs['n_images'] = n_images
+        h5dict.attrs['shape'] = shape
+        h5dict.attrs['time_interval'] = float(time_interval)
+        h5dict.attrs['affine'] = img.affine
+        h5dict.attrs['voxel_size'] = np.asarray(zooms[:3], dtype=np.float64)
+        log.info("time interval: {}s".format(time_interval))
+        h5dict.close()
+        log.info("Series hdf5 file creating process finished")
+
+    @staticmethod
+    def _list_hdr(image_dir):
+        """
+        list hdr image files in image_dir, in time sequence order.
+        """
+        img_files = [i for i in listdir(image_dir) if i.endswith('.hdr')]
+        img_files.sort(key=lambda i: i.split('.')[0])
+        return [join(image_dir, i) for i in img_files]
+
+    @staticmethod
+    def _add_source_files(h5dict, names):
+        """
+        record names of ingested image files in dataset 'source_files'.
+        """
+        if 'source_files' not in h5dict:
+            h5dict.create_dataset('source_files', shape=(0,), maxshape=(None,),
+                                  dtype=special_dtype(vlen=str), chunks=True)
+        dset = h5dict['source_files']
+        n = dset.shape[0]
+        dset.resize(n + len(names), axis=0)
+        dset[n:] = names
+
+    def _source_files(self, img_files):
+        """
+        names of ingested image files. For files created without the record,
+        the first n_images files of img_files are considered ingested.
+        """
+        if 'source_files' in self.h5dict:
+            names = self.h5dict['source_files'][...]
+            return set(n.decode() if isinstance(n, bytes) else n for n in names)
+        return set(basename(f) for f in img_files[:self.n_images])
+
+    def _ensure_resizable(self):
+        """
+        make arr4d resizable along the time axis,
+        datasets of old files are copied to a chunked one (only once).
+        """
+        dset = self.h5dict['arr4d']
+        if dset.maxshape[0] is None:
+            return
+        log.warning("arr4d is not resizable, copy it to a chunked dataset ...")
+        self.h5dict.move('arr4d', 'arr4d_fixed')
+        old = self.h5dict['arr4d_fixed']
+        new = _create_arr4d(self.h5dict, old.shape, old.dtype)
+        for y0 in range(0, old.shape[1], 8):
+            new[:, y0:y0+8] = old[:, y0:y0+8]
+        del self.h5dict['arr4d_fixed']
+
+    def append_images(self, image_dir, block_size=8):
+        """
+        Append new hdr images in image_dir to the series,
+        images already ingested are skipped, existing data is not rewritten.
+        n_images/shape attributes and the moment index (if built) are updated.
+        return the number of appended images.
+
+        :image_dir: path to directory which store hdr image files.
+        :block_size: (int) how many y slices processed at once
+            when extend the moment index.
+        """
+        img_files = self._list_hdr(image_dir)
+        ingested = self._source_files(img_files)
+        new_files = [f for f in img_files if basename(f) not in ingested]
+        if not new_files:
+            log.info("no new images in {}".format(image_dir))
+            return 0
+
+        log.info("appending {} images ...".format(len(new_files)))
+        shape = tuple(self.shape[1:])
+        volumes = []
+        for f in new_files:
+            img = np.asanyarray(nib.load(f).dataobj)
+            assert img.shape == shape, \
+                "Image {} expect in shape {} but get shape {}".format(
+                    f, shape, img.shape)
+            volumes.append(img)
+        n = self.append_volumes(volumes, block_size=block_size)
+        if 'source_files' not in self.h5dict:
+            self._add_source_files(self.h5dict, sorted(ingested))
+        self._add_source_files(self.h5dict, [basename(f) for f in new_files])
+        self.h5dict.flush()
+        return n
+
+    def append_volumes(self, volumes, block_size=8):
+        """
+        Append 3d arrays (y, x, z) to the series, existing data is not rewritten.
+        n_images/shape attributes and the moment index (if built) are updated.
+        return the number of appended volumes.
+
+        :volumes: (list/numpy array) 3d arrays in time order.
+        :block_size: (int) how many y slices processed at once
+            when extend the moment index.
+        """
+        self._ensure_resizable()
+        dset = self.h5dict['arr4d']
+        shape = dset.shape[1:]
+        # validate all before resize, never leave a half extended arr4d
+        for vol in volumes:
+            assert np.shape(vol) == shape, \
+                "volume expect in shape {} but get shape {}".format(
+                    shape, np.shape(vol))
+        t0 = dset.shape[0]
+        dset.resize(t0 + len(volumes), axis=0)
+        for i, vol in enumerate(volumes):
+            dset[t0 + i] = vol
+
+        # update meta data
+        self.h5dict.attrs['n_images'] = dset.shape[0]
+        self.h5dict.attrs['shape'] = dset.shape
+        self.n_images = self.h5dict.attrs['n_images']
+        self.shape = self.h5dict.attrs['shape']
+        self.h5dict.flush()
+        if hasattr(self, '_mymem'):
+            # time series of this series changed, other series keep their cache
+            self._mymem.clear(warn=False)
+            log.info("memory cache of {} clear".format(self.h5dict.filename))
+
+        calling = importlib.import_module('simucaller.call_simu')
+        calling.extend_moment_index(self, t0, block_size=block_size)
+        log.info("series extended to {} images".format(self.n_images))
+        return len(volumes)
+
     def __del__(self):
         self.h5dict.close()
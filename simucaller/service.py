@@ -0,0 +1,663 @@
+"""
+Local analysis service, share one in-RAM copy of a Series between
+viewers, notebooks and jobs on the same workstation.
+
+The daemon (`SeriesService`) loads `arr4d` once into shared memory
+(`multiprocessing.shared_memory`) and serves requests over a local
+connection (unix socket or named pipe, `multiprocessing.connection`):
+
+* clients attach the shared memory block, so frames, time series and ROI
+    reads are plain numpy indexing, nothing copied through the connection.
+* analyses are evaluated by the daemon and cached there by fingerprint
+    (see `simucaller.fingerprint`), every client share the warm cache.
+* results, ROIs and attributes are written to the hdf5 file by the daemon.
+    The daemon opens the file only while answering a request, so other
+    read-only jobs (e.g. shards) can open it between requests.
+* analyses and smoothing send ('progress', Progress) messages after each
+    block before the reply, a client cancel them by sending ('cancel',)
+    while waiting, see `SeriesClient.request`.
+
+`SeriesClient` is a thin client look like `simucaller.series.Series`.
+
+Usage:
+
+    $ python -m simucaller serve data.h5
+
+    series = open_series('data.h5')  # client if served, else Series
+    series.get_arr3d(10)
+    series.call_simu('ttest', 'call_1')
+
+Sockets and the authkey live in a per-user directory (mode 0700, see
+`runtime_dir`), the authkey is random, created once per user, and clients
+only connect to sockets owned by the same user: other local users can
+neither connect to a service nor impersonate one.
+
+Need Python >= 3.8, `open_series` fall back to `Series` without it.
+"""
+
+import os
+import copy
+import stat
+import pickle
+import hashlib
+import tempfile
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener, Client
+
+import numpy as np
+from h5py import File
+
+from simucaller.helpers import get_logger
+from simucaller.series import Series, CACHE
+from simucaller import fingerprint
+from simucaller.engine import iter_blocks, _report_whole
+from simucaller.progress import CancelToken
+
+log = get_logger(__name__)
+
+try:
+    from multiprocessing import shared_memory
+    HAS_SHARED_MEMORY = True
+except ImportError:
+    HAS_SHARED_MEMORY = False
+
+# analysis results kept by the daemon
+CACHE_SIZE = 32
+
+# series attributes used by analyses, sent with each analysis request
+SERIES_ATTRS = ('break_points', 'simu_intervals', 'start', 'end')
+
+# requests forward their progress and accept cancel, see `_Forward`
+FORWARDED = ('call_simu', 'smooth')
+
+# how often a waiting client check its cancel token, unit: 1 second
+CANCEL_POLL = 0.1
+
+
+def _check_private(path, kind=None):
+    """
+    raise PermissionError if path is not owned by this user,
+    or (except sockets) accessible by others.
+
+    :kind: (function/None) like `stat.S_ISDIR`, expected file type.
+    """
+    if os.name == 'nt':
+        return
+    st = os.lstat(path)
+    if st.st_uid != os.getuid() or (kind is not None and not kind(st.st_mode)) or \
+            (not stat.S_ISSOCK(st.st_mode) and st.st_mode & 0o077):
+        raise PermissionError("{} is not private to this user".format(path))
+
+
+def runtime_dir():
+    """
+    per-user directory (mode 0700) of service sockets and the authkey,
+    in $XDG_RUNTIME_DIR if set, else the temp directory.
+    """
+    if os.environ.get('XDG_RUNTIME_DIR'):
+        path = os.path.join(os.environ['XDG_RUNTIME_DIR'], 'simucaller')
+    elif os.name == 'nt':
+        path = os.path.join(tempfile.gettempdir(), 'simucaller')
+    else:
+        path = os.path.join(tempfile.gettempdir(), 'simucaller-%d'%os.getuid())
+    try:
+        os.mkdir(path, 0o700)
+    except FileExistsError:
+        pass
+    _check_private(path, stat.S_ISDIR)
+    return path
+
+
+def default_authkey():
+    """
+    random authkey shared by this user's services and clients,
+    created once, stored in `runtime_dir` readable by this user only.
+    """
+    path = os.path.join(runtime_dir(), 'authkey')
+    if not os.path.exists(path):
+        # written aside then linked, never read half written
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as f:
+            f.write(os.urandom(32))
+        try:
+            os.link(tmp_path, path)
+        except FileExistsError:
+            pass # created by another process
+        finally:
+            os.remove(tmp_path)
+    _check_private(path, stat.S_ISREG)
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def service_address(hdf5_path):
+    """
+    default address of the service of a hdf5 file,
+    unix socket in `runtime_dir`, or named pipe on Windows.
+    """
+    key = hashlib.sha1(os.path.abspath(hdf5_path).encode('utf-8')).hexdigest()[:12]
+    if os.name == 'nt':
+        return r'\\.\pipe\simucaller-%s'%key
+    return os.path.join(runtime_dir(), 'simucaller-%s.sock'%key)
+
+
+def is_serving(address, authkey=None):
+    """
+    check a service of this user is listening on the address.
+
+    :authkey: (bytes/None) default `default_authkey()`
+    """
+    if os.name != 'nt':
+        if not os.path.exists(address):
+            return False
+        try:
+            _check_private(address, stat.S_ISSOCK)
+        except PermissionError as e:
+            log.warning("{}, not connected".format(e))
+            return False
+    try:
+        conn = Client(address, authkey=authkey or default_authkey())
+    except (OSError, EOFError, AuthenticationError):
+        return False
+    conn.close()
+    return True
+
+
+def open_series(hdf5_path, cachedir=CACHE, mode='r+', served=True):
+    """
+    open hdf5_path through its service if served, else as `Series`.
+
+    :mode: ('r+'/'r') mode of `Series` when not served.
+    :served: (bool) False for jobs change arr4d (e.g. append images),
+        arr4d shared by the service can not be resized, fail if served.
+    """
+    if HAS_SHARED_MEMORY and is_serving(service_address(hdf5_path)):
+        assert served, "{} is served, shutdown the service to change arr4d, " \
+            "then serve it again".format(hdf5_path)
+        log.info("{} is served, connect to the service".format(hdf5_path))
+        return SeriesClient(hdf5_path)
+    return Series(hdf5_path, cachedir=cachedir, mode=mode)
+
+
+def _attach(name):
+    """
+    attach an existing shared memory block,
+    without register it to this process's resource tracker,
+    or the block unlinked when the client exit (Python < 3.13).
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        shm = shared_memory.SharedMemory(name=name)
+        if os.name != 'nt':
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
+
+
+class _Forward(object):
+    """
+    progress callback of a request in the daemon, send each Progress to the
+    client, and set the cancel token once the client sent ('cancel',).
+    """
+    def __init__(self, conn):
+        self.conn = conn
+        self.cancel = CancelToken()
+
+    def __call__(self, progress):
+        self.conn.send(('progress', progress))
+        # the client hold its connection while waiting, only cancel is sent
+        while self.conn.poll():
+            command = self.conn.recv()[0]
+            if command == 'cancel':
+                self.cancel.cancel()
+
+
+class _Overlay(object):
+    """
+    hdf5 file with datasets replaced by in-memory arrays,
+    other keys and methods passed to the file, opened by `SeriesService`
+    only while answering a request (None between requests).
+    """
+    def __init__(self, h5dict, arrays):
+        self._h5dict = h5dict
+        self._arrays = arrays
+
+    def _file(self):
+        assert self._h5dict is not None, "hdf5 file not opened by the service"
+        return self._h5dict
+
+    def __getitem__(self, key):
+        if key in self._arrays:
+            return self._arrays[key]
+        return self._file()[key]
+
+    def __setitem__(self, key, value):
+        self._file()[key] = value
+
+    def __contains__(self, key):
+        return key in self._arrays or key in self._file()
+
+    def __delitem__(self, key):
+        del self._file()[key]
+
+    def __getattr__(self, name):
+        return getattr(self._file(), name)
+
+    def close(self):
+        if self._h5dict is not None:
+            self._h5dict.close()
+            self._h5dict = None
+
+
+class SeriesService(object):
+    """
+    Daemon serve one Series from shared memory, see module doc.
+    """
+    def __init__(self, hdf5_path, address=None, authkey=None,
+                 cachedir=CACHE, block_size=8):
+        """
+        :hdf5_path: path to Series hdf5 file.
+        :address: (str/None) unix socket path or pipe name,
+            default `service_address(hdf5_path)`.
+        :authkey: (bytes/None) shared by the service and its clients,
+            default `default_authkey()`.
+        :cachedir: path to cache directory.
+        :block_size: (int) how many y slices read at once when loading.
+        """
+        assert HAS_SHARED_MEMORY, "the service need Python >= 3.8"
+        self.hdf5_path = hdf5_path
+        self.address = address or service_address(hdf5_path)
+        self.authkey = authkey or default_authkey()
+        self.lock = threading.Lock()
+        self.cache = OrderedDict()
+        self.series = Series(hdf5_path, cachedir=cachedir)
+        self.load(block_size)
+        if os.name != 'nt' and os.path.exists(self.address):
+            assert not is_serving(self.address, self.authkey), \
+                "{} is already served at {}".format(hdf5_path, self.address)
+            os.remove(self.address) # stale socket of a dead service
+        self.listener = Listener(self.address, authkey=self.authkey)
+        log.info("serving {} at {}".format(hdf5_path, self.address))
+
+    def load(self, block_size=8):
+        """
+        copy arr4d into a new shared memory block,
+        then close the file, reopened by each request (see `_file`).
+        """
+        dset = self.series.h5dict['arr4d']
+        shape, dtype = tuple(int(n) for n in dset.shape), np.dtype(dset.dtype)
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        log.info("loading arr4d into shared memory, {:.1f} MB".format(
+            nbytes / 1024.0 ** 2))
+        self.shm = shared_memory.SharedMemory(create=True, size=max(nbytes, 1))
+        self.arr4d = np.ndarray(shape, dtype=dtype, buffer=self.shm.buf)
+        for ys, block in iter_blocks(self.series, block_size):
+            self.arr4d[:, ys] = block
+        # hashed from the file, kept by the series
+        self.series.data_fingerprint()
+        self.series.h5dict.close()
+        self.series.h5dict = _Overlay(None, {'arr4d': self.arr4d})
+        # data in memory, the disk cache of readers not needed
+        self.series._memoize = lambda func, verbose=0: func
+
+    def serve_forever(self):
+        """ accept clients, each client served in its own thread. """
+        self.running = True
+        while self.running:
+            try:
+                conn = self.listener.accept()
+            except (OSError, EOFError, AuthenticationError):
+                if not self.running:
+                    break
+                continue
+            thread = threading.Thread(target=self.handle, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def handle(self, conn):
+        """ answer requests of one client until it disconnect. """
+        while True:
+            try:
+                command, args, kwargs = conn.recv()
+            except (EOFError, OSError):
+                break
+            if command == 'cancel':
+                # sent after its request finished, nothing to cancel
+                continue
+            if command in FORWARDED:
+                kwargs = dict(kwargs, forward=_Forward(conn))
+            try:
+                reply = ('ok', getattr(self, 'do_' + command)(*args, **kwargs))
+            except Exception as e:
+                log.error("request {} failed: {}".format(command, e))
+                reply = ('error', e)
+            try:
+                conn.send(reply)
+            except (OSError, pickle.PicklingError) as e:
+                conn.send(('error', RuntimeError(str(e))))
+            if command == 'shutdown':
+                # replied, wake up the blocking accept
+                Client(self.address, authkey=self.authkey).close()
+                break
+        conn.close()
+
+    def close(self):
+        """ stop listening, release the shared memory. """
+        self.running = False
+        self.listener.close()
+        del self.arr4d
+        self.shm.close()
+        self.shm.unlink()
+        log.info("service at {} closed".format(self.address))
+
+    @contextmanager
+    def _file(self, mode='r'):
+        """
+        open the hdf5 file under the overlay while answering a request,
+        so the file is not locked between requests.
+
+        :mode: ('r'/'r+') 'r+' for requests write the file.
+        """
+        with self.lock:
+            self.series.h5dict._h5dict = File(self.hdf5_path, mode)
+            try:
+                yield self.series
+            finally:
+                self.series.h5dict.close()
+
+    def _set_attrs(self, attrs):
+        for attr in SERIES_ATTRS:
+            if attr in attrs:
+                setattr(self.series, attr, attrs[attr])
+            elif hasattr(self.series, attr):
+                delattr(self.series, attr)
+
+    # requests
+
+    def do_info(self):
+        with self._file():
+            attrs = dict(self.series.h5dict.attrs.items())
+        return {'shm_name': self.shm.name, 'shape': self.arr4d.shape,
+                'dtype': self.arr4d.dtype.str, 'attrs': attrs}
+
+    def do_contains(self, key):
+        with self._file():
+            return key in self.series.h5dict
+
+    def do_read(self, index):
+        return self.arr4d[index]
+
+    def do_call_simu(self, algorithm, attrs, kwargs, force=False, forward=None):
+        """
+        `Series.call_simu` with the client's series attributes,
+        results kept in memory by fingerprint, return (result, meta) pair.
+        """
+        if forward is not None:
+            kwargs = dict(kwargs, progress=forward, cancel=forward.cancel)
+        with self._file():
+            self._set_attrs(attrs)
+            params, key = fingerprint.result_fingerprint(
+                self.series, algorithm, **kwargs)
+            meta = {'fingerprint': key, 'params': params}
+            if key in self.cache and not force:
+                log.info("{}: cached result".format(algorithm))
+                self.cache.move_to_end(key)
+                return self.cache[key], meta
+            result = self.series.call_simu(algorithm, key, force=force, **kwargs)
+            self.series.simu_results, self.series.simu_meta = {}, {}
+            self.cache[key] = result
+            while len(self.cache) > CACHE_SIZE:
+                self.cache.popitem(last=False)
+        return result, meta
+
+    def do_save_simu_result(self, algorithm, name, result, meta=None,
+                            overwrite=False):
+        with self._file('r+'):
+            self.series.simu_results = {algorithm: {name: result}}
+            self.series.simu_meta = {"%s/%s"%(algorithm, name): meta} if meta else {}
+            self.series.save_simu_result(algorithm, name, overwrite)
+
+    def do_list_simu_result(self, params=False):
+        with self._file():
+            return self.series.list_simu_result(params)
+
+    def do_get_simu_result(self, algorithm, name):
+        with self._file():
+            return self.series.get_simu_result(algorithm, name)
+
+    def do_save_roi(self, name, mask):
+        with self._file('r+'):
+            self.series.save_roi(name, mask)
+
+    def do_list_roi(self):
+        with self._file():
+            return self.series.list_roi()
+
+    def do_get_roi(self, name):
+        with self._file():
+            return self.series.get_roi(name)
+
+    def do_save_attr(self, attrs):
+        with self._file('r+'):
+            self._set_attrs(attrs)
+            self.series.save_attr()
+
+    def do_build_moment_index(self, block_size=8):
+        with self._file('r+'):
+            self.series.build_moment_index(block_size)
+
+    def do_data_fingerprint(self, dataset='arr4d'):
+        with self._file():
+            return self.series.data_fingerprint(dataset)
+
+    def do_smooth(self, fwhm, name=None, batch_size=16, processes=None,
+                  forward=None):
+        kwargs = {}
+        if forward is not None:
+            kwargs = {'progress': forward, 'cancel': forward.cancel}
+        with self._file('r+'):
+            return self.series.smooth(fwhm, name=name, batch_size=batch_size,
+                                      processes=processes, **kwargs)
+
+    def do_shutdown(self):
+        """
+        stop `serve_forever` once replied (see `handle`),
+        the caller should `close` the service.
+        """
+        self.running = False
+
+
+class _RemoteDataset(object):
+    """ arr4d read through the connection, when shared memory not attached. """
+    def __init__(self, client, shape, dtype):
+        self.client = client
+        self.shape = shape
+        self.dtype = dtype
+
+    def __getitem__(self, index):
+        return self.client.request('read', index)
+
+
+class _ClientH5(object):
+    """ h5dict of `SeriesClient`, only arr4d readable. """
+    def __init__(self, client, arr4d):
+        self.client = client
+        self.arr4d = arr4d
+
+    def __getitem__(self, key):
+        if key == 'arr4d':
+            return self.arr4d
+        raise KeyError("{} not readable through the service".format(key))
+
+    def __contains__(self, key):
+        return key == 'arr4d' or self.client.request('contains', key)
+
+    def close(self):
+        self.client.close()
+
+
+class SeriesClient(Series):
+    """
+    Series-like thin client of `SeriesService`.
+
+    Readers (`get_arr3d`, `get_series`, `get_region_series` ...) read the
+    shared memory directly, analyses, results and ROIs go through the service.
+    `progress` and `cancel` of analyses and smoothing are forwarded
+    to the service block by block.
+    arr4d can not be appended while served, see `open_series`.
+    """
+    def __new__(cls, *args, **kwargs):
+        return object.__new__(cls)
+
+    def __init__(self, hdf5_path=None, address=None, authkey=None, attach=True):
+        """
+        :hdf5_path: path to the served hdf5 file, used to find the address.
+        :address: (str/None) service address, default `service_address(hdf5_path)`.
+        :authkey: (bytes/None) same to the service, default `default_authkey()`.
+        :attach: (bool) attach the shared memory, else read arr4d
+            through the connection (slower, e.g. shared memory not permitted).
+        """
+        assert hdf5_path or address, "need hdf5_path or address"
+        self.address = address or service_address(hdf5_path)
+        _check_private(self.address, stat.S_ISSOCK)
+        self.conn = Client(self.address, authkey=authkey or default_authkey())
+        self.conn_lock = threading.Lock()
+        info = self.request('info')
+        for k, v in info['attrs'].items():
+            setattr(self, k, v)
+        if attach:
+            self.shm = _attach(info['shm_name'])
+            arr4d = np.ndarray(info['shape'], dtype=info['dtype'], buffer=self.shm.buf)
+            arr4d.flags.writeable = False
+        else:
+            arr4d = _RemoteDataset(self, info['shape'], np.dtype(info['dtype']))
+        self.h5dict = _ClientH5(self, arr4d)
+
+    def request(self, command, *args, **kwargs):
+        """ send a request to the service, return its reply. """
+        return self._request(command, args, kwargs)
+
+    def _request(self, command, args, kwargs, progress=None, cancel=None):
+        """
+        send a request to the service, return its reply.
+        Progress sent by the service before the reply passed to progress,
+        cancel checked while waiting, sent to the service once cancelled.
+        """
+        cancel_sent = cancel is None
+        with self.conn_lock:
+            self.conn.send((command, args, kwargs))
+            while True:
+                if not cancel_sent:
+                    while not self.conn.poll(CANCEL_POLL) and not cancel.cancelled:
+                        pass
+                    if cancel.cancelled:
+                        self.conn.send(('cancel', (), {}))
+                        cancel_sent = True
+                        continue
+                status, value = self.conn.recv()
+                if status != 'progress':
+                    break
+                if progress is not None:
+                    progress(value)
+        if status == 'error':
+            raise value
+        return value
+
+    def close(self):
+        if getattr(self, 'conn', None) is not None:
+            self.conn.close()
+            self.conn = None
+        if hasattr(self, 'shm'):
+            self.h5dict.arr4d = None
+            self.shm.close()
+            del self.shm
+
+    def __del__(self):
+        self.close()
+
+    def _memoize(self, func, verbose=0):
+        """ data in shared memory, no disk cache. """
+        return func
+
+    def _attrs(self):
+        return {a: copy.deepcopy(getattr(self, a))
+                for a in SERIES_ATTRS if hasattr(self, a)}
+
+    def call_simu(self, algorithm, name, force=False, progress=None,
+                  cancel=None, **kwargs):
+        """
+        Call simulation region in the service, see `Series.call_simu`.
+        """
+        if cancel is not None:
+            cancel.check()
+        reported = []
+        def forward(p):
+            reported.append(True)
+            if progress is not None:
+                progress(p)
+        result, meta = self._request(
+            'call_simu', (algorithm, self._attrs(), kwargs), {'force': force},
+            forward, cancel)
+        if not reported: # cached by the service
+            _report_whole(result, progress)
+        if not hasattr(self, 'simu_results'):
+            self.simu_results = {}
+        if not hasattr(self, 'simu_meta'):
+            self.simu_meta = {}
+        self.simu_results.setdefault(algorithm, {})[name] = result
+        self.simu_meta["%s/%s"%(algorithm, name)] = meta
+        return result
+
+    def save_simu_result(self, algorithm, name, overwrite=False):
+        self.request('save_simu_result', algorithm, name,
+                     self.simu_results[algorithm][name],
+                     getattr(self, 'simu_meta', {}).get("%s/%s"%(algorithm, name)),
+                     overwrite)
+
+    def list_simu_result(self, params=False):
+        return self.request('list_simu_result', params)
+
+    def get_simu_result(self, algorithm, name):
+        return self.request('get_simu_result', algorithm, name)
+
+    def save_roi(self, name, mask):
+        self.request('save_roi', name, np.asarray(mask, dtype=bool))
+
+    def list_roi(self):
+        return self.request('list_roi')
+
+    def get_roi(self, name):
+        return self.request('get_roi', name)
+
+    def save_attr(self):
+        self.request('save_attr', self._attrs())
+
+    def build_moment_index(self, block_size=8):
+        self.request('build_moment_index', block_size)
+
+    def data_fingerprint(self, dataset='arr4d'):
+        return self.request('data_fingerprint', dataset)
+
+    def smooth(self, fwhm, name=None, batch_size=16, processes=None,
+               progress=None, cancel=None):
+        """
+        Smooth in the service, see `Series.smooth`.
+        """
+        if cancel is not None:
+            cancel.check()
+        return self._request('smooth', (fwhm, name, batch_size, processes), {},
+                             progress, cancel)
+
+    def append_images(self, *args, **kwargs):
+        """
+        arr4d in shared memory can not be resized, shutdown the service,
+        then append images to the `Series` (`open_series(served=False)`).
+        """
+        raise RuntimeError("{} is served, shutdown the service to append images, "
+                           "then serve it again".format(self.address))
+
+    append_volumes = append_images
@@ -0,0 +1,257 @@
+"""
+Slab-sharded execution, spread one analysis over independent jobs
+(local processes, or machines share only a filesystem), no scheduler needed.
+
+The voxel grid is split into n_shards slabs along the y axis.
+Each shard is an independent job: it opens the Series read-only,
+evaluates its slab and writes a small shard file:
+
+    <out_dir>/<name>.shard-<k>-of-<n>.h5
+        result: output_shape + (slab_y, x, z)
+        attrs: algorithm, name, shard, n_shards, y_start, y_stop,
+            shape, fingerprint, dataset, data_fingerprint, params
+
+`merge_shards` validates the shard files (same analysis on the same data,
+slabs cover the grid exactly once) and store the assembled result in the
+Series, like `Series.call_simu` then `Series.save_simu_result`.
+
+Shards only read their slab: the data fingerprint (hashed over all frames)
+is stored in the hdf5 file once by `prepare_shards` before the jobs are
+handed out, or given to each job.
+
+Usage:
+
+    # once, hash the data and store its fingerprint
+    $ python -m simucaller prepare data.h5
+    # each job, k = 0 .. n-1, anywhere the files are reachable
+    $ python -m simucaller shard data.h5 ttest call_1 k n shards/
+    # after all jobs finished
+    $ python -m simucaller merge data.h5 ttest call_1 shards/
+
+or `run_sharded` on local processes.
+"""
+
+import os
+import glob
+import multiprocessing as mp
+
+import numpy as np
+from h5py import File
+
+from simucaller.helpers import get_logger
+from simucaller.series import Series, CACHE
+from simucaller.registry import get_algorithm
+from simucaller.engine import stream_algorithm
+from simucaller.fingerprint import result_fingerprint, stored_data_fingerprint
+
+log = get_logger(__name__)
+
+# engine options not used by shards
+_UNUSED_OPTIONS = ('use_index',)
+
+
+def slab(ny, shard, n_shards):
+    """
+    y range (y_start, y_stop) of the shard,
+    sizes of slabs differ by at most 1.
+    """
+    assert 0 < n_shards <= ny, "n_shards should in range [1, {}]".format(ny)
+    assert 0 <= shard < n_shards, "shard should in range [0, {})".format(n_shards)
+    return ny * shard // n_shards, ny * (shard + 1) // n_shards
+
+
+def shard_path(out_dir, name, shard, n_shards):
+    """ path of the shard file. """
+    return os.path.join(out_dir, "%s.shard-%d-of-%d.h5"%(name, shard, n_shards))
+
+
+def prepare_shards(series, dataset='arr4d'):
+    """
+    Hash the input dataset once before the shard jobs are handed out,
+    store its fingerprint in the hdf5 file, return the fingerprint.
+
+    :series: (simucaller.Series object) opened writable.
+    :dataset: (str) input 4D dataset of the shards.
+    """
+    return series.data_fingerprint(dataset)
+
+
+def run_shard(series, algorithm, name, shard, n_shards, out_dir,
+              data_fingerprint=None, **kwargs):
+    """
+    Evaluate one slab of the analysis, write the shard file,
+    return the path of shard file.
+
+    :series: (simucaller.Series object) can be opened read-only,
+        then its data fingerprint should be stored by `prepare_shards`
+        or given, so frames out of the slab are never read.
+    :algorithm: (str) registered algorithm name.
+    :name: (str) result name.
+    :shard: (int) shard number, in [0, n_shards)
+    :n_shards: (int) number of shards.
+    :out_dir: path to directory of shard files.
+    :data_fingerprint: (str/None) fingerprint of the input dataset,
+        returned by `prepare_shards`, default the one stored in the file.
+    :kwargs: algorithm parameters and engine options,
+        see `simucaller.engine.stream_algorithm`
+    """
+    for option in _UNUSED_OPTIONS:
+        kwargs.pop(option, None)
+    y_start, y_stop = slab(int(series.shape[1]), shard, n_shards)
+    dataset = kwargs.get('dataset') or 'arr4d'
+    if data_fingerprint is None:
+        # hashing reads every frame, not done by read-only shards
+        assert getattr(series.h5dict, 'mode', None) != 'r' or \
+            stored_data_fingerprint(series.h5dict[dataset]) is not None, \
+            "data fingerprint of {} not stored, run `prepare_shards` " \
+            "(prepare command) before the shard jobs".format(dataset)
+        data_fingerprint = series.data_fingerprint(dataset)
+    params, key = result_fingerprint(series, algorithm,
+                                     data_fingerprint=data_fingerprint, **kwargs)
+    log.info("shard {}/{} of {}/{}: y {}-{}".format(
+        shard, n_shards, algorithm, name, y_start, y_stop))
+    blocks = [block for _, block in stream_algorithm(
+        algorithm, series, y_range=(y_start, y_stop), **kwargs)]
+    result = np.concatenate(blocks, axis=-3)
+
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    path = shard_path(out_dir, name, shard, n_shards)
+    # written to a temporary file then renamed,
+    # so a partial file never taken as finished
+    tmp_path = path + '.tmp'
+    with File(tmp_path, 'w') as f:
+        f.create_dataset('result', data=result)
+        f.attrs['algorithm'] = algorithm
+        f.attrs['name'] = name
+        f.attrs['shard'] = shard
+        f.attrs['n_shards'] = n_shards
+        f.attrs['y_start'] = y_start
+        f.attrs['y_stop'] = y_stop
+        f.attrs['shape'] = np.asarray(series.shape)
+        f.attrs['fingerprint'] = key
+        f.attrs['dataset'] = dataset
+        f.attrs['data_fingerprint'] = data_fingerprint
+        f.attrs['params'] = params
+    os.replace(tmp_path, path)
+    return path
+
+
+def _read_shard(path):
+    with File(path, 'r') as f:
+        attrs = dict(f.attrs.items())
+        return attrs, f['result'][...]
+
+
+def merge_shards(series, algorithm, name, out_dir, save=True):
+    """
+    Validate and assemble the shard files of result `name`,
+    store the result in series.simu_results (and the hdf5 file if save),
+    return the result.
+
+    Validation: every shard file of the same algorithm, parameters and data
+    (fingerprints) as the others and the series, shards cover the y axis
+    exactly once.
+
+    :series: (simucaller.Series object)
+    :algorithm: (str) registered algorithm name.
+    :name: (str) result name.
+    :out_dir: path to directory of shard files.
+    :save: (bool) save the result to the hdf5 file.
+    """
+    paths = sorted(glob.glob(os.path.join(glob.escape(out_dir),
+                                          glob.escape(name) + ".shard-*-of-*.h5")))
+    assert paths, "no shard file of {} in {}".format(name, out_dir)
+    ny = int(series.shape[1])
+    shards = {}
+    first = None
+    for path in paths:
+        attrs, block = _read_shard(path)
+        if first is None:
+            first = attrs
+        assert attrs['algorithm'] == algorithm, \
+            "{} is a shard of algorithm {}".format(path, attrs['algorithm'])
+        assert attrs['n_shards'] == first['n_shards'], \
+            "{}: shard files split in different n_shards".format(path)
+        assert attrs['fingerprint'] == first['fingerprint'], \
+            "{}: shard files of different parameters or data".format(path)
+        assert attrs['data_fingerprint'] == series.data_fingerprint(attrs['dataset']), \
+            "{}: shard computed on different data".format(path)
+        assert tuple(attrs['shape']) == tuple(series.shape), \
+            "{}: shard of series in shape {}".format(path, tuple(attrs['shape']))
+        k, n_shards = int(attrs['shard']), int(attrs['n_shards'])
+        y_start, y_stop = slab(ny, k, n_shards)
+        assert (attrs['y_start'], attrs['y_stop']) == (y_start, y_stop), \
+            "{}: slab not match shard {}/{}".format(path, k, n_shards)
+        assert block.shape[-3:] == (y_stop - y_start,) + tuple(series.shape[2:]), \
+            "{}: result in wrong shape {}".format(path, block.shape)
+        shards[k] = block
+    n_shards = int(first['n_shards'])
+    missing = sorted(set(range(n_shards)) - set(shards))
+    assert not missing, "missing shards: {}".format(missing)
+
+    result = np.concatenate([shards[k] for k in range(n_shards)], axis=-3)
+    log.info("{} shards of {}/{} merged".format(n_shards, algorithm, name))
+    if not hasattr(series, 'simu_results'):
+        series.simu_results = {}
+    if not hasattr(series, 'simu_meta'):
+        series.simu_meta = {}
+    series.simu_results.setdefault(algorithm, {})
+    series.simu_results[algorithm][name] = result
+    series.simu_meta["%s/%s"%(algorithm, name)] = \
+        {'fingerprint': first['fingerprint'], 'params': first['params']}
+    if save:
+        series.save_simu_result(algorithm, name)
+    return result
+
+
+def _shard_job(args):
+    hdf5_path, cachedir, algorithm, name, shard, n_shards, out_dir, kwargs = args
+    series = Series(hdf5_path, cachedir=cachedir, mode='r')
+    try:
+        return run_shard(series, algorithm, name, shard, n_shards, out_dir, **kwargs)
+    finally:
+        series.h5dict.close()
+
+
+def run_sharded(hdf5_path, algorithm, name, n_shards, out_dir, processes=None,
+                cachedir=CACHE, save=True, **kwargs):
+    """
+    Run all shards on local processes, then merge them, return the result.
+
+    Series parameters (like break_points) are taken from kwargs or the
+    attributes saved in the hdf5 file (`Series.save_attr`).
+
+    :hdf5_path: path to Series hdf5 file, not opened by others for writing.
+    :algorithm: (str) registered algorithm name.
+    :name: (str) result name.
+    :n_shards: (int) number of shards.
+    :out_dir: path to directory of shard files.
+    :processes: (int/None) number of processes, default use all cpu cores.
+    :cachedir: path to cache directory.
+    :save: (bool) save the merged result to the hdf5 file.
+    :kwargs: algorithm parameters and engine options of each shard.
+    """
+    alg = get_algorithm(algorithm)
+    series = Series(hdf5_path, cachedir=cachedir)
+    kwargs['data_fingerprint'] = prepare_shards(
+        series, kwargs.get('dataset') or 'arr4d')
+    for param, attr in alg.series_params.items():
+        if kwargs.get(param) is None and hasattr(series, attr):
+            kwargs[param] = getattr(series, attr)
+    series.h5dict.close()
+
+    jobs = [(hdf5_path, cachedir, algorithm, name, k, n_shards, out_dir, kwargs)
+            for k in range(n_shards)]
+    pool = mp.Pool(processes=min(processes or mp.cpu_count(), n_shards))
+    try:
+        pool.map(_shard_job, jobs)
+    finally:
+        pool.terminate()
+        pool.join()
+
+    series = Series(hdf5_path, cachedir=cachedir)
+    try:
+        return merge_shards(series, algorithm, name, out_dir, save)
+    finally:
+        series.h5dict.close()
@@ -0,0 +1,155 @@
+"""
+Gaussian spatial smoothing of a Series.
+
+Separable: one 1-D Gaussian convolution along each of the y, x, z axes,
+applied to a batch of time frames at once, batches optionally evaluated
+by a pool of worker processes.
+
+The smoothed series is written to a derived dataset (default
+`derived/smooth_fwhm<fwhm>`) in the same hdf5 file, analyses use it by
+the engine option `dataset`:
+
+    path = series.smooth(fwhm=2)
+    series.call_simu('ttest', 'call_1', dataset=path)
+"""
+
+import multiprocessing as mp
+from itertools import islice
+
+import numpy as np
+from scipy import ndimage
+
+from simucaller.helpers import get_logger
+from simucaller.progress import ProgressTracker
+
+log = get_logger(__name__)
+
+DERIVED = 'derived'
+
+# FWHM = sigma * 2 sqrt(2 ln 2)
+FWHM_TO_SIGMA = 1.0 / (2 * np.sqrt(2 * np.log(2)))
+
+
+def gaussian_kernel(fwhm, truncate=3.0):
+    """
+    normalized 1-D Gaussian kernel, None if fwhm is 0.
+
+    :fwhm: (float) full width at half maximum, unit: voxel
+    :truncate: (float) kernel radius, unit: sigma
+    """
+    if fwhm <= 0:
+        return None
+    sigma = fwhm * FWHM_TO_SIGMA
+    radius = max(1, int(np.ceil(truncate * sigma)))
+    x = np.arange(-radius, radius + 1)
+    kernel = np.exp(-0.5 * (x / sigma) ** 2)
+    return kernel / kernel.sum()
+
+
+def _axis_fwhm(fwhm):
+    """ fwhm of (y, x, z) axes from a number or a 3-sequence. """
+    fwhm = np.broadcast_to(np.asarray(fwhm, dtype=np.float64), (3,))
+    assert (fwhm >= 0).all() and (fwhm > 0).any(), "fwhm should be positive"
+    return tuple(float(f) for f in fwhm)
+
+
+def smooth_frames(frames, fwhm, mode='nearest'):
+    """
+    smooth a batch of frames (n, y, x, z) spatially,
+    return array in the same shape and dtype (float32 for integer input).
+
+    :frames: (numpy array) in shape (n, y, x, z)
+    :fwhm: (float/tuple) FWHM of all axes or (y, x, z) axes, unit: voxel
+    :mode: boundary mode, see `scipy.ndimage.convolve1d`
+    """
+    out = frames if frames.dtype.kind == 'f' else frames.astype(np.float32)
+    for axis, f in zip((1, 2, 3), _axis_fwhm(fwhm)):
+        kernel = gaussian_kernel(f)
+        if kernel is not None:
+            out = ndimage.convolve1d(out, kernel, axis=axis, mode=mode)
+    return out
+
+
+def _smooth_job(args):
+    frames, fwhm = args
+    return smooth_frames(frames, fwhm)
+
+
+def _iter_batches(dset, batch_size):
+    """ yield (t_slice, frames) of each batch of frames. """
+    nt = dset.shape[0]
+    for t0 in range(0, nt, batch_size):
+        ts = slice(t0, min(t0 + batch_size, nt))
+        yield ts, dset[ts]
+
+
+def _smooth_pool(dst, batches, fwhm, processes, tracker, frame_size):
+    """ smooth batches in worker processes, at most 2 batches per process in flight. """
+    pool = mp.Pool(processes=processes)
+    try:
+        while True:
+            tracker.check()
+            chunk = list(islice(batches, 2 * processes))
+            if not chunk:
+                break
+            results = pool.map(_smooth_job, [(f, fwhm) for _, f in chunk])
+            for (ts, frames), smoothed in zip(chunk, results):
+                dst[ts] = smoothed
+                tracker.update(frames.shape[0] * frame_size, frames.nbytes)
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def smooth_series(series, fwhm, name=None, batch_size=16, processes=None,
+                  progress=None, cancel=None):
+    """
+    Smooth arr4d of series, write the derived dataset, return its path.
+
+    :series: (simucaller.Series object)
+    :fwhm: (float/tuple) FWHM of all axes or (y, x, z) axes, unit: voxel
+    :name: (str/None) dataset name under the group 'derived',
+        default 'smooth_fwhm<fwhm>'
+    :batch_size: (int) how many time frames smoothed at once.
+    :processes: (int/None) smooth batches in this many worker processes,
+        None for in this process.
+    :progress: (callable/None) called after each batch of frames,
+        see `simucaller.progress`
+    :cancel: (simucaller.progress.CancelToken/None) checked between batches.
+    """
+    fwhm = _axis_fwhm(fwhm)
+    if name is None:
+        axes = fwhm[:1] if len(set(fwhm)) == 1 else fwhm
+        name = "smooth_fwhm" + "_".join("%g"%f for f in axes)
+    path = "%s/%s"%(DERIVED, name)
+    src = series.h5dict['arr4d']
+    if path in series.h5dict:
+        log.warning("dataset {} exists, overwrite it".format(path))
+        del series.h5dict[path]
+    getattr(series, '_data_fingerprints', {}).pop(path, None)
+    dtype = src.dtype if np.dtype(src.dtype).kind == 'f' else np.float32
+    # src is an in-memory array in `simucaller.service`
+    dst = series.h5dict.create_dataset(path, shape=src.shape, dtype=dtype,
+                                       chunks=getattr(src, 'chunks', None))
+    dst.attrs['source'] = 'arr4d'
+    dst.attrs['fwhm'] = fwhm
+
+    frame_size = int(np.prod(src.shape[1:]))
+    tracker = ProgressTracker(int(src.shape[0]) * frame_size, progress, cancel)
+    batches = _iter_batches(src, batch_size)
+    log.info("smoothing with fwhm {} voxels ...".format(fwhm))
+    try:
+        if processes is None:
+            for ts, frames in batches:
+                tracker.check()
+                dst[ts] = smooth_frames(frames, fwhm)
+                tracker.update(frames.shape[0] * frame_size, frames.nbytes)
+        else:
+            _smooth_pool(dst, batches, fwhm, processes, tracker, frame_size)
+    except BaseException:
+        # never leave a partially smoothed dataset to be analysed
+        del series.h5dict[path]
+        raise
+    series.h5dict.flush()
+    log.info("smoothed series stored in dataset {}".format(path))
+    return path
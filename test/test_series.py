@@ -6,6 +6,8 @@ from subprocess import check_call
 import sys
 sys.path.insert(0, "../")
 
+import numpy as np
+
 from simucaller.series import Series
 from simucaller.helpers import get_logger
 
@@ -55,6 +57,37 @@ def test_get_arr2d():
     arr2d = series.get_arr2d(100, 20, axis='xz')
     assert arr2d.shape == (shape[1], shape[2])
 
+def test_get_series2d():
+    """ Series.get_series2d """
+    series = Series(hdf5, cachedir=cache)
+    arr = series.get_series2d(3, axis='xy')
+    assert arr.shape == (n_images,) + shape[0:2]
+    assert (arr[:, 21, 21] == series.get_series(21, 21, 3)).all()
+    arr = series.get_series2d(20, axis='yz')
+    assert arr.shape == (n_images, shape[0], shape[2])
+
+def test_roi():
+    """
+    Series.get_roi_series
+    Series.save_roi
+    """
+    series = Series(hdf5, cachedir=cache)
+    mask = np.zeros(shape, dtype=bool)
+    mask[20:23, 20:22, 2] = True
+    mask[30, 40, 4] = True
+    arr = series.get_region_series(mask)
+    assert arr.shape == (n_images, 7)
+    assert (arr[:, -1] == series.get_series(40, 30, 4)).all()
+    # scattered voxels read one by one, the block read as its bounding box
+    block = np.zeros(shape, dtype=bool)
+    block[20:23, 20:22, 2] = True
+    assert (series.get_region_series(block) == arr[:, :-1]).all()
+    mean = series.get_roi_series(mask)
+    assert np.allclose(mean, arr.mean(axis=1))
+    series.save_roi('roi_0', mask)
+    assert 'roi_0' in series.list_roi()
+    assert (series.get_roi('roi_0') == mask).all()
+
 def test_set_break_points():
     """ Serirs.set_break_points """
     series = Series(hdf5, cachedir=cache)
@@ -96,6 +129,400 @@ def test_call_simu():
     # save attributes
     series.save_attr()
 
+def test_scan_break_points():
+    """ call_simu.scan_break_points """
+    from scipy import stats
+    from simucaller.call_simu import scan_break_points
+    series = Series(hdf5, cachedir=cache)
+    series.set_break_points((100, 110))
+    candidates = range(90, 120)
+    stat, best = scan_break_points(series, candidates)
+    assert stat.shape == (len(candidates),) + shape
+    assert best.shape == shape
+    assert set(best.flat) <= set(candidates)
+    # t statistic of diff_ttest at the candidate break points
+    arr4d = series.h5dict['arr4d']
+    for y, x, z in [(0, 0, 0), (15, 20, 3), (40, 5, 8)]:
+        diff = np.diff(arr4d[:, y, x, z].astype(np.float64))
+        for i in (0, 12, 29):
+            start = candidates[i]
+            after = diff[start + 10 + 1:]
+            ref = stats.ttest_ind(after, diff[:start - 1])[0]
+            assert np.isclose(stat[i, y, x, z], ref, rtol=1e-4)
+
+def test_diff_ttest_phases():
+    """ call_simu.diff_ttest_phases """
+    from simucaller import call_simu
+    series = Series(hdf5, cachedir=cache)
+    series.set_break_points((100, 110))
+    stacked = call_simu.diff_ttest_phases(series, phases=[1, 2, 3],
+        directions=['+', '~'], n_after=30, diff_length=2)
+    assert stacked.shape == (3, 2) + shape
+    single = call_simu.diff_ttest(series, '~', n_after=30, phase=3, diff_length=2)
+    assert np.allclose(stacked[2, 1], single, equal_nan=True)
+    arr4d = series.h5dict['arr4d']
+    _, pvalue = call_simu._diff_ttest((5, 5, 1), arr4d[:, 5, 5, 1].astype(np.float64),
+        (100, 110), '~', n_after=30, phase=3, diff_length=2)
+    assert np.isclose(single[5, 5, 1], pvalue, rtol=1e-4)
+
+def test_moment_index():
+    """ Series.build_moment_index """
+    from simucaller import call_simu
+    series = Series(hdf5, cachedir=cache)
+    series.set_break_points((100, 110))
+    series.set_simu_intervals([(28 + i*40, 28 + i*40 + 10) for i in range(8)])
+    direct = call_simu.ttest(series, use_index=False), \
+        call_simu.diff_ttest(series, use_index=False)
+    series.build_moment_index()
+    assert call_simu.has_moment_index(series)
+    indexed = call_simu.ttest(series), call_simu.diff_ttest(series)
+    for a, b in zip(direct, indexed):
+        assert np.allclose(a, b, rtol=1e-4, equal_nan=True)
+
+def test_registry():
+    """ registry.register, engine.run_algorithm """
+    from simucaller import call_simu
+    from simucaller.registry import register, list_algorithms
+    from simucaller.engine import run_algorithm
+    series = Series(hdf5, cachedir=cache)
+    series.set_simu_intervals([(28 + i*40, 28 + i*40 + 10) for i in range(8)])
+    # the per-voxel reference is slow, compare on a slab only
+    slab = slice(20, 24)
+    reference = call_simu.algorithm_interface(call_simu._ttest, series,
+        intervals=series.simu_intervals, y_range=(slab.start, slab.stop))
+    serial = run_algorithm('ttest', series, use_index=False)
+    multi = run_algorithm('ttest', series, engine='process', processes=2,
+                          use_index=False)
+    assert np.isnan(reference[:slab.start]).all()
+    assert np.isnan(reference[slab.stop:]).all()
+    assert np.allclose(reference[slab], serial[slab], rtol=1e-4, equal_nan=True)
+    assert np.allclose(serial, multi, equal_nan=True)
+
+    mask = np.zeros(shape, dtype=bool)
+    mask[20:30, 20:30] = True
+    masked = run_algorithm('ttest', series, mask=mask, use_index=False)
+    assert np.isnan(masked[~mask]).all()
+    assert np.allclose(masked[mask], serial[mask], equal_nan=True)
+
+    @register('mean_diff', params={'split': 100})
+    def mean_diff(arr2d, split):
+        return arr2d[split:].mean(axis=0) - arr2d[:split].mean(axis=0)
+    assert 'mean_diff' in list_algorithms()
+    series.call_simu('mean_diff', 'call_2', split=110)
+    assert series.simu_results['mean_diff']['call_2'].shape == shape
+
+def test_kernels():
+    """ kernels.ttest_columns against scipy.stats.ttest_ind """
+    from scipy import stats
+    from simucaller.kernels import ttest_columns
+    series = Series(hdf5, cachedir=cache)
+    arr2d = series.h5dict['arr4d'][:, 20:24, 20:24, 0].reshape(n_images, -1)
+    rows1, rows2 = np.arange(100, 200), np.arange(0, 90)
+    t, df = ttest_columns(arr2d, rows1, rows2, 0)
+    ref = stats.ttest_ind(arr2d[rows1].astype(np.float64),
+                          arr2d[rows2].astype(np.float64))
+    assert np.allclose(t, ref[0], equal_nan=True)
+    diff = np.diff(arr2d.astype(np.float64), axis=0)
+    t, df = ttest_columns(arr2d, rows1, rows2, 1)
+    assert np.allclose(t, stats.ttest_ind(diff[rows1], diff[rows2])[0],
+                       equal_nan=True)
+
+def test_memory_budget():
+    """ engine.estimate_memory, run_algorithm with dtype and memory budget """
+    from simucaller.engine import estimate_memory, run_algorithm, DEFAULT_BLOCK_SIZE
+    series = Series(hdf5, cachedir=cache)
+    series.set_simu_intervals([(28 + i*40, 28 + i*40 + 10) for i in range(8)])
+    default = estimate_memory('ttest', series)
+    assert default['block_size'] == DEFAULT_BLOCK_SIZE
+    spread = estimate_memory('ttest', series, engine='process', processes=16)
+    assert spread['block_size'] == shape[0] // 32
+    budget = default['peak'] // 4
+    blocked = estimate_memory('ttest', series, memory_budget=budget)
+    assert blocked['block_size'] < DEFAULT_BLOCK_SIZE and blocked['peak'] <= budget
+    reports = []
+    double = run_algorithm('ttest', series, use_index=False,
+                           progress=reports.append)
+    assert len(reports) == shape[0] // DEFAULT_BLOCK_SIZE
+    single = run_algorithm('ttest', series, use_index=False,
+                           dtype=np.float32, memory_budget=budget)
+    assert single.dtype == np.float32
+    assert np.allclose(single, double, rtol=1e-4, equal_nan=True)
+
+    # result volume alone exceed the budget: written to hdf5 block by block
+    tiny = default['result'] // 4
+    streamed = series.call_simu('ttest', 'streamed', force=True,
+                                use_index=False, memory_budget=tiny)
+    assert not isinstance(streamed, np.ndarray)
+    assert streamed.name.startswith('/scratch/')
+    assert np.allclose(streamed[...], double, equal_nan=True)
+    series.save_simu_result('ttest', 'streamed')
+    assert len(series.h5dict['scratch']) == 0
+    assert np.allclose(series.get_simu_result('ttest', 'streamed'), double,
+                       equal_nan=True)
+
+def test_create_from_nifti():
+    """ Series.create_from_nifti """
+    import nibabel as nib
+    nifti, hdf5_nii = "./test_4d.nii.gz", "./test_nii.h5"
+    data = np.random.normal(size=(8, 7, 3, 20)).astype('f4')
+    img = nib.Nifti1Image(data, np.diag([2., 2., 4., 1.]))
+    img.header.set_xyzt_units('mm', 'msec')
+    img.header['pixdim'][4] = 1500
+    nib.save(img, nifti)
+    if os.path.exists(hdf5_nii):
+        os.remove(hdf5_nii)
+    series = Series(hdf5_nii, nifti_path=nifti, cachedir=cache)
+    assert tuple(series.shape) == (20, 8, 7, 3)
+    assert series.time_interval == 1.5
+    assert np.allclose(series.affine, img.affine)
+    assert np.array_equal(series.h5dict['arr4d'][...], np.moveaxis(data, -1, 0))
+
+def test_append_images():
+    """ Series.append_images """
+    import nibabel as nib
+    from simucaller import call_simu
+    image_dir, hdf5_app = "./test_append", "./test_append.h5"
+    if os.path.exists(image_dir):
+        rmtree(image_dir)
+    os.mkdir(image_dir)
+    if os.path.exists(hdf5_app):
+        os.remove(hdf5_app)
+    vols = np.random.normal(100, 5, size=(16, 6, 5, 3)).astype('f4')
+    def write(i):
+        img = nib.AnalyzeImage(vols[i], np.eye(4))
+        nib.save(img, os.path.join(image_dir, "img%03d.hdr"%i))
+    for i in range(10):
+        write(i)
+    series = Series(hdf5_app, image_dir=image_dir, time_interval=2, cachedir=cache)
+    series.build_moment_index()
+    series.get_series(0, 0, 0)
+    other = Series(hdf5, cachedir=cache)
+    other.get_series(0, 0, 0)
+    for i in range(10, 16):
+        write(i)
+    assert series.append_images(image_dir) == 6
+    # only the cache of the appended series cleared
+    assert os.listdir(other._series_cachedir())
+    assert series.append_images(image_dir) == 0
+    assert series.n_images == 16
+    with pytest.raises(AssertionError):
+        series.append_volumes([vols[0], vols[0][:, :, :2]])
+    assert series.h5dict['arr4d'].shape[0] == 16
+    assert np.array_equal(series.h5dict['arr4d'][...], vols)
+    assert call_simu.has_moment_index(series)
+    extended = series.h5dict['moment_index']['cumsum_diff_sq'][...]
+    series.build_moment_index()
+    assert np.allclose(extended, series.h5dict['moment_index']['cumsum_diff_sq'][...])
+
+def test_online():
+    """ online.OnlineAnalysis """
+    from simucaller.online import OnlineAnalysis
+    from simucaller.engine import run_algorithm
+    hdf5_app = "./test_append.h5"
+    series = Series(hdf5_app, cachedir=cache)
+    intervals = [(2, 5), (series.n_images + 1, series.n_images + 4)]
+    online = OnlineAnalysis(series, 'ttest', direction='~', intervals=intervals)
+    published = []
+    online.subscribe(lambda pvalue_arr3d, t: published.append(t))
+    volumes = np.random.normal(100, 5, size=(4,) + tuple(series.shape[1:]))
+    for vol in volumes:
+        pvalue_arr3d = online.add_volume(vol.astype('f4'))
+    assert len(published) == 4
+    reference = run_algorithm('ttest', series, use_index=False,
+                              intervals=intervals, direction='~')
+    assert np.allclose(pvalue_arr3d, reference, rtol=1e-6, equal_nan=True)
+
+def test_glm():
+    """ glm.glm """
+    from simucaller import call_simu
+    from simucaller.glm import glm
+    series = Series(hdf5, cachedir=cache)
+    series.set_simu_intervals([(28 + i*40, 28 + i*40 + 10) for i in range(8)])
+    # boxcar and intercept only: same as two sample t-test
+    result = glm(series, drift=0, direction='~', memory_budget=10 * 1024 ** 2)
+    assert result['beta'].shape == (2,) + shape
+    ttest = call_simu.ttest(series, direction='~', use_index=False)
+    assert np.allclose(result['p'][0], ttest, rtol=1e-5, equal_nan=True)
+    result = glm(series, 'call_glm', hrf=True, drift=2, contrasts=[[1], [0, 1]])
+    assert result['t'].shape == (2,) + shape
+    assert 'glm/call_glm_p1' in series.list_simu_result()
+    with pytest.raises(AssertionError):
+        glm(series, 'call_glm', hrf=True, drift=1, contrasts=[[1], [0, 1]])
+    result = glm(series, 'call_glm', hrf=True, drift=1, contrasts=[[1], [0, 1]],
+                 overwrite=True)
+    assert np.allclose(series.get_simu_result('glm', 'call_glm_p1'),
+                       result['p'][1], rtol=1e-5, equal_nan=True)
+
+def test_seed_correlation():
+    """ correlation.seed_correlation """
+    from simucaller.correlation import seed_correlation
+    series = Series(hdf5, cachedir=cache)
+    mask = np.zeros(shape, dtype=bool)
+    mask[0:2, 0:2, 0] = True
+    r, pvalue = seed_correlation(series, mask, 'seed', direction='~')
+    arr4d = series.h5dict['arr4d'][...].astype(np.float64)
+    seed = arr4d[:, mask].mean(axis=1)
+    for y, x, z in [(0, 0, 0), (3, 1, 0), (5, 4, 2)]:
+        assert np.isclose(r[y, x, z], np.corrcoef(seed, arr4d[:, y, x, z])[0, 1])
+    assert np.all(pvalue[mask] < 0.05)
+    assert 'seed_correlation/seed_r' in series.list_simu_result()
+    with pytest.raises(AssertionError):
+        seed_correlation(series, mask, 'seed', direction='+')
+    _, pvalue = seed_correlation(series, mask, 'seed', direction='+', overwrite=True)
+    assert np.allclose(series.get_simu_result('seed_correlation', 'seed'), pvalue,
+                       equal_nan=True)
+
+def test_fingerprint():
+    """ Series.call_simu reuse saved result with the same fingerprint """
+    series = Series(hdf5, cachedir=cache)
+    series.set_simu_intervals([(28 + i*40, 28 + i*40 + 10) for i in range(8)])
+    result = series.call_simu('ttest', 'fp_0', direction='~')
+    series.save_simu_result('ttest', 'fp_0')
+    series.set_simu_intervals(np.array(series.simu_intervals))
+    reports = []
+    reused = series.call_simu('ttest', 'fp_1', direction='~', block_size=4,
+                              use_index=False, progress=reports.append)
+    assert series.simu_meta['ttest/fp_1'] == series.simu_meta['ttest/fp_0']
+    # loaded, not computed block by block
+    assert len(reports) == 1 and reports[0].n_done == reports[0].n_total
+    assert reused.dtype == result.dtype
+    assert np.allclose(result, reused, equal_nan=True)
+    series.call_simu('ttest', 'fp_2', direction='+', force=True)
+    assert series.simu_meta['ttest/fp_2'] != series.simu_meta['ttest/fp_0']
+    params = dict(series.list_simu_result(params=True))['ttest/fp_0']
+    assert params['direction'] == '~' and len(params['intervals']) == 8
+
+class _ReadRecorder(object):
+    """ h5dict wrapper record the index of each arr4d read. """
+    def __init__(self, h5dict, reads):
+        self._h5dict = h5dict
+        self._reads = reads
+
+    def __getitem__(self, key):
+        dset = self._h5dict[key]
+        if key != 'arr4d':
+            return dset
+        recorder = self
+        class Dataset(object):
+            shape, dtype, attrs = dset.shape, dset.dtype, dset.attrs
+            def __getitem__(self, index):
+                recorder._reads.append(index)
+                return dset[index]
+        return Dataset()
+
+    def __contains__(self, key):
+        return key in self._h5dict
+
+    def __getattr__(self, name):
+        return getattr(self._h5dict, name)
+
+def test_shard():
+    """ shard.run_sharded, shard.run_shard, shard.merge_shards """
+    from simucaller import call_simu
+    from simucaller.shard import run_sharded, run_shard, slab
+    intervals = [(28 + i*40, 28 + i*40 + 10) for i in range(8)]
+    result = run_sharded(hdf5, 'ttest', 'sharded', 5, "./shards",
+                         processes=2, cachedir=cache, intervals=intervals)
+    series = Series(hdf5, cachedir=cache)
+    series.set_simu_intervals(intervals)
+    assert np.allclose(result, call_simu.ttest(series, use_index=False),
+                       equal_nan=True)
+    assert 'ttest/sharded' in series.list_simu_result()
+
+    # a read-only shard job reads only its slab, data fingerprint stored
+    reads = []
+    job = Series(hdf5, cachedir=cache, mode='r')
+    job.h5dict = _ReadRecorder(job.h5dict, reads)
+    run_shard(job, 'ttest', 'slab', 1, 4, "./shards", intervals=intervals)
+    y_start, y_stop = slab(shape[0], 1, 4)
+    assert reads
+    for index in reads:
+        assert isinstance(index, tuple), "whole frames read: {}".format(index)
+        assert y_start <= index[1].start and index[1].stop <= y_stop
+    job.h5dict.close()
+    rmtree("./shards")
+
+def test_smooth():
+    """ Series.smooth, engine option dataset """
+    from scipy import ndimage
+    from simucaller.smoothing import FWHM_TO_SIGMA
+    series = Series(hdf5, cachedir=cache)
+    path = series.smooth(2, batch_size=7)
+    frame = series.h5dict['arr4d'][3]
+    assert np.allclose(series.h5dict[path][3],
+                       ndimage.gaussian_filter(frame, 2 * FWHM_TO_SIGMA,
+                                               mode='nearest', truncate=3.0),
+                       atol=1e-3)
+    series.set_simu_intervals([(28 + i*40, 28 + i*40 + 10) for i in range(8)])
+    raw = series.call_simu('ttest', 'raw')
+    smoothed = series.call_simu('ttest', 'smoothed', dataset=path)
+    assert smoothed.shape == raw.shape
+    assert series.simu_meta['ttest/raw']['fingerprint'] != \
+        series.simu_meta['ttest/smoothed']['fingerprint']
+
+def _serve():
+    from simucaller.service import SeriesService
+    service = SeriesService(hdf5, cachedir=cache)
+    service.serve_forever()
+    service.close()
+
+def test_service():
+    """ service.SeriesService, service.SeriesClient """
+    import time
+    import multiprocessing as mp
+    from simucaller import service
+    from simucaller.progress import CancelToken, Cancelled
+    daemon = mp.Process(target=_serve)
+    daemon.start()
+    address = service.service_address(hdf5)
+    # socket and authkey private to this user
+    assert os.stat(os.path.dirname(address)).st_mode & 0o077 == 0
+    try:
+        for _ in range(100):
+            if service.is_serving(address):
+                break
+            time.sleep(0.1)
+        client = service.open_series(hdf5, cachedir=cache)
+        assert isinstance(client, service.SeriesClient)
+        # arr4d shared by the service is not appendable
+        with pytest.raises(AssertionError):
+            service.open_series(hdf5, cachedir=cache, served=False)
+        with pytest.raises(RuntimeError):
+            client.append_volumes([np.zeros(shape)])
+        # the service opens the file only while answering a request
+        series = Series(hdf5, cachedir=cache, mode='r')
+        assert np.array_equal(client.get_arr3d(10), series.h5dict['arr4d'][10])
+        series.h5dict.close()
+        client.set_simu_intervals([(28 + i*40, 28 + i*40 + 10) for i in range(8)])
+        reports = []
+        client.call_simu('ttest', 'served', force=True, use_index=False,
+                         block_size=4, progress=reports.append)
+        # progress forwarded block by block
+        assert len(reports) == shape[0] // 4
+        assert reports[-1].n_done == reports[-1].n_total
+        cancel = CancelToken()
+        with pytest.raises(Cancelled):
+            client.call_simu('ttest', 'cancelled', force=True, use_index=False,
+                             block_size=4, progress=lambda p: cancel.cancel(),
+                             cancel=cancel)
+        remote = service.SeriesClient(hdf5, attach=False)
+        remote.set_simu_intervals(client.simu_intervals)
+        remote.call_simu('ttest', 'served', use_index=False) # cached by the service
+        assert np.array_equal(client.simu_results['ttest']['served'],
+                              remote.simu_results['ttest']['served'])
+        client.save_simu_result('ttest', 'served')
+        assert 'ttest/served' in client.list_simu_result()
+        client.close()
+        remote.close()
+    finally:
+        if service.is_serving(address):
+            service.SeriesClient(address=address, attach=False).request('shutdown')
+        daemon.join(10)
+        if daemon.is_alive():
+            daemon.terminate()
+            daemon.join()
+    assert daemon.exitcode == 0
+
 #def test_clean():
 #    """ clean all intermedia files """
 #    os.remove(hdf5)